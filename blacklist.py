@@ -0,0 +1,111 @@
+"""Compiled matcher for a list of stream patterns.
+
+The patterns have the syntax understood by fnmatch (e.g. "GE.*.*.BH?"). They
+are compiled once: patterns without wildcards are kept in a set and the rest
+are translated to regular expressions, grouped by network code when the code
+does not contain wildcards. Checking a stream ID is then a set lookup plus at
+most two regular expressions, independently of the number of patterns.
+"""
+
+import os
+import re
+import fnmatch
+
+_magic = re.compile('[*?[]')
+
+
+def _translate(pattern):
+    """Regular expression for a pattern without the end anchor and flags
+    added by fnmatch.translate."""
+
+    regex = fnmatch.translate(pattern)
+    for suffix in ('\\Z(?ms)', '\\Z'):
+        if regex.endswith(suffix):
+            return regex[:-len(suffix)]
+    return regex
+
+
+def _compile(patterns):
+    if not patterns:
+        return None
+    return re.compile('(?ms)(?:%s)\\Z' % '|'.join(_translate(p)
+                                                 for p in patterns))
+
+
+class Blacklist:
+    """Set of patterns of streams to discard."""
+
+    def __init__(self, patterns=()):
+        self.filename = None
+        self._stat = None
+        self.setPatterns(patterns)
+
+    @classmethod
+    def fromFile(cls, filename):
+        """Read the patterns from a file (one per line). IOError or OSError
+        is raised if the file cannot be read."""
+
+        result = cls()
+        result.filename = filename
+        result.reload()
+        return result
+
+    def setPatterns(self, patterns):
+        self.patterns = [p for p in patterns if p]
+
+        # Patterns without wildcards
+        self._exact = set()
+        # Patterns with wildcards grouped by network code
+        byNetwork = dict()
+        # Patterns with wildcards also in the network code
+        generic = []
+
+        for p in self.patterns:
+            if not _magic.search(p):
+                self._exact.add(p)
+                continue
+
+            net = p.split('.', 1)[0]
+            if _magic.search(net) or '.' not in p:
+                generic.append(p)
+            else:
+                byNetwork.setdefault(net, []).append(p)
+
+        self._byNetwork = dict((net, _compile(pats))
+                               for net, pats in byNetwork.iteritems())
+        self._generic = _compile(generic)
+
+    def reload(self):
+        """Read again the file if it was modified.
+
+        Returns True if the patterns were (re)loaded."""
+
+        if self.filename is None:
+            return False
+
+        st = os.stat(self.filename)
+        stat = (st.st_mtime, st.st_size)
+        if stat == self._stat:
+            return False
+
+        with open(self.filename) as fin:
+            self.setPatterns([line.strip() for line in fin])
+        self._stat = stat
+        return True
+
+    def __contains__(self, streamID):
+        if streamID in self._exact:
+            return True
+
+        regex = self._byNetwork.get(streamID.split('.', 1)[0])
+        if regex is not None and regex.match(streamID):
+            return True
+
+        return self._generic is not None and \
+            self._generic.match(streamID) is not None
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def __len__(self):
+        return len(self.patterns)
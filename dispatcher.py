@@ -0,0 +1,307 @@
+"""Processing of the events received by a long-running application.
+
+Every qualifying event gets its own magnitude processors and its own
+acquisition of waveforms, which runs in a separate thread and hands the
+records over to a processing thread through a bounded queue (EventJob). The
+resources which do not depend on the event (inventory, travel times) are
+created once by the application and used by all the jobs.
+
+The dispatcher does not use the messaging system. The application passes the
+events with their preferred origin and magnitude to it, so that it can be fed
+in the same way from the messaging system, from a file or from a script.
+"""
+
+import sys
+import time
+import threading
+import traceback
+import seiscomp3.IO
+import seiscomp3.Core
+import seiscomp3.Logging
+import waveproc
+import recordqueue
+
+
+def _printException():
+    info = traceback.format_exception(*sys.exc_info())
+    for i in info:
+        sys.stderr.write(i)
+
+
+class RecordStreamSource:
+    """Records of a list of time windows read from a SC3 RecordStream."""
+
+    def __init__(self, url, windows, timeout=3600):
+        self.stream = seiscomp3.IO.RecordStream.Open(url)
+        if self.stream is None:
+            raise IOError("cannot open record stream '%s'" % url)
+        self.stream.setTimeout(timeout)
+        for t_from, t_to, net, sta, loc, cha in windows:
+            self.stream.addStream(net, sta, loc, cha, t_from, t_to)
+
+    def __iter__(self):
+        return iter(seiscomp3.IO.RecordInput(
+            self.stream, seiscomp3.Core.Array.DOUBLE,
+            seiscomp3.Core.Record.SAVE_RAW))
+
+    def removeStream(self, streamID):
+        """Stop receiving a stream, if the RecordStream supports it."""
+
+        if hasattr(self.stream, 'removeStream'):
+            n, s, l, c = streamID.split('.')
+            self.stream.removeStream(n, s, l, c)
+
+    def close(self):
+        self.stream.close()
+
+
+class EventJob:
+    """Magnitude processors of one event and the acquisition of its
+    waveforms."""
+
+    def __init__(self, eventID, processors, windows, queueSize=10000,
+                 overflow='block'):
+        """processors: dictionary with the magnitude processors by name
+        windows: list of time windows requested by the processors
+                 (t_from, t_to, net, sta, loc, cha)
+        queueSize, overflow: size and overflow policy of the queue of
+                             records between the acquisition and the
+                             processing (see recordqueue.RecordQueue)"""
+
+        self.eventID = eventID
+        self.processors = processors
+        self.windows = windows
+        # Objects fed with the records (the preprocessing shared by the
+        # processors)
+        self.inputs = waveproc.processorInputs(
+            [processors[name] for name in sorted(processors)])
+        self.queueSize = queueSize
+        self.overflow = overflow
+
+        # The processors are fed from the processing thread and updated
+        # from the thread of the application
+        self.lock = threading.Lock()
+
+        # Number of records received
+        self.records = 0
+        # Streams rejected by all the processors. Only the acquisition
+        # thread uses it and the source.
+        self.discarded = set()
+        # Streams rejected in the processing thread which the acquisition
+        # has still not discarded
+        self._rejected = []
+        self._rejectedLock = threading.Lock()
+        for name in processors:
+            processors[name].onReject = self._streamRejected
+        # Maximum time (wall clock) to wait for the end of the acquisition
+        self.deadline = None
+
+        self._source = None
+        self._thread = None
+        self._queue = None
+        self._stopped = False
+
+    def start(self, source, timeout=3600):
+        """Read the records of "source" (an iterable) in a separate thread
+        and feed the processors with them in another one.
+
+        The acquisition is stopped if it did not finish "timeout" seconds
+        after the length of the longest time window."""
+
+        span = 0.0
+        if self.windows:
+            span = (max(w[1] for w in self.windows) -
+                    min(w[0] for w in self.windows)).length()
+        self.deadline = time.time() + span + timeout
+
+        self._source = source
+        self._queue = recordqueue.RecordQueue(
+            self._process, self.queueSize, self.overflow, self.lock,
+            '%s-processing' % self.eventID)
+        self._thread = threading.Thread(target=self._acquire,
+                                        name=self.eventID)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _acquire(self):
+        try:
+            for rec in self._source:
+                if self._stopped:
+                    break
+                if self._rejected:
+                    self._discardRejected()
+                if rec.streamID() in self.discarded:
+                    continue
+                self._queue.put(rec)
+                self.records += 1
+        except:
+            _printException()
+
+        seiscomp3.Logging.info("event %s: acquisition finished (%d records)"
+                               % (self.eventID, self.records))
+
+    def _process(self, rec):
+        # Called by the queue with the lock held
+        if self._stopped:
+            return
+        for input in self.inputs:
+            input.feed(rec)
+
+    def _streamRejected(self, streamID):
+        # Called from the processing thread
+        for name in self.processors:
+            if streamID not in self.processors[name].quarantine:
+                return
+
+        with self._rejectedLock:
+            self._rejected.append(streamID)
+
+    def _discardRejected(self):
+        with self._rejectedLock:
+            rejected, self._rejected = self._rejected, []
+
+        for streamID in rejected:
+            self.discarded.add(streamID)
+            if hasattr(self._source, 'removeStream'):
+                self._source.removeStream(streamID)
+
+    def finished(self):
+        """True if the acquisition ended and its records were processed, or
+        if it took too long."""
+
+        if self._thread is None:
+            return False
+        if time.time() > self.deadline:
+            return True
+        return not self._thread.is_alive() and not self._queue.depth()
+
+    def setOrigin(self, origin):
+        with self.lock:
+            for name in self.processors:
+                self.processors[name].setEvent(origin)
+
+    def update(self):
+        with self.lock:
+            for name in self.processors:
+                self.processors[name].flush()
+                self.processors[name].update()
+        if self._queue is not None:
+            self._queue.report()
+
+    def finalize(self):
+        """Stop the acquisition and calculate the final results."""
+
+        # The records already queued are processed unless the acquisition
+        # took too long
+        if self._queue is not None:
+            if time.time() > self.deadline:
+                self._stopped = True
+            self._queue.close()
+
+        with self.lock:
+            self._stopped = True
+            for name in self.processors:
+                processor = self.processors[name]
+                processor.flush()
+                processor.update()
+                processor.finalize()
+
+        # Unblock the acquisition thread if it is still waiting for data
+        if self._thread is not None and self._thread.is_alive() and \
+                hasattr(self._source, 'close'):
+            try:
+                self._source.close()
+            except:
+                _printException()
+
+
+class EventDispatcher:
+    """Start a job for every qualifying event, update the jobs in progress
+    and retire them when their acquisition is finished."""
+
+    def __init__(self, createJob, openSource, minMagnitude=None):
+        """createJob: function receiving an event ID and its preferred origin
+                      and returning an EventJob (None if the event cannot be
+                      processed)
+        openSource: function receiving a list of time windows and returning
+                    an iterable with their records
+        minMagnitude: minimum value of the preferred magnitude of the events
+                      to process (None to process all the events)"""
+
+        self.createJob = createJob
+        self.openSource = openSource
+        self.minMagnitude = minMagnitude
+
+        # Jobs in progress by event ID
+        self.jobs = dict()
+        # Events already processed (or which could not be processed)
+        self.done = set()
+
+    def qualifies(self, magnitude):
+        if self.minMagnitude is None:
+            return True
+        return magnitude is not None and magnitude >= self.minMagnitude
+
+    def setEvent(self, eventID, origin, magnitude=None):
+        """Start or update the processing of an event with its current
+        preferred origin and the value of its preferred magnitude.
+
+        The job of the event is returned (None if it is not processed)."""
+
+        job = self.jobs.get(eventID)
+        if job is not None:
+            job.setOrigin(origin)
+            return job
+
+        if eventID in self.done or not self.qualifies(magnitude):
+            return None
+
+        seiscomp3.Logging.info("event %s: starting processing" % eventID)
+        try:
+            job = self.createJob(eventID, origin)
+            if job is not None:
+                job.start(self.openSource(job.windows))
+        except:
+            _printException()
+            job = None
+
+        if job is None:
+            seiscomp3.Logging.error("event %s cannot be processed" % eventID)
+            self.done.add(eventID)
+            return None
+
+        self.jobs[eventID] = job
+        return job
+
+    def _retire(self, eventID):
+        job = self.jobs.pop(eventID)
+        self.done.add(eventID)
+        try:
+            job.finalize()
+        except:
+            _printException()
+        seiscomp3.Logging.info("event %s: processing finished" % eventID)
+
+    def update(self):
+        """Update the jobs in progress and retire the finished ones. The IDs
+        of the events retired are returned."""
+
+        retired = []
+        for eventID in sorted(self.jobs):
+            if self.jobs[eventID].finished():
+                self._retire(eventID)
+                retired.append(eventID)
+                continue
+
+            try:
+                self.jobs[eventID].update()
+            except:
+                _printException()
+
+        return retired
+
+    def close(self):
+        """Finalize all the jobs in progress."""
+
+        for eventID in sorted(self.jobs):
+            self._retire(eventID)
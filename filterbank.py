@@ -0,0 +1,435 @@
+"""Butterworth filters applied to the signal of many streams at once.
+
+A FilterBank keeps the coefficients of every band (second-order sections)
+once per sampling rate and the state of the filter of every stream in a
+2-D array, so that the blocks of many streams can be filtered in one call
+(e.g. the batches of all the streams on every update) and the filtered
+signal can be shared by all the magnitude modules.
+
+The bands are given as in SeisComP3: "BW(order, fmin, fmax)" (bandpass),
+"BW_LP(order, fc)" and "BW_HP(order, fc)". The filters are designed as the
+bilinear transform (with prewarped frequencies) of the analog Butterworth
+filter, but it has not been verified that they are the same as the
+recursive filters of SeisComP3 (e.g. that a bandpass is designed in the same
+way), so scxxlmag-compute does not use it and the modules still filter every
+stream on their own (scxxlmag-bench.py can use it). Run this module in a
+SeisComP3 environment to compare both on the streams of a miniSEED file:
+
+    python filterbank.py [file.mseed] [band]
+
+It prints the maximum difference between the signals filtered in blocks of
+several sizes by a FilterBank and by seiscomp3.Math.InPlaceFilterD, relative
+to the RMS of the latter, and fails if it is over "tolerance".
+
+scipy.signal.sosfilt is used to apply the filters if scipy is installed.
+Otherwise they are applied with numpy to chunks of samples at once (see
+_filterRows), which gives the same results up to the last digits, depending
+on how the signal is split in blocks (a relative difference under 1E-9, see
+tests/test_filterbank.py).
+"""
+
+import re
+import sys
+import numpy
+
+try:
+    import scipy.signal
+    _sosfilt = scipy.signal.sosfilt
+except ImportError:
+    _sosfilt = None
+
+_bandRe = re.compile(r'^\s*(BW|BW_LP|BW_HP)\s*\(([^)]*)\)\s*$')
+
+# Samples filtered at once by the numpy implementation
+chunkSize = 32
+
+# Maximum difference accepted between a signal filtered by a FilterBank and
+# by SeisComP3, relative to the RMS of the filtered signal (see compare)
+tolerance = 1E-3
+
+
+def parseBand(band):
+    """Kind ("bandpass", "lowpass" or "highpass"), order and frequencies of
+    a band given as in SeisComP3."""
+
+    m = _bandRe.match(band)
+    if m is None:
+        raise ValueError("Unknown filter '%s'" % band)
+    try:
+        args = [float(a) for a in m.group(2).split(',')]
+    except ValueError:
+        raise ValueError("Wrong parameters of filter '%s'" % band)
+
+    kind = {'BW': 'bandpass', 'BW_LP': 'lowpass',
+            'BW_HP': 'highpass'}[m.group(1)]
+    if len(args) != (3 if kind == 'bandpass' else 2) or args[0] < 1 or \
+            args[0] != int(args[0]) or min(args[1:]) <= 0:
+        raise ValueError("Wrong parameters of filter '%s'" % band)
+    if kind == 'bandpass' and args[1] >= args[2]:
+        raise ValueError("Wrong frequencies of filter '%s'" % band)
+
+    return kind, int(args[0]), tuple(args[1:])
+
+
+def butterworth(band, sps):
+    """Second-order sections (one row [b0, b1, b2, 1, a1, a2] per section)
+    of a Butterworth filter for a sampling rate."""
+
+    kind, order, freqs = parseBand(band)
+    if max(freqs) >= sps / 2.0:
+        raise ValueError("Frequencies of filter '%s' over the Nyquist "
+                         "frequency (%g Hz)" % (band, sps / 2.0))
+
+    # Poles of the analog lowpass prototype (cutoff 1 rad/s)
+    k = numpy.arange(order)
+    poles = numpy.exp(1j * numpy.pi * (2 * k + order + 1) / (2.0 * order))
+
+    # Prewarped frequencies of the analog filter
+    fs2 = 2.0 * sps
+    warped = [fs2 * numpy.tan(numpy.pi * f / sps) for f in freqs]
+
+    if kind == 'bandpass':
+        bw = warped[1] - warped[0]
+        wo = numpy.sqrt(warped[0] * warped[1])
+        scaled = poles * bw / 2.0
+        root = numpy.sqrt(scaled * scaled - wo * wo)
+        poles = numpy.concatenate([scaled + root, scaled - root])
+        zeros = numpy.zeros(order)
+        gain = bw ** order
+    elif kind == 'lowpass':
+        poles = warped[0] * poles
+        zeros = numpy.zeros(0)
+        gain = warped[0] ** order
+    else:
+        gain = numpy.real(1.0 / numpy.prod(-poles))
+        poles = warped[0] / poles
+        zeros = numpy.zeros(order)
+
+    # Bilinear transform. The zeros at infinity go to -1.
+    gain *= numpy.real(numpy.prod(fs2 - zeros) / numpy.prod(fs2 - poles))
+    zeros = numpy.concatenate([(fs2 + zeros) / (fs2 - zeros),
+                               -numpy.ones(len(poles) - len(zeros))])
+    poles = (fs2 + poles) / (fs2 - poles)
+
+    # Every section gets a pair of complex conjugate poles (or two real
+    # ones) and two zeros, alternating the zeros at +1 and -1
+    tol = 1E-10
+    pairs = [(p, p.conjugate()) for p in poles if p.imag > tol]
+    real = sorted(p.real for p in poles if abs(p.imag) <= tol)
+    pairs += [tuple(real[i:i + 2]) for i in range(0, len(real), 2)]
+    zeros = sorted(zeros.real)
+    zeros = [z for pair in zip(zeros[:len(zeros) // 2],
+                               zeros[::-1][:len(zeros) // 2])
+             for z in pair] + zeros[len(zeros) // 2:len(zeros) -
+                                    len(zeros) // 2]
+
+    sos = numpy.zeros((len(pairs), 6))
+    for i, pair in enumerate(pairs):
+        a = numpy.real(numpy.poly(pair))
+        b = numpy.real(numpy.poly(zeros[2 * i:2 * i + len(pair)]))
+        sos[i, 3:3 + len(a)] = a
+        sos[i, :len(b)] = b
+    sos[0, :3] *= gain
+
+    return sos
+
+
+def _filterSamples(sos, x, state):
+    """Apply a filter to the rows of x, updating their state (sections x
+    rows x 2), looping over the samples (like scipy.signal.sosfilt)."""
+
+    y = x.copy()
+    for s in range(len(sos)):
+        b0, b1, b2, a0, a1, a2 = sos[s]
+        z1 = state[s, :, 0]
+        z2 = state[s, :, 1]
+        for n in range(x.shape[1]):
+            xn = y[:, n]
+            yn = b0 * xn + z1
+            z1[:] = b1 * xn - a1 * yn + z2
+            z2[:] = b2 * xn - a2 * yn
+            y[:, n] = yn
+    return y
+
+
+def _chunkMatrices(sos, size):
+    """Matrices giving the output and the final state of a filter for
+    "size" samples as a linear function of the samples x and of the
+    initial state s (one row per stream, the state of every section one
+    after the other): y = x Mx + s Ms, s' = x Nx + s Ns.
+
+    They are the response to every sample and every variable of the state
+    alone."""
+
+    order = 2 * len(sos)
+    x = numpy.zeros((size + order, size))
+    x[:size] = numpy.eye(size)
+    state = numpy.zeros((len(sos), size + order, 2))
+    for k in range(order):
+        state[k // 2, size + k, k % 2] = 1.0
+
+    y = _filterSamples(sos, x, state)
+    final = state.transpose(1, 0, 2).reshape(size + order, order)
+    return y[:size], y[size:], final[:size], final[size:]
+
+
+def _filterRows(matrices, x, lengths, state):
+    """Apply a filter to the rows of x (each one with its own number of
+    samples, sorted from the longest), updating their state (sections x
+    rows x 2). The samples are filtered in chunks of chunkSize samples with
+    the matrices of the filter for a number of samples ("matrices" returns
+    them, see _chunkMatrices). The remaining samples of the rows with the
+    same number of them are filtered together as well."""
+
+    size = chunkSize
+    rows, sections = len(x), len(state)
+    y = numpy.zeros_like(x)
+    s = state.transpose(1, 0, 2).reshape(rows, -1)
+
+    # einsum gives the same results for a row whatever the other rows are,
+    # unlike dot
+    full = lengths // size
+    mx, ms, nx, ns = matrices(size)
+    for c in range(full[0]):
+        # Rows with at least c + 1 complete chunks
+        k = numpy.searchsorted(-full, -c, 'left')
+        xc = x[:k, c * size:(c + 1) * size]
+        sc = s[:k]
+        y[:k, c * size:(c + 1) * size] = \
+            numpy.einsum('ij,jk->ik', xc, mx) + \
+            numpy.einsum('ij,jk->ik', sc, ms)
+        s[:k] = numpy.einsum('ij,jk->ik', xc, nx) + \
+            numpy.einsum('ij,jk->ik', sc, ns)
+
+    rest = lengths - full * size
+    for n in numpy.unique(rest[rest > 0]):
+        same = numpy.flatnonzero(rest == n)
+        cols = full[same, None] * size + numpy.arange(n)
+        xc = x[same[:, None], cols]
+        sc = s[same]
+        mx, ms, nx, ns = matrices(n)
+        y[same[:, None], cols] = numpy.einsum('ij,jk->ik', xc, mx) + \
+            numpy.einsum('ij,jk->ik', sc, ms)
+        s[same] = numpy.einsum('ij,jk->ik', xc, nx) + \
+            numpy.einsum('ij,jk->ik', sc, ns)
+
+    state[...] = s.reshape(rows, sections, 2).transpose(1, 0, 2)
+    return y
+
+
+class _Group:
+    """Filters and state of the streams with the same sampling rate."""
+
+    def __init__(self, sps):
+        self.sps = sps
+        self.sos = dict()
+        self.state = dict()
+        # Matrices of the numpy implementation by band and number of
+        # samples (see _chunkMatrices)
+        self._matrices = dict()
+        self.size = 0
+        self.capacity = 16
+
+    def add(self):
+        if self.size == self.capacity:
+            self.capacity *= 2
+            for band in self.state:
+                state = numpy.zeros((len(self.sos[band]), self.capacity, 2))
+                state[:, :self.size] = self.state[band][:, :self.size]
+                self.state[band] = state
+        self.size += 1
+        return self.size - 1
+
+    def filter(self, band):
+        """Coefficients and state of a band, created the first time it is
+        used."""
+
+        if band not in self.sos:
+            self.sos[band] = butterworth(band, self.sps)
+            self.state[band] = numpy.zeros((len(self.sos[band]),
+                                            self.capacity, 2))
+        return self.sos[band], self.state[band]
+
+    def matrices(self, band, size):
+        key = band, size
+        if key not in self._matrices:
+            self._matrices[key] = _chunkMatrices(self.sos[band], size)
+        return self._matrices[key]
+
+
+class FilterBank:
+
+    def __init__(self):
+        # Groups of streams by sampling rate
+        self._groups = dict()
+        # Number of calls and of blocks and samples filtered
+        self.calls = 0
+        self.blocks = 0
+        self.samples = 0
+
+    def addStream(self, sps, bands=()):
+        """Add a stream and return the handle of its state. The filters of
+        the given bands are designed for its sampling rate, so that a
+        ValueError is raised if they cannot be applied."""
+
+        group = self._groups.get(sps)
+        if group is None:
+            group = self._groups[sps] = _Group(sps)
+        for band in bands:
+            group.filter(band)
+        return sps, group.add()
+
+    def reset(self, stream):
+        """Start the filters of a stream again (e.g. after a gap)."""
+
+        sps, row = stream
+        group = self._groups[sps]
+        for band in group.state:
+            group.state[band][:, row] = 0.0
+
+    def filter(self, band, streams, blocks):
+        """Filter the consecutive blocks of samples of some streams (handles
+        returned by addStream), continuing from the state of every stream.
+        A list with the filtered blocks is returned."""
+
+        result = [None] * len(blocks)
+        bySps = dict()
+        for i, (sps, row) in enumerate(streams):
+            bySps.setdefault(sps, []).append(i)
+
+        for sps in bySps:
+            group = self._groups[sps]
+            sos, state = group.filter(band)
+            # The longest blocks first
+            order = sorted(bySps[sps], key=lambda i: -len(blocks[i]))
+            rows = numpy.array([streams[i][1] for i in order])
+            lengths = numpy.array([len(blocks[i]) for i in order])
+            if not lengths[0]:
+                continue
+
+            x = numpy.zeros((len(order), lengths[0]))
+            for j, i in enumerate(order):
+                x[j, :lengths[j]] = blocks[i]
+
+            zi = state[:, rows]
+            if _sosfilt is None:
+                y = _filterRows(lambda n: group.matrices(band, n), x,
+                                lengths, zi)
+            else:
+                # Blocks of the same length are filtered together
+                y = numpy.empty_like(x)
+                for n in numpy.unique(lengths):
+                    same = numpy.flatnonzero(lengths == n)
+                    y[same, :n], zi[:, same] = _sosfilt(
+                        sos, x[same, :n], axis=-1, zi=zi[:, same])
+            state[:, rows] = zi
+
+            for j, i in enumerate(order):
+                result[i] = y[j, :lengths[j]]
+
+            self.calls += 1
+            self.blocks += len(order)
+            self.samples += int(lengths.sum())
+
+        for i, block in enumerate(blocks):
+            if result[i] is None:
+                result[i] = numpy.zeros(0)
+        return result
+
+
+def compare(band, sps, signal, blockSize):
+    """Maximum difference between a signal filtered by a FilterBank in
+    blocks of "blockSize" samples and by the filter of SeisComP3
+    (seiscomp3.Math.InPlaceFilterD), relative to the RMS of the latter."""
+
+    import seiscomp3.Core
+    import seiscomp3.Math
+
+    signal = numpy.asarray(signal, dtype=numpy.double)
+    sc3 = seiscomp3.Math.InPlaceFilterD.Create(band)
+    sc3.setSamplingFrequency(sps)
+    data = seiscomp3.Core.DoubleArrayT()
+    data.setNumpy(signal)
+    sc3.apply(data)
+    expected = data.numpy()
+
+    bank = FilterBank()
+    stream = bank.addStream(sps, [band])
+    result = numpy.concatenate([
+        bank.filter(band, [stream], [signal[i:i + blockSize]])[0]
+        for i in range(0, len(signal), blockSize)])
+
+    rms = numpy.sqrt(numpy.mean(expected * expected))
+    return float(numpy.max(numpy.abs(result - expected)) / rms) if rms \
+        else float(numpy.max(numpy.abs(result - expected)))
+
+
+def readStreams(filename):
+    """Samples of every stream of a miniSEED file, up to its first gap, and
+    their sampling rate."""
+
+    import seiscomp3.IO
+    import seiscomp3.Core
+
+    stream = seiscomp3.IO.RecordStream.Open('file://' + filename)
+    if stream is None:
+        raise IOError("cannot open '%s'" % filename)
+
+    streams = dict()
+    complete = set()
+    for rec in seiscomp3.IO.RecordInput(stream, seiscomp3.Core.Array.DOUBLE,
+                                        seiscomp3.Core.Record.SAVE_RAW):
+        streamID = rec.streamID()
+        if streamID in complete:
+            continue
+        sps = rec.samplingFrequency()
+        if streamID in streams:
+            end, sps0, blocks = streams[streamID]
+            if sps != sps0 or \
+                    abs((rec.startTime() - end).length()) > 0.5 / sps:
+                complete.add(streamID)
+                continue
+        else:
+            blocks = []
+        blocks.append(numpy.array(rec.data().numpy(), dtype=numpy.double))
+        streams[streamID] = rec.endTime(), sps, blocks
+
+    return dict((streamID, (sps, numpy.concatenate(blocks)))
+                for streamID, (end, sps, blocks) in streams.items())
+
+
+def main():
+    """Compare the filters with the ones of SeisComP3 (see the
+    documentation of the module)."""
+
+    if len(sys.argv) > 3:
+        sys.stderr.write("Usage: %s [file.mseed] [band]\n" % sys.argv[0])
+        return 2
+
+    band = sys.argv[2] if len(sys.argv) == 3 else "BW(4, 1, 3)"
+    if len(sys.argv) > 1:
+        streams = readStreams(sys.argv[1])
+    else:
+        # White noise, at the most common sampling rates
+        rng = numpy.random.RandomState(1)
+        streams = dict(('noise-%g' % sps, (sps, rng.normal(0, 1, 20000)))
+                       for sps in (20.0, 40.0, 100.0))
+
+    worst = 0.0
+    print '%-20s %6s %12s %12s %12s' % ('stream', 'sps', 'blocks of 1',
+                                        '512', 'all')
+    for streamID in sorted(streams):
+        sps, signal = streams[streamID]
+        diff = [compare(band, sps, signal, size)
+                for size in (1, 512, len(signal))]
+        worst = max([worst] + diff)
+        print '%-20s %6g %12.3g %12.3g %12.3g' % ((streamID, sps) +
+                                                   tuple(diff))
+
+    print 'Maximum relative difference with SeisComP3 (%s): %.3g ' \
+        '(tolerance %g)' % (band, worst, tolerance)
+    return 0 if worst <= tolerance else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
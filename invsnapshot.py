@@ -0,0 +1,298 @@
+"""Compact snapshot of the inventory.
+
+Only the information needed by the magnitude modules is kept: codes,
+coordinates, gains and epochs of networks, stations, locations and streams.
+The snapshot is saved with numpy in a single file together with a key that
+identifies the inventory it was created from. Loading it is much faster than
+loading the complete inventory from the database.
+
+The objects created from the snapshot provide the same methods as the SC3
+objects which are used by the application and the magnitude modules (code(),
+latitude(), longitude(), elevation(), gain()), so that they can be used in
+the inventory dictionary instead of the SC3 objects.
+"""
+
+import os
+import hashlib
+import numpy
+import seiscomp3.IO
+import seiscomp3.Logging
+
+
+class Network(object):
+    __slots__ = ('_code',)
+
+    def __init__(self, code):
+        self._code = code
+
+    def code(self):
+        return self._code
+
+
+class Station(object):
+    __slots__ = ('_code', '_latitude', '_longitude', '_elevation')
+
+    def __init__(self, code, latitude, longitude, elevation):
+        self._code = code
+        self._latitude = latitude
+        self._longitude = longitude
+        self._elevation = elevation
+
+    def code(self):
+        return self._code
+
+    def latitude(self):
+        return self._latitude
+
+    def longitude(self):
+        return self._longitude
+
+    def elevation(self):
+        return self._elevation
+
+
+class SensorLocation(Network):
+    __slots__ = ()
+
+
+class Stream(object):
+    __slots__ = ('_code', '_gain')
+
+    def __init__(self, code, gain):
+        self._code = code
+        self._gain = gain
+
+    def code(self):
+        return self._code
+
+    def gain(self):
+        # As the SC3 object does when the gain is not set
+        if numpy.isnan(self._gain):
+            raise ValueError("Stream.gain is not set")
+        return self._gain
+
+
+def _epoch(obj):
+    """Start and end of the epoch of an SC3 object in seconds.
+
+    As in the application, an epoch without end is open and an epoch that
+    cannot be checked at all is always considered operational."""
+
+    try:
+        start = obj.start().length()
+    except:
+        return -numpy.inf, numpy.inf
+
+    try:
+        return start, obj.end().length()
+    except:
+        return start, numpy.inf
+
+
+def _value(method):
+    try:
+        return method()
+    except:
+        return numpy.nan
+
+
+def inventoryKey(source, database=None):
+    """Key identifying the current state of an inventory source.
+
+    source: file name or database URL given to load the inventory
+    database: URL of the database (when the inventory is read from it)
+
+    For a file, its size and modification time are part of the key. For a
+    database, the last modification of the inventory tables is requested.
+    None is returned if the state of the source cannot be determined."""
+
+    key = hashlib.sha1()
+
+    if source and os.path.isfile(source):
+        st = os.stat(source)
+        key.update('%s %d %f' % (os.path.abspath(source), st.st_size,
+                                 st.st_mtime))
+        return key.hexdigest()
+
+    url = source or database
+    if not url:
+        return None
+
+    try:
+        db = seiscomp3.IO.DatabaseInterface.Open(url)
+        if db is None:
+            return None
+
+        key.update(url)
+        for table in ('Network', 'Station', 'SensorLocation', 'Stream'):
+            query = 'select count(*), max(_last_modified) from %s' % table
+            if not db.beginQuery(query):
+                return None
+            if db.fetchRow():
+                key.update('%s %s %s' % (table, db.getRowFieldString(0),
+                                         db.getRowFieldString(1)))
+            db.endQuery()
+        db.disconnect()
+    except Exception, e:
+        seiscomp3.Logging.warning("Cannot check the inventory in %s: %s" %
+                                  (url, str(e)))
+        return None
+
+    return key.hexdigest()
+
+
+class InventorySnapshot:
+    """Codes, coordinates, gains and epochs of an inventory in numpy
+    arrays."""
+
+    def __init__(self, key, networks, stations, locations, streams):
+        """key: key of the inventory (see inventoryKey)
+        networks: array of network codes
+        stations: structured array (net, sta, lat, lon, elev, start, end)
+        locations: structured array (station, loc, start, end), where
+                   station is the position in "stations"
+        streams: structured array (location, cha, gain, start, end), where
+                 location is the position in "locations"."""
+
+        self.key = key
+        self.networks = networks
+        self.stations = stations
+        self.locations = locations
+        self.streams = streams
+
+    @classmethod
+    def fromInventory(cls, inv, key):
+        """Create the snapshot from a SC3 inventory with all the epochs."""
+
+        networks = []
+        stations = []
+        locations = []
+        streams = []
+
+        for inet in xrange(inv.networkCount()):
+            network = inv.network(inet)
+            net = network.code()
+            networks.append(net)
+            for ista in xrange(network.stationCount()):
+                station = network.station(ista)
+                stations.append((net, station.code(),
+                                 _value(station.latitude),
+                                 _value(station.longitude),
+                                 _value(station.elevation)) +
+                                _epoch(station))
+                for iloc in xrange(station.sensorLocationCount()):
+                    location = station.sensorLocation(iloc)
+                    locations.append((len(stations) - 1, location.code()) +
+                                     _epoch(location))
+                    for istr in xrange(location.streamCount()):
+                        stream = location.stream(istr)
+                        streams.append((len(locations) - 1, stream.code(),
+                                        _value(stream.gain)) +
+                                       _epoch(stream))
+
+        def table(rows, dtype):
+            return numpy.array(rows, dtype=dtype) if rows else \
+                numpy.zeros(0, dtype=dtype)
+
+        strType = 'S%d'
+        size = lambda pos, rows: max([len(r[pos]) for r in rows] or [1])
+
+        networks = numpy.array(networks, dtype=strType % max(
+            [len(n) for n in networks] or [1]))
+        stations = table(stations, [('net', strType % size(0, stations)),
+                                    ('sta', strType % size(1, stations)),
+                                    ('lat', float), ('lon', float),
+                                    ('elev', float),
+                                    ('start', float), ('end', float)])
+        locations = table(locations, [('station', int),
+                                      ('loc', strType % size(1, locations)),
+                                      ('start', float), ('end', float)])
+        streams = table(streams, [('location', int),
+                                  ('cha', strType % size(1, streams)),
+                                  ('gain', float),
+                                  ('start', float), ('end', float)])
+
+        return cls(key, networks, stations, locations, streams)
+
+    @classmethod
+    def load(cls, filename):
+        with numpy.load(filename) as npz:
+            return cls(str(npz['key']), npz['networks'], npz['stations'],
+                       npz['locations'], npz['streams'])
+
+    @staticmethod
+    def loadKey(filename):
+        """Read only the key of a snapshot file. None if it cannot be
+        read."""
+
+        try:
+            with numpy.load(filename) as npz:
+                return str(npz['key'])
+        except Exception:
+            return None
+
+    def save(self, filename):
+        # Write with a temporary name to never leave a half-written snapshot
+        tmpName = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmpName, 'wb') as fout:
+            numpy.savez(fout, key=numpy.array(self.key),
+                        networks=self.networks, stations=self.stations,
+                        locations=self.locations, streams=self.streams)
+        os.rename(tmpName, filename)
+
+    def inventory(self, time, blacklisted=None):
+        """Dictionary with the operational items at "time" (seconds), as
+        created by the application from the SC3 inventory.
+
+        blacklisted: function receiving a stream ID (N.S.L.C) and returning
+                     True if the stream must be discarded."""
+
+        result = dict()
+        for net in self.networks.tolist():
+            result[net] = Network(net)
+
+        sta = self.stations
+        staOK = (sta['start'] < time) & (time < sta['end'])
+
+        # Stations without coordinates or elevation cannot be used to
+        # calculate travel times (the SC3 objects raise an exception)
+        unknown = staOK & (numpy.isnan(sta['lat']) | numpy.isnan(sta['lon']) |
+                           numpy.isnan(sta['elev']))
+        for net, code in sta[['net', 'sta']][unknown].tolist():
+            seiscomp3.Logging.warning("%s.%s has no coordinates or elevation, "
+                                      "skipped" % (net, code))
+        staOK &= ~unknown
+
+        loc = self.locations
+        locOK = (loc['start'] < time) & (time < loc['end']) & \
+            staOK[loc['station']]
+
+        stm = self.streams
+        stmOK = (stm['start'] < time) & (time < stm['end']) & \
+            locOK[stm['location']]
+
+        staRows = sta.tolist()
+        for row in numpy.flatnonzero(staOK).tolist():
+            net, code, lat, lon, elev = staRows[row][:5]
+            result[net, code] = Station(code, lat, lon, elev)
+
+        locRows = loc.tolist()
+        for row in numpy.flatnonzero(locOK).tolist():
+            station, code = locRows[row][:2]
+            net, sta = staRows[station][:2]
+            result[net, sta, code] = SensorLocation(code)
+
+        for location, code, gain in stm[['location', 'cha', 'gain']][
+                stmOK].tolist():
+            station, loc = locRows[location][:2]
+            net, sta = staRows[station][:2]
+            key = (net, sta, loc, code)
+
+            # Check whether the stream should be discarded
+            if blacklisted is not None and blacklisted(".".join(key)):
+                seiscomp3.Logging.warning("blacklisted %s" % ".".join(key))
+                continue
+
+            result[key] = Stream(code, gain)
+
+        return result
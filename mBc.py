@@ -1,12 +1,14 @@
-import os
 import sys
-import glob
+import copy
 import numpy
 from collections import namedtuple, Iterable
 import seiscomp3.Math
 import seiscomp3.Core
 import waveproc
-from math import log10, pi, sqrt
+import streamstats
+import wavedump
+import traveltime
+from math import log10, pi
 import seiscomp3.Logging
 import seiscomp3.Seismology
 
@@ -46,13 +48,280 @@ class Peak(namedtuple('Peak', ['time', 'value'])):
             return self.time > other
 
 
-def mysign(number):
-    if number == 0:
-        return 0
+class PeakList(object):
+    """Peaks in chronological order, stored in a structured array with the
+    fields "time" and "value" (16 bytes per peak) which grows as needed.
 
-    if number < 0:
-        return -1
-    return 1
+    The cumulative sum of the amplitudes (half of the absolute value of the
+    peaks) is kept while the peaks are appended, so that the sum up to any
+    time is a binary search and does not need to go through all the peaks.
+    Items are returned as Peak."""
+
+    def __init__(self, peaks=()):
+        self._data = numpy.zeros(16, dtype=wavedump.dumpType)
+        self._cumul = numpy.zeros(16)
+        self._size = 0
+        self.extend(peaks)
+
+    def append(self, peak):
+        self.extend((peak,))
+
+    def extend(self, peaks):
+        peaks = list(peaks)
+        self.extendArrays([p.time for p in peaks], [p.value for p in peaks])
+
+    def extendArrays(self, times, values):
+        """Append the peaks given by an array of times and one of values."""
+
+        n = len(times)
+        if not n:
+            return
+
+        size = self._size + n
+        if size > len(self._data):
+            capacity = max(size, 2 * len(self._data))
+            data = numpy.zeros(capacity, dtype=wavedump.dumpType)
+            data[:self._size] = self._data[:self._size]
+            cumul = numpy.zeros(capacity)
+            cumul[:self._size] = self._cumul[:self._size]
+            self._data, self._cumul = data, cumul
+
+        new = self._data[self._size:size]
+        new['time'] = times
+        new['value'] = values
+
+        # Added one after the other, as when the peaks were appended in a
+        # loop
+        total = self._cumul[self._size - 1] if self._size else 0.0
+        self._cumul[self._size:size] = numpy.cumsum(numpy.append(
+            total, numpy.abs(new['value']) / 2.0))[1:]
+        self._size = size
+
+    @property
+    def times(self):
+        return self._data['time'][:self._size]
+
+    @property
+    def values(self):
+        return self._data['value'][:self._size]
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, pos):
+        if pos < 0:
+            pos += self._size
+        if not 0 <= pos < self._size:
+            raise IndexError("peak index out of range")
+        return Peak(float(self._data['time'][pos]),
+                    float(self._data['value'][pos]))
+
+    def __iter__(self):
+        return (Peak(t, v) for t, v in zip(self.times.tolist(),
+                                           self.values.tolist()))
+
+    def amplitudeBefore(self, limit):
+        """Sum of the amplitudes of the peaks before "limit"."""
+
+        pos = numpy.searchsorted(self.times, limit, 'left')
+        return float(self._cumul[pos - 1]) if pos else 0.0
+
+    def before(self, limit):
+        """New PeakList with the peaks before "limit"."""
+
+        pos = numpy.searchsorted(self.times, limit, 'left')
+        result = PeakList()
+        result._data = self._data[:pos].copy()
+        result._cumul = self._cumul[:pos].copy()
+        result._size = pos
+        return result
+
+
+class PeakDetector(object):
+    """Recognize the peaks of a signal processing whole blocks of samples.
+
+    A peak is the maximum (in absolute value) of a segment of the signal with
+    the same sign. By definition, it is only accepted if its value is greater
+    than the global maximum (in absolute value) multiplied by q (0.6 in
+    Bormann and Saul, 2008). The open segment and the global maximum are kept
+    between blocks, so that the peaks do not depend on how the signal is split
+    in records."""
+
+    def __init__(self, q=0.6):
+        self.q = q
+        # Global maximum
+        self.Vmaxt = Peak(0, 0)
+        # Maximum of the segment being currently analyzed
+        self.Vlocal = None
+        # Sign of the segment being currently analyzed
+        self.signV = 0
+
+    def feed(self, values, times, lowThresh=0.0):
+        """Search for the peaks in a block of the signal.
+
+        values: numpy array with the samples
+        times: numpy array with the (relative) time of every sample
+        lowThresh: minimum value to be considered a maximum
+
+        Returns:
+            A tuple with an array of the positions in the block where the
+            peaks are recognized (first sample with a different sign) and a
+            list with the peaks."""
+
+        nsamp = len(values)
+        if not nsamp:
+            return numpy.zeros(0, dtype=int), []
+
+        absValues = numpy.abs(numpy.asarray(values, dtype=numpy.double))
+        signs = numpy.sign(values)
+
+        # Beginning and end of the segments with the same sign
+        starts = numpy.concatenate(
+            ([0], numpy.flatnonzero(signs[1:] != signs[:-1]) + 1))
+        ends = numpy.append(starts[1:], nsamp)
+
+        # Maximum of every segment and position of its first occurrence
+        segMax = numpy.maximum.reduceat(absValues, starts)
+        where = numpy.flatnonzero(absValues ==
+                                  numpy.repeat(segMax, ends - starts))
+        segPos = where[numpy.searchsorted(where, starts)]
+
+        peaks = [Peak(t, v) for t, v in zip(times[segPos].tolist(),
+                                            values[segPos])]
+        # Position where every segment is closed
+        closing = starts[1:]
+
+        if signs[0] == self.signV:
+            # The first segment continues the one from the previous block
+            if self.Vlocal is not None and abs(self.Vlocal) >= segMax[0]:
+                peaks[0] = self.Vlocal
+        elif self.Vlocal is not None:
+            # The segment from the previous block is closed right now
+            peaks.insert(0, self.Vlocal)
+            closing = numpy.append(0, closing)
+
+        # The last segment remains open
+        self.Vlocal = peaks.pop()
+        self.signV = int(signs[-1])
+
+        if not peaks:
+            return numpy.zeros(0, dtype=int), []
+
+        absPeaks = numpy.abs(numpy.array([p.value for p in peaks],
+                                         dtype=numpy.double))
+        valid = absPeaks > lowThresh
+        # Global maximum before every candidate
+        globalMax = numpy.maximum.accumulate(numpy.append(
+            abs(self.Vmaxt), numpy.where(valid, absPeaks, 0.0)))[:-1]
+
+        # Case of a global maximum
+        newMax = numpy.flatnonzero(valid & (absPeaks > globalMax))
+        if len(newMax):
+            self.Vmaxt = peaks[newMax[-1]]
+
+        # Global or local maximum
+        accepted = numpy.flatnonzero(valid & (absPeaks >= self.q * globalMax))
+
+        return closing[accepted], [peaks[i] for i in accepted]
+
+    def restart(self):
+        """Discard the open segment, e.g. after a gap. The global maximum is
+        kept."""
+
+        self.Vlocal = None
+        self.signV = 0
+
+
+class DurationStats(object):
+    """Values of the streams whose percentiles are used to combine their
+    results, kept sorted (streamstats.OrderStatistics):
+
+    hara: time from the theoretical P arrival to the global maximum of the
+          processed streams (if it is after the P arrival)
+    active, finished: durations of the streams not in quarantine, before
+                      and after the end of the event was found (stage 3)
+    durations: all the durations except 0
+
+    They are updated from the summaries of the streams (see
+    waveproc.Processor.summary), only for the streams whose values changed
+    since the previous one."""
+
+    def __init__(self):
+        self.hara = streamstats.OrderStatistics()
+        self.active = streamstats.OrderStatistics()
+        self.finished = streamstats.OrderStatistics()
+        self.durations = streamstats.OrderStatistics()
+        self._stats = (self.hara, self.active, self.finished, self.durations)
+
+        # Streams of the last summary and their values (one row per
+        # statistic, NaN if the stream is not included)
+        self._streamIDs = []
+        self._values = numpy.zeros((4, 0))
+
+    def update(self, summary):
+        table = summary['table']
+        streamIDs = summary['streamID']
+
+        stage = table['stage']
+        rejected = table['rejected']
+        duration = table['duration']
+        pExpected = table['pExpected']
+        vmaxTime = table['vmaxTime']
+
+        valid = ~numpy.isnan(duration) & ~rejected
+        finished = stage == 3
+        values = numpy.empty((4, len(streamIDs)))
+        # pExpected is NaN until the stream starts
+        with numpy.errstate(invalid='ignore'):
+            values[0] = numpy.where((stage > 0) & (vmaxTime > pExpected),
+                                    vmaxTime - pExpected, numpy.nan)
+        values[1] = numpy.where(valid & ~finished, duration, numpy.nan)
+        values[2] = numpy.where(valid & finished, duration, numpy.nan)
+        # NaN is kept
+        values[3] = numpy.where(duration != 0, duration, numpy.nan)
+
+        previous = self._previous(streamIDs)
+        changed = (values != previous) & \
+            ((values == values) | (previous == previous))
+        changed = numpy.flatnonzero(changed)
+        for row, old, new in zip((changed // len(streamIDs)).tolist(),
+                                 previous.flat[changed].tolist(),
+                                 values.flat[changed].tolist()):
+            # NaN if the stream was not included
+            if old == old:
+                self._stats[row].remove(old)
+            if new == new:
+                self._stats[row].add(new)
+
+        # The summaries are not modified afterwards
+        self._streamIDs = streamIDs
+        self._values = values
+
+    def _previous(self, streamIDs):
+        """Values of the last summary in the order of the streams of a new
+        one. The values of the streams which are not there anymore are
+        removed."""
+
+        n = len(self._streamIDs)
+        if streamIDs[:n] == self._streamIDs:
+            # Only new streams (the usual case)
+            previous = numpy.empty((4, len(streamIDs)))
+            previous.fill(numpy.nan)
+            previous[:, :n] = self._values
+            return previous
+
+        # The streams were reordered (e.g. by a streampool.ProcessorPool)
+        rows = dict(zip(self._streamIDs, range(n)))
+        pos = numpy.array([rows.pop(streamID, n) for streamID in streamIDs],
+                          dtype=int)
+        values = numpy.hstack([self._values, numpy.zeros((4, 1))])
+        values[:, n] = numpy.nan
+        previous = values[:, pos]
+        for col in rows.values():
+            for row in range(4):
+                if not numpy.isnan(self._values[row, col]):
+                    self._stats[row].remove(float(self._values[row, col]))
+        return previous
 
 
 def Q_PV(dist, depth):
@@ -64,59 +333,90 @@ def Q_PV(dist, depth):
     return _bmagn(0.001 * amp, per, dist, depth)
 
 
-class Processor(waveproc.Processor):
+class StreamState(waveproc.StreamState):
+    """State of the calculation of mBc for a stream."""
+
+    __slots__ = ('filter', 'results', 'results2', 'detectors', 'idx', 'rms',
+                 'pReal', 'posLastPeak', 'magnitude', 'dumps', 'gaps')
+
+    def __init__(self, input, table):
+        waveproc.StreamState.__init__(self, input, table)
+        # Filter to apply to the signal
+        self.filter = None
+        # List of peaks recognized in the raw and the filtered signal. They
+        # are created with the first record processed.
+        self.results = None
+        self.results2 = None
+        # Peak detectors (raw and filtered signal). They keep the state
+        # variables to recognize maximum values between records.
+        self.detectors = None
+        # This can be shared for the two signals (broad band and high
+        # frequency) because the indexes are the same for both of them.
+        # Current offset to know the position of every component of the
+        # record being currently analyzed
+        self.idx = 0
+        # RMS of the (HF) filtered signal to detect P arrival
+        # (streamstats.RunningStats while it is being calculated)
+        self.rms = None
+        # P arrival (relative time)
+        self.pReal = None
+        # Position of the last peak detected
+        # FIXME I think it is not needed anymore
+        self.posLastPeak = 0
+        self.magnitude = None
+        # Files with the raw and filtered signal (if the waveforms are
+        # dumped)
+        self.dumps = None
+        # Gaps after which the processing was resumed (relative time of the
+        # beginning and end)
+        self.gaps = []
+
+    # "stage" specifies if we are:
+    # 0) not processing the stream yet
+    # 1) searching for a maximum
+    # 2) checking the quiet period of 30 seconds
+    # 3) magnitude was already calculated
+    stage = waveproc.tableField('stage')
+    # Duration (NaN until a peak is found in the filtered signal)
+    duration = waveproc.tableField('duration')
+    # Theoretical P arrival (seconds since the beginning of the stream)
+    pExpected = waveproc.tableField('pExpected')
+    # Time of the global maximum of the raw signal
+    vmaxTime = waveproc.tableField('vmaxTime')
 
-    def __init__(self, dumpWaveforms=False):
+
+class Processor(waveproc.Processor):
+    stateClass = StreamState
+    streamFields = waveproc.Processor.streamFields + [
+        ('stage', numpy.int8, 0),
+        ('duration', numpy.double, numpy.nan),
+        ('pExpected', numpy.double, numpy.nan),
+        ('vmaxTime', numpy.double, 0.0)]
+    # Butterworth filter for the Control signal
+    # Filter around 2 Hz (1-3)
+    controlBand = "BW(4, 1, 3)"
+    filterBands = [controlBand]
+
+    def __init__(self, dumpWaveforms=False, ttt=None):
         waveproc.Processor.__init__(self, dumpWaveforms)
         self.name = "mBc"
 
         # Extra margin for the time windows
         self.margin_begin = 30
 
-        # Filter to apply to the signal
-        self.filters = dict()
-        # List of peaks recognized in the raw signal
-        self.results = dict()
-        # List of peaks recognized in the filtered signal
-        self.results2 = dict()
-        # Magnitude per stream
-        self.magnitude = dict()
-        # Duration per stream
-        self.duration = dict()
         # Effective duration to be applied to all the streams.
-        # It is calculated based on the "duration"s of the streams
+        # It is calculated based on the durations of the streams
         self.meanDuration = 0.0
+        # Durations of the streams kept sorted to calculate it
+        self.durationStats = DurationStats()
 
-        # Keeps state variables for every stream to recognize maximum values
-        # Global maximum per stream
-        self.Vmaxt = dict()
-        # Current local maximum per stream
-        self.Vlocal = dict()
-        # Current sign of the signal
-        self.signV = dict()
-        # This can be shared for the two signals (broad band and high
-        # frequency) because the indexes are the same for both of them.
-        # Current offset per stream to know the position of every component of
-        # the record being currently analyzed
-        self.idx = dict()
-
-        # Calculate RMS of the (HF) filtered signal to detect P arrival
-        self.rms = dict()
-        # P arrival per stream
-        self.pReal = dict()
-
-        # "stage" specifies if we are:
-        # 1) searching for a maximum
-        # 2) checking the quiet period of 30 seconds
-        # 3) magnitude was already calculated
-        self.stage = dict()
+        # Short notation for the Time Travel Calculation function. It can be
+        # shared with other processors.
+        self.ttt = ttt if ttt is not None else \
+            seiscomp3.Seismology.TravelTimeTable()
 
-        # Position of the last peak detected
-        # FIXME I think it is not needed anymore
-        self.posLastPeak = dict()
-
-        # Short notation for the Time Travel Calculation function
-        self.ttt = seiscomp3.Seismology.TravelTimeTable()
+    def distanceCorrection(self, delta, depth):
+        return Q_PV(delta, depth)
 
     def timeWindows(self):
         """Calculate the timewindows based on the event and
@@ -131,60 +431,127 @@ class Processor(waveproc.Processor):
 
         t0 = self.event.timeSC3
 
+        # P arrivals calculated exactly (shared by all streams of a station)
+        exact = dict()
+
+        def exactP(net, sta):
+            if (net, sta) not in exact:
+                s = self.filtered[net, sta]
+                try:
+                    ttlist = self.ttt.compute(self.event.lat,
+                                              self.event.lon,
+                                              self.event.dep,
+                                              s.latitude(),
+                                              s.longitude(),
+                                              s.elevation())
+                    exact[net, sta] = traveltime.firstP(ttlist)
+                except Exception, e:
+                    msg = "Exception from ttt.compute(): " + str(e)
+                    seiscomp3.Logging.error(msg)
+                    exact[net, sta] = None
+            return exact[net, sta]
+
+        # P arrival for all the stations at once if the precomputed grid is
+        # available and close enough to the exact travel times
+        if self.tttGrid is not None:
+            ptimes = self.__gridTimes(exactP)
+        else:
+            ptimes = None
+
         for key in self.filtered:
             try:
                 net, sta, loc, cha = key
             except:
                 continue
 
-            # distance calculation
-            s = self.filtered[net, sta]
-            # This could be moved to every magnitude module
-            try:
-                ttlist = self.ttt.compute(self.event.lat,
-                                          self.event.lon,
-                                          self.event.dep,
-                                          s.latitude(),
-                                          s.longitude(),
-                                          s.elevation())
-            except Exception, e:
-                msg = "Exception from ttt.compute(): " + str(e)
-                seiscomp3.Logging.error(msg)
-                continue
+            row = self.geometry.row[net, sta]
+            ptime = ptimes[row] if ptimes is not None else numpy.nan
 
-            # distance calculation
-            s = self.filtered[net, sta]
-            delta, az, baz = seiscomp3.Math.delazi(self.event.lat,
-                                                   self.event.lon,
-                                                   s.latitude(),
-                                                   s.longitude())
-            # Convert from deg to km
-            dist_km = delta * 111.195
-
-            # Check all the entries in the table
-            for tt in ttlist:
-                # until I find the P phase (or similar)
-                if tt.phase == 'P' or tt.phase == 'Pdiff':
-                    # Limits for the timewindow
-                    # P arrival minus a small buffer AND another number of
-                    # seconds to calculate the average value of the signal
-                    t_from = t0 + seiscomp3.Core.TimeSpan(tt.time -
-                                                          self.margin_begin -
-                                                          self.peepAvg)
-                    # S arrival
-                    t_to = t0 + seiscomp3.Core.TimeSpan(dist_km / vmax)
-                    break
-            else:
+            # The exact value is used if it is known
+            if numpy.isnan(ptime) or (net, sta) in exact:
+                ptime = exactP(net, sta)
+
+            if ptime is None:
                 # Something went wrong and I cannot find a P phase arrival
                 # time for the parameters given. Try with the next one.
                 continue
 
+            # Convert from deg to km
+            dist_km = self.geometry.distance(net, sta) * 111.195
+
+            # Limits for the timewindow
+            # P arrival minus a small buffer AND another number of
+            # seconds to calculate the average value of the signal
+            t_from = t0 + seiscomp3.Core.TimeSpan(float(ptime) -
+                                                  self.margin_begin -
+                                                  self.peepAvg)
+            # S arrival
+            t_to = t0 + seiscomp3.Core.TimeSpan(dist_km / vmax)
+
             # Collect all the necessary timewindows
             self.timeWinDict[net, sta, loc, cha] = (t_from, t_to)
 
         return
 
-    def _filterInventory(self, inventory):
+    def __gridTimes(self, exactP):
+        """P travel times of the stations interpolated from tttGrid (NaN
+        where it has no value), or None if the grid cannot be used for this
+        event.
+
+        The grid only includes the ellipticity correction of equatorial
+        paths and not the elevation of the stations, so it is compared with
+        the exact travel times (exactP) of traveltime.checkStations stations
+        spread over the distances of the event, and of the highest one. If
+        they differ by more than traveltime.tolerance seconds, all the
+        travel times are calculated exactly."""
+
+        geometry = self.geometry
+        ptimes = self.tttGrid.interpolate(geometry.delta, self.event.dep)
+
+        keys = [key for key in geometry.row
+                if not numpy.isnan(ptimes[geometry.row[key]])]
+        if not keys:
+            return ptimes
+        keys.sort(key=lambda key: (geometry.delta[geometry.row[key]], key))
+        pos = numpy.linspace(0, len(keys) - 1,
+                             min(len(keys), traveltime.checkStations))
+        checked = set(keys[i] for i in numpy.round(pos).astype(int))
+
+        def elevation(key):
+            # The SC3 stations raise an exception if it is not set
+            try:
+                return abs(self.filtered[key].elevation())
+            except:
+                return 0.0
+        checked.add(max(keys, key=elevation))
+
+        maxDiff = 0.0
+        for net, sta in sorted(checked):
+            ptime = exactP(net, sta)
+            if ptime is not None:
+                maxDiff = max(maxDiff,
+                              abs(ptime - ptimes[geometry.row[net, sta]]))
+
+        if maxDiff > traveltime.tolerance:
+            seiscomp3.Logging.warning(
+                "Processor %s: P travel times of the grid differ up to "
+                "%.2f s from the exact ones, not using the grid" %
+                (self.name, maxDiff))
+            return None
+
+        seiscomp3.Logging.debug("Processor %s: P travel times of the grid "
+                                "differ up to %.2f s from the exact ones" %
+                                (self.name, maxDiff))
+        return ptimes
+
+    def _filterInventory(self, inventory, index=None):
+        """Select the streams to use from the inventory.
+
+        inventory: dictionary with the inventory prepared by the application
+        index: waveproc.InventoryIndex of the inventory. It is created if it
+               is not given, but it should be kept and reused for all the
+               events."""
+
         # Definitions to filter the available inventory
         # by distance
         deltaMin = 5
@@ -194,124 +561,81 @@ class Processor(waveproc.Processor):
         # but sometimes HH, SH etc., so we try each of these
         channels = ["BH", "HH", "SH", "MH", "EH", "CH"]
 
-        failed = []
+        if index is None:
+            index = waveproc.InventoryIndex(inventory)
 
-        for key in inventory:
+        # Preferred streams for every location
+        streams = index.streams(channels)
 
-            try:
-                # only consider items at the location level
-                net, sta, loc = key
-            except:
-                continue
+        failed = []
 
-            # distance filter
-            s = inventory[net, sta]
-            delta, az, baz = seiscomp3.Math.delazi(self.event.lat,
-                                                   self.event.lon,
-                                                   s.latitude(),
-                                                   s.longitude())
-            if delta > deltaMax:
-                continue
+        # Only locations inside the distance range
+        for pos in index.within(self.event.lat, self.event.lon, deltaMin,
+                                deltaMax):
+            net, sta, loc = index.locations[pos]
 
-            if delta < deltaMin:
+            if not streams[pos]:
+                failed.append((net, sta, loc))
                 continue
 
-            for ch in channels:
-                if(((net, sta, loc, ch + "Z") not in inventory) and
-                   ((net, sta, loc, ch + "3") not in inventory)):
-                    continue
-
-                for c in "Z3":
-                    cha = ch + c
-                    if (net, sta, loc, cha) in inventory:
-                        self.filtered[net, sta, loc, cha] = inventory[
-                            net, sta, loc, cha]
-                self.filtered[net, sta, loc] = inventory[net, sta, loc]
-                self.filtered[net, sta] = inventory[net, sta]
-                self.filtered[net] = inventory[net]
-                break
-
-            if (net, sta, loc) not in self.filtered:
-                failed.append((net, sta, loc))
+            for key in streams[pos]:
+                self.filtered[key] = inventory[key]
+            self.filtered[net, sta, loc] = inventory[net, sta, loc]
+            self.filtered[net, sta] = inventory[net, sta]
+            self.filtered[net] = inventory[net]
 
         for net, sta, loc in failed:
             if (net, sta) not in self.filtered:
                 seiscomp3.Logging.warning("could not find suitable stream " +
                                           "for %s.%s.%s" % (net, sta, loc))
 
-        return
-
-    def __checkMax(self, value, Vlocal, Vmaxt, signV, signalID, pos, idx, sps,
-                   lowThresh=0.0):
-        """Check whether a value is a maximum taking into account the
-        previous history of the search.
-
-        value: is the value to check
-        Vlocal: tuple with (position, value)
-        Vmaxt: tuple with (position, value)
-        signV: sign of the current period
-        signalID: component of the vectors (Vlocal, Vmaxt, signV) related to
-                  this signal.
-        pos: position in the current record
-        idx: offset of the position of the components of the current record
-        sps: samples per second
-        lowThresh: minimum value to be considered a maximum
-
-        Returns:
-            None if there is no maximum
-            A tuple containing (position, value) of the maximum.
-                Ready to be added to self.results."""
+        # Distances and corrections of the selected stations
+        self._updateGeometry()
 
-        q = 0.6
-
-        returnValue = None
-
-        # Check if there is a change in sign (-1, 0, 1)
-        if mysign(value) != signV[signalID]:
-            # Save the maximum
-            if (Vlocal[signalID] is not None) and \
-               (abs(Vlocal[signalID]) > lowThresh):
-                # By definition, a sample is recognized as a new peak only
-                # if its value is greater than the maximum in absolute
-                # value multiplied by q (0.6 in Bormann and Saul, 2008)
-                # If this is a global maximum
+        return
 
-                # Case of a global maximum
-                if abs(Vmaxt[signalID]) < abs(Vlocal[signalID]):
-                    Vmaxt[signalID] = Vlocal[signalID]
-                    returnValue = Vlocal[signalID]
+    def __createFilter(self, state):
+        # The signal is already filtered if the preprocessing has a filter
+        # bank (see waveproc.Block.filtered)
+        if self.input.filterBank is not None:
+            state.filter = None
+            return
 
-                # Case of a local maximum
-                elif (abs(Vlocal[signalID]) >= q * abs(Vmaxt[signalID])):
-                    returnValue = Vlocal[signalID]
+        state.filter = seiscomp3.Math.InPlaceFilterD.Create(self.controlBand)
+        state.filter.setSamplingFrequency(state.sps)
 
-            # Reset values for the new segment
-            Vlocal[signalID] = None
+    def _reject(self, streamID, reason):
+        # The signal of the stream which is still not saved is discarded
+        if streamID in self.streams:
+            self.streams[streamID].dumps = None
+        waveproc.Processor._reject(self, streamID, reason)
 
-            # Update the sign for the new segment
-            signV[signalID] = mysign(value)
+    def resume(self, state, missing):
+        """The stream continues after a gap as a new segment."""
 
-        # In case this is the biggest local peak we save it
-        if Vlocal[signalID] is None:
-            Vlocal[signalID] = Peak((pos + idx) / sps, value)
+        if state.results is None:
+            return
 
-        elif abs(value) > abs(Vlocal[signalID]):
-            Vlocal[signalID] = Peak((pos + idx) / sps, value)
+        # The relative time of the samples keeps counting the gap
+        gapStart = state.idx / state.sps
+        state.idx += missing
+        state.gaps.append((gapStart, state.idx / state.sps))
 
-        return returnValue
+        # The filter and the segments of the peak detectors are not
+        # continued through the gap
+        self.__createFilter(state)
+        for detector in state.detectors:
+            detector.restart()
 
-    def feed(self, rec):
+    def process(self, state, rec):
         """Receives a record and update the status of the magnitude calculation
-        for the selected stream."""
+        for the selected stream. Basic checks were done by the parent
+        class."""
 
-        # Basic checks are done by the parent class
-        if not waveproc.Processor.feed(self, rec):
-            return False
-
-        streamID = rec.streamID()
+        streamID = state.streamID
 
         # If the magnitude was already calculated, get out
-        if streamID in self.stage and self.stage[streamID] > 2:
+        if state.stage > 2:
             return False
 
         #sys.stdout.write('.')
@@ -320,198 +644,225 @@ class Processor(waveproc.Processor):
 
         auxData = rec.data()
         if auxData is None:
-            print streamID
-            print 'Estamos en problemas'
+            seiscomp3.Logging.error("Processor %s: record of %s without data"
+                                    % (self.name, streamID))
             return False
 
         data = auxData.numpy()
         nsamp = len(data)
 
-        n, s, l, c = streamID.split('.')
-        gain = self.getGain(n, s, l, c)
+        n, s, l, c = state.key
 
-        if streamID not in self.rms:
-            # Delete an old file in case that this is the first record
-            try:
-                os.remove("%s-%s%s%s%s.dat" % (self.name, n, s, l, c))
-            except OSError:
-                pass
-
-            # Idem in the case of filtered data
-            try:
-                os.remove("%s-%s%s%s%s-f.dat" % (self.name, n, s, l, c))
-            except OSError:
-                pass
+        if state.results is None:
+            # Files for the raw and the filtered signal. Old files are
+            # overwritten in case that this is the first record.
+            if self.dumpWaveforms:
+                state.dumps = (
+                    wavedump.DumpFile(self.outputFile(
+                        "%s-%s%s%s%s.bin" % (self.name, n, s, l, c)),
+                        output=self._output, append=self._appendOutput),
+                    wavedump.DumpFile(self.outputFile(
+                        "%s-%s%s%s%s-f.bin" % (self.name, n, s, l, c)),
+                        output=self._output, append=self._appendOutput))
 
-            # Butterworth filter for the Control signal
-            # Filter around 2 Hz (1-3)
-            self.filters[streamID] = seiscomp3.Math.InPlaceFilterD.Create(
-                "BW(4, 1, 3)")
-            self.filters[streamID].setSamplingFrequency(self.sps[streamID])
+            self.__createFilter(state)
 
             # Store the RMS of the filtered signal
-            self.rms[streamID] = (0, 0)
+            state.rms = streamstats.RunningStats()
             # The real P arrival should be detected from (HF) filtered data
-            self.pReal[streamID] = None
+            state.pReal = None
 
             # We are looking for a maximum
-            self.stage[streamID] = 1
+            state.stage = 1
+
+            # Theoretical P arrival
+            state.pExpected = (self.timeWinDict[state.key][0] +
+                               seiscomp3.Core.TimeSpan(self.margin_begin +
+                                                       self.peepAvg -
+                                                       state.startTime)
+                               ).length()
 
             # List of maximum values
-            self.results[streamID] = []
-            self.results2[streamID] = []
-            self.Vmaxt[streamID] = [Peak(0, 0), Peak(0, 0)]
-            self.Vlocal[streamID] = [None, None]
-            self.signV[streamID] = [0, 0]
-            if streamID not in self.idx:
-                self.idx[streamID] = 0
-            self.posLastPeak[streamID] = 0
-
-        # Define a SC3 array to copy the data to
-        data2 = seiscomp3.Core.DoubleArrayT()
-        data2.resize(nsamp)
-        # data2.setNumpy(data)
+            state.results = PeakList()
+            state.results2 = PeakList()
+            # Peak detectors for the raw and the filtered signal
+            state.detectors = [PeakDetector(), PeakDetector()]
+            state.posLastPeak = 0
 
         # To make notation shorter
-        dur = self.duration
-        res = self.results[streamID]
-        res2 = self.results2[streamID]
-
-        # Auxiliary variable to be written in a file
-        auxValues = []
-
-        for pos, i in enumerate(data):
-            # The signal is scaled with the gain and centered around 0 by
-            # substracting the average of the first "peepAvg" seconds
-            avg = self.avgValue[streamID] if not isinstance(
-                self.avgValue[streamID], tuple) else 0
-            data[pos] = i / gain - avg
-
-            relTime = (pos + self.idx[streamID]) / self.sps[streamID]
-            # If we should write the output
-            if (relTime > self.peepAvg):
-                auxValues.append((relTime, data[pos]))
-
-            # Save it to a SC3 array
-            # The average is included to avoid a "jump" when we finish with the
-            # calculation of the average and the signal is "re-centered"
-            # In any case the filter will remove the average
-            data2.set(pos, numpy.double(data[pos] + avg))
-
-        # Save waveform to a file
-        self.__save2File("%s-%s%s%s%s.dat" % (self.name, n, s, l, c),
-                         auxValues, 'a')
+        res = state.results
+        res2 = state.results2
 
-        # and apply the filter (1-3 Hz)
-        self.filters[streamID].apply(data2)
-
-        pArrival = self.timeWinDict[n, s, l, c][0] + \
-            seiscomp3.Core.TimeSpan(self.margin_begin +
-                                    self.peepAvg)
+        # Relative time of every sample since the beginning of the stream
+        relTimes = (numpy.arange(nsamp) + state.idx) / state.sps
 
-        # Auxiliary variable to be written in a file
-        auxValues = []
+        # The signal was scaled with the gain and centered around 0 by the
+        # preprocessing (see waveproc.Preprocessor). It is read-only.
+        if state.filter is None:
+            # Filtered by the preprocessing
+            filtered = rec.filtered[self.controlBand]
+        else:
+            avg = state.avgValue if state.avgValue is not None else 0
 
-        # Search for local maximum values
-        for pos in xrange(nsamp):
-            relTime = (pos + self.idx[streamID]) / self.sps[streamID]
+            # Copy it to a SC3 array in one go
+            # The average is included to avoid a "jump" when we finish with
+            # the calculation of the average and the signal is "re-centered"
+            # In any case the filter will remove the average
+            data2 = seiscomp3.Core.DoubleArrayT()
+            data2.setNumpy(data + avg)
 
-            # I cannot process the first "peepAvg" seconds, because I used them
-            # to calculate the average
-            if relTime < self.peepAvg:
-                # WARNING! we are not considering the first 2 seconds of
-                # filtered data because could have high values that could
-                # artificially affect the RMS
-                cumul = (self.rms[streamID][0] + data2.get(pos) *
-                         data2.get(pos)) if relTime > 2.0 else 0.0
-                count = (self.rms[streamID][1] + 1) if relTime > 2.0 else 0
+            # and apply the filter (1-3 Hz)
+            state.filter.apply(data2)
 
-                self.rms[streamID] = (cumul, count)
-                continue
-            else:
-                if isinstance(self.rms[streamID], tuple):
-                    # Finish the calculation fo the RMS
-                    if self.rms[streamID][1]:
-                        self.rms[streamID] = sqrt(self.rms[streamID][0] /
-                                                  self.rms[streamID][1])
-                    else:
-                        self.rms[streamID] = 0.0
+            # Read the filtered signal back in one go
+            filtered = data2.numpy()
 
-            i = data[pos]
+        pArrival = self.timeWinDict[state.key][0] + \
+            seiscomp3.Core.TimeSpan(self.margin_begin +
+                                    self.peepAvg)
 
-            isMax = self.__checkMax(i, self.Vlocal[streamID],
-                                    self.Vmaxt[streamID],
-                                    self.signV[streamID], 0,
-                                    pos, self.idx[streamID],
-                                    self.sps[streamID])
+        # I cannot process the first "peepAvg" seconds, because I used them
+        # to calculate the average
+        start = numpy.count_nonzero(relTimes < self.peepAvg)
+
+        noise = state.rms
+        if start and isinstance(noise, streamstats.RunningStats):
+            # WARNING! we are not considering the first 2 seconds of
+            # filtered data because could have high values that could
+            # artificially affect the RMS
+            valid = relTimes[:start] > 2.0
+            if not valid.all():
+                noise.reset()
+            noise.add(filtered[:start][valid])
+
+        if start < nsamp and isinstance(noise, streamstats.RunningStats):
+            # Finish the calculation fo the RMS
+            state.rms = noise.rms()
+
+        # While the RMS is being calculated there is nothing to search yet
+        noise = state.rms
+        lowThresh = 0.0 if isinstance(noise, streamstats.RunningStats) \
+            else 3 * noise
+
+        detRaw, detFilt = state.detectors
+
+        # Only check for a peak in the filtered signal if the theoretical P
+        # arrival is already there
+        active = start + numpy.count_nonzero(
+            state.startTime + relTimes[start:] < pArrival.length())
+
+        # Keep the state in case that the end of the event is found in this
+        # record and the search must be repeated up to that point
+        savedFilt = copy.copy(detFilt)
+        pos2, peaks2 = detFilt.feed(filtered[active:], relTimes[active:],
+                                    lowThresh=lowThresh)
+        pos2 += active
+
+        # Go through the peaks found in the filtered signal and check whether
+        # there is a quiet period of 60 seconds between them
+        pReal = state.pReal
+        lastPeak = state.posLastPeak
+        # Position where the P arrival was detected if it was in this record
+        pRealPos = None
+        # Position where the end of the event was found
+        endPos = None
+        begin = start
+        for k, end in enumerate(pos2.tolist() + [nsamp]):
+            if pReal is not None:
+                quiet = numpy.flatnonzero(relTimes[begin:end] - lastPeak >=
+                                          60.0)
+                if len(quiet):
+                    endPos = begin + quiet[0]
+                    peaks2 = peaks2[:k]
+                    break
 
-            i2 = data2.get(pos)
-            # Only check for a peak in the filtered signal if the theoretical P
-            # arrival is already there
-            if self.startTime[streamID] + relTime < pArrival.length():
-                isMax2 = None
-            else:
-                isMax2 = self.__checkMax(i2, self.Vlocal[streamID],
-                                         self.Vmaxt[streamID],
-                                         self.signV[streamID], 1,
-                                         pos, self.idx[streamID],
-                                         self.sps[streamID],
-                                         lowThresh=3 * self.rms[streamID])
-
-            # If we find a maximum add it to results
-            if (isMax is not None) and (self.pReal[streamID] is not None):
-                res.append(isMax)
-
-            # If we find a maximum in the filtered signal, add it to results
-            if isMax2 is not None:
+            if k < len(peaks2):
                 # If the P arrival was still not detected, now it is done!
-                if self.pReal[streamID] is None:
-                    self.pReal[streamID] = isMax2[0]
-
-                res2.append(isMax2)
-                self.posLastPeak[streamID] = isMax2[0]
-                self.stage[streamID] = 1
-                dur[streamID] = isMax2.time - res2[0].time
-            else:
-                if self.pReal[streamID] is not None:
-                    self.stage[streamID] = max(2, self.stage[streamID])
-                    # Check whether the 60 seconds are already gone
-                    if (relTime - self.posLastPeak[streamID]) >= 60.0:
-
-                        if self.posLastPeak[streamID]:
-                            # Calculate the duration as the difference between
-                            # the last peak and the first peak detected in the
-                            # HF filtered signal.
-                            dur[streamID] = res2[-1].time - res2[0].time
-
-                        else:
-                            # No peak was detected
-                            print 'DEBUG!', streamID, relTime
-                            return False
-
-                        sys.stdout.flush()
-                        self.stage[streamID] = 3
-
-                        # Remove the peaks in the raw signal that go beyond the
-                        # "duration" of the event
-                        # res = [p for p in res if p[0] <= res2[-1][0]]
-
-                        return True
-
-            # Write filtered streams to file
-            auxValues.append((relTime, data2.get(pos)))
+                if pReal is None:
+                    pReal = peaks2[k].time
+                    pRealPos = end
+                lastPeak = peaks2[k].time
+                begin = end + 1
+
+        # Save waveform to a file, up to the end of the record where the end
+        # of the event was found. The filtered signal of that record is not
+        # saved.
+        if self.dumpWaveforms:
+            rawStop, filtStop = (nsamp, nsamp) if endPos is None else \
+                waveproc.recordLimits(rec, endPos)[::-1]
+            mask = relTimes[:rawStop] > self.peepAvg
+            state.dumps[0].append(relTimes[:rawStop][mask],
+                                  data[:rawStop][mask])
+
+        if endPos is not None:
+            if self.dumpWaveforms and filtStop > start:
+                state.dumps[1].append(relTimes[start:filtStop],
+                                      filtered[start:filtStop])
+
+            # The signal after the end of the event is not analyzed
+            detFilt = state.detectors[1] = savedFilt
+            detFilt.feed(filtered[active:endPos + 1],
+                         relTimes[active:endPos + 1],
+                         lowThresh=lowThresh)
+            stop = endPos + 1
+        else:
+            stop = nsamp
+
+        pos1, peaks1 = detRaw.feed(data[start:stop], relTimes[start:stop])
+        pos1 += start
+        state.vmaxTime = detRaw.Vmaxt.time
+
+        # Peaks in the raw signal are only considered after the P arrival
+        if state.pReal is not None:
+            res.extend(peaks1)
+        elif pRealPos is not None:
+            res.extend(p for p, pos in zip(peaks1, pos1) if pos > pRealPos)
+
+        # If we find a maximum in the filtered signal, add it to results
+        if len(peaks2):
+            res2.extend(peaks2)
+            times = res2.times
+            state.posLastPeak = float(times[-1])
+            state.duration = float(times[-1] - times[0])
+        state.pReal = pReal
+
+        if endPos is not None:
+            state.stage = max(2, state.stage)
+
+            if not state.posLastPeak:
+                # No peak was detected
+                seiscomp3.Logging.debug("Processor %s: no peak detected in "
+                                        "%s until %.2f s" %
+                                        (self.name, streamID,
+                                         relTimes[endPos]))
+                return False
+
+            sys.stdout.flush()
+            state.stage = 3
+
+            # Remove the peaks in the raw signal that go beyond the
+            # "duration" of the event
+            # res = [p for p in res if p[0] <= res2[-1][0]]
+
+            return True
+
+        if start < nsamp:
+            if len(pos2) and pos2[-1] == nsamp - 1:
+                state.stage = 1
+            elif pReal is not None:
+                state.stage = max(2, state.stage)
 
         # Write the filtered data to a file
-        self.__save2File("%s-%s%s%s%s-f.dat" % (self.name, n, s, l, c),
-                         auxValues, 'a')
+        if self.dumpWaveforms:
+            state.dumps[1].append(relTimes[start:], filtered[start:])
 
         # Update the index count
-        self.idx[streamID] = self.idx[streamID] + nsamp
+        state.idx = state.idx + nsamp
 
         return True
 
     def __save2File(self, filename, values, mode='w'):
-        with open(filename, mode) as fstr:
+        with open(self.outputFile(filename), mode) as fstr:
             if not isinstance(values, Iterable):
                 fstr.write('%s ' % values)
             else:
@@ -523,46 +874,60 @@ class Processor(waveproc.Processor):
                             fstr.write('%s ' % value)
                         fstr.write('\n')
 
-    def __removeFiles(self, filePatt):
-        r = glob.glob(filePatt)
-        for i in r:
-            try:
-                os.remove(i)
-            except:
-                pass
+    def removeResults(self):
+        """Remove all files with peaks and magnitudes (of a previous run)."""
 
-    def __saveResult(self):
-        # This method should be called to save the original signal, the
-        # filtered signal and the peaks recognized.
-        if not self.dumpWaveforms:
-            return
+        self._output(self._removeOutput, "%s-*-p.bin" % (self.name))
+        self._output(self._removeOutput, "%s-*-p2.bin" % (self.name))
+        self._output(self._removeOutput, "%s-*-m.dat" % (self.name))
 
-        # Remove all files with peaks and magnitudes
-        self.__removeFiles("%s-*-p.dat" % (self.name))
-        self.__removeFiles("%s-*-p2.dat" % (self.name))
-        self.__removeFiles("%s-*-m.dat" % (self.name))
+    def saveStreams(self):
+        """Save the end of the original and the filtered signal, the peaks
+        recognized and the magnitude of every stream."""
 
-        for streamID in self.results:
+        for state in self.states:
             # If there were gaps or other problems while receiving data
-            if streamID in self._wrongStreams:
+            if state.results is None or state.rejected:
                 continue
 
-            n, s, l, c = streamID.split('.')
+            n, s, l, c = state.key
+
+            # Write what is still pending of the raw and filtered signal
+            for dump in state.dumps or ():
+                dump.flush()
 
             # Save the peaks detected in the raw signal
-            self.__save2File("%s-%s%s%s%s-p.dat" % (self.name, n, s, l, c),
-                             self.results[streamID], 'w')
+            peaks = state.results
+            self._output(wavedump.save,
+                         self.outputFile("%s-%s%s%s%s-p.bin" %
+                                         (self.name, n, s, l, c)),
+                         peaks.times, peaks.values)
 
             # Save the peaks detected in the filtered signal
-            self.__save2File("%s-%s%s%s%s-p2.dat" % (self.name, n, s, l, c),
-                             self.results2[streamID], 'w')
+            peaks = state.results2
+            self._output(wavedump.save,
+                         self.outputFile("%s-%s%s%s%s-p2.bin" %
+                                         (self.name, n, s, l, c)),
+                         peaks.times, peaks.values)
 
             # Save the magnitude from this stream
-            self.__save2File("%s-%s%s%s%s-m.dat" % (self.name, n, s, l, c),
-                             self.magnitude[streamID], 'w')
+            self._output(self.__save2File,
+                         "%s-%s%s%s%s-m.dat" % (self.name, n, s, l, c),
+                         state.magnitude, 'w')
 
         return
 
+    def __magnitude(self, state, limit):
+        """Magnitude of a stream from the peaks before "limit"."""
+
+        amplitude = state.results.amplitudeBefore(limit)
+        magnitude = log10(amplitude / (2 * pi)) if (amplitude > 0.0) else 0.0
+
+        # The final magnitude includes also an extra term depending
+        # on the distance of the station and the depth of the event
+        n, s, l, c = state.key
+        return magnitude + self.geometry.distanceCorrection(n, s)
+
     def update(self):
         """Method to give partial results about magnitude calculation
         A bool value should be returned:
@@ -570,115 +935,59 @@ class Processor(waveproc.Processor):
             False: Magnitude is already processed
         """
 
-        # List with all magnitudes from streams
-        magnitudes = []
-
-        # To shorten notation
-        sMag = self.magnitude
-
-        modStage = 3
-
-        simTime = max(self._timeStream.values()) - self.event.timeSC3 if \
-            len(self._timeStream) else 0.0
-        mHara = []
-        for streamID in self.results:
-            n, s, l, c = streamID.split('.')
-            pArrival = self.timeWinDict[n, s, l, c][0] + \
-                seiscomp3.Core.TimeSpan(self.margin_begin +
-                                        self.peepAvg -
-                                        self.startTime[streamID])
-            #maxUnknDur = max((self._timeStream[streamID] - pArrival).length(),
-            #                 maxUnknDur)
-            if (self.Vmaxt[streamID][0].time > pArrival.length()):
-                mHara.append((self.Vmaxt[streamID][0].time -
-                              pArrival.length()))
-        mHara.sort()
-        mHaraValue = mHara[int(round((len(mHara) - 1) * 0.75))] if len(mHara)\
-            else 0
-
-        auxList = []
-        auxList2 = []
-        topStreams = set()
-        for streamID in self.duration:
-            # Discard streams with gaps or discontinuities
-            if streamID in self._wrongStreams:
-                continue
-
-            if ((self.duration[streamID] > 0.8 * self.meanDuration) or
-                    (self.stage[streamID] == 3)):
-                auxList2.append((self.duration[streamID], streamID,
-                                self.idx[streamID]))
-                auxList.append(self.duration[streamID])
-                topStreams.add(streamID)
+        return self.combine(self.summary(), self.streamMagnitudes)
+
+    def combine(self, summary, magnitudes):
+        """Partial results from the summary of the streams (see
+        waveproc.Processor.summary) and a function returning the magnitudes
+        of the streams for a duration (see streamMagnitudes). The streams
+        can be processed by several processors (see streampool)."""
+
+        simTime = summary['end'] - self.event.timeSC3.length() if \
+            summary['end'] is not None else 0.0
+
+        # Columns of the streams being processed
+        table = summary['table']
+        streamIDs = summary['streamID']
+        stage = table['stage']
+        processed = stage > 0
+        rejected = table['rejected']
+        duration = table['duration']
+
+        stats = self.durationStats
+        stats.update(summary)
+
+        # Time from the theoretical P arrival to the global maximum
+        mHara = stats.hara
+        mHaraValue = float(mHara[int(round((len(mHara) - 1) * 0.75))]) if \
+            len(mHara) else 0
+
+        # Streams with a duration, discarding the ones with gaps or
+        # discontinuities
+        limit = 0.8 * self.meanDuration
+        top = ~numpy.isnan(duration) & ~rejected
+        top[top] = (duration[top] > limit) | (stage[top] == 3)
+        topStreams = set(streamIDs[i] for i in numpy.flatnonzero(top))
+        nTop = stats.active.countAbove(limit) + len(stats.finished)
 
         # Calculate a common duration based on the value located in the 50 % of
         # the order values
-        auxList.sort()
-        auxList2.sort()
-        self.meanDuration = auxList[int(round((len(auxList) - 1) * 0.5))]\
-            if len(auxList) else mHaraValue
+        self.meanDuration = float(stats.active.select(
+            int(round((nTop - 1) * 0.5)), stats.finished, limit)) \
+            if nTop else mHaraValue
 
+        nProcessed = numpy.count_nonzero(processed)
         status = 'Status: Peaks %d, Peaks2 %d, Dur %d, Hara %3.1f (%d)' %\
-            (len(self.results), len(self.results2), len(auxList),
-             mHaraValue, len(mHara))
-        #print [(n[2] / self.sps[streamID], n[1], '%.1f' % round(n[0], 1))
-        #       for n in auxList2]
-
-        for streamID in self.results:
-            # If there were gaps or other problems while receiving data
-            if streamID in self._wrongStreams:
-                continue
-
-            n, s, l, c = streamID.split('.')
-
-            if streamID in self.pReal and self.pReal[streamID] is not None:
-                pArrival = self.pReal[streamID]
-            else:
-                pArrival = self.timeWinDict[n, s, l, c][0] + \
-                    seiscomp3.Core.TimeSpan(self.margin_begin +
-                                            self.peepAvg -
-                                            self.startTime[streamID])
-                pArrival = pArrival.length()
-
-            # Temporary end of event (duration) from the recognized peaks in
-            # the (HF) filtered signal and the mean duration from all the
-            # streams.
-            limit = pArrival + self.meanDuration
-
-            # Check whether the end of the event was found
-            if self.stage[streamID] == 1:
-                msg = '%s: End of event not found!' % streamID
-                seiscomp3.Logging.warning(msg)
-
-            # Check whether the magnitude should be still calculated for some
-            # streamID
-            modStage = min(modStage, self.stage[streamID])
-
-            sMag[streamID] = 0.0
-
-            for p in self.results[streamID]:
-                sMag[streamID] += (abs(p.value) / 2.0 if limit is not None and
-                                   p.before(limit) else 0)
-
-            sMag[streamID] = log10(sMag[streamID] / (2 * pi)) \
-                if (sMag[streamID] > 0.0) else 0.0
+            (nProcessed, nProcessed, nTop, mHaraValue, len(mHara))
 
-            # Distance calculation
-            sta = self.filtered[n, s]
-            delta, az, baz = seiscomp3.Math.delazi(self.event.lat,
-                                                   self.event.lon,
-                                                   sta.latitude(),
-                                                   sta.longitude())
+        # Check whether the magnitude should be still calculated for some
+        # stream
+        active = processed & ~rejected
+        modStage = min(3, stage[active].min()) if active.any() else 3
 
-            # The final magnitude includes also an extra term depending
-            # on the distance of the station and the depth of the event
-            sMag[streamID] += Q_PV(delta, self.event.dep)
-
-            # Save also in a list of magnitudes to be worked further
-            if streamID in topStreams:
-                magnitudes.append((sMag[streamID], self.duration[streamID] if
-                                   streamID in self.duration else 0.0,
-                                   streamID))
+        # Save also in a list of magnitudes to be worked further
+        magnitudes = [m for m in magnitudes(self.meanDuration)
+                      if m[2] in topStreams]
 
         # Discard 25 % of the values
         magnitudes.sort()
@@ -694,88 +1003,84 @@ class Processor(waveproc.Processor):
                                                       len(magnitudes),
                                                       status)
 
-        self.__save2File("%s.txt" % self.name, magnitudes, 'w')
+        self._replaceOutput("%s.txt" % self.name, self.__save2File,
+                            "%s.txt" % self.name, magnitudes, 'w')
 
         if modStage == 3:
             return False
 
         return True
 
-    def finalize(self):
-        # FIXME Some of these tasks could be moved to feed. For instance,
-        # the magnitude, which should be stored in an attribute of the
-        # class.
-
-        # List with all magnitudes from streams
-        magnitudes = []
-
-        # To shorten notation
-        sMag = self.magnitude
-
-        auxList = []
-        for streamID in self.duration:
-            if self.duration[streamID]:
-                auxList.append(self.duration[streamID])
+    def streamMagnitudes(self, meanDuration, final=False):
+        """Magnitude of every stream being processed (except the ones in
+        quarantine) if the event lasts "meanDuration" seconds after the P
+        arrival. With final, the peaks after the end of the event are
+        removed.
 
-        # Calculate a common duration based on the value located in the 50 % of
-        # the order values
-        auxList.sort()
-        if len(auxList) > 5:
-            self.meanDuration = auxList[int((len(auxList) - 1) * 0.5)]
-        else:
-            self.meanDuration = sum(auxList) / len(auxList) if len(auxList) \
-                else 1.0
+        Returns a list of (magnitude, duration, stream ID)."""
 
-        for streamID in self.results:
+        magnitudes = []
+        for state in self.states:
             # If there were gaps or other problems while receiving data
-            if streamID in self._wrongStreams:
+            if state.results is None or state.rejected:
                 continue
 
-            n, s, l, c = streamID.split('.')
-
-            if streamID in self.pReal and self.pReal[streamID] is not None:
-                pArrival = self.pReal[streamID]
-            else:
-                pArrival = self.timeWinDict[n, s, l, c][0] + \
-                    seiscomp3.Core.TimeSpan(self.margin_begin +
-                                            self.peepAvg -
-                                            self.startTime[streamID])
-                pArrival = pArrival.length()
+            pArrival = state.pReal if state.pReal is not None else \
+                state.pExpected
 
-            limit = pArrival + self.meanDuration
+            # Temporary end of event (duration) from the recognized peaks in
+            # the (HF) filtered signal and the mean duration from all the
+            # streams.
+            limit = pArrival + meanDuration
 
             # Remove the peaks outside the "duration" of the event
-            self.results[streamID] = [p for p in self.results[streamID]
-                                      if p.before(limit)]
+            if final:
+                state.results = state.results.before(limit)
 
             # Check whether the end of the event was found
-            if self.stage[streamID] == 1:
-                msg = '%s: End of event not found!' % streamID
+            if state.stage == 1:
+                msg = '%s: End of event not found!' % state.streamID
                 seiscomp3.Logging.warning(msg)
 
-            sMag[streamID] = 0.0
+            state.magnitude = self.__magnitude(state, limit)
 
-            for p in self.results[streamID]:
-                sMag[streamID] += (abs(p.value) / 2.0 if limit is not None and
-                                   p.before(limit) else 0)
+            magnitudes.append((state.magnitude,
+                               0.0 if numpy.isnan(state.duration) else
+                               state.duration, state.streamID))
 
-            sMag[streamID] = log10(sMag[streamID] / (2 * pi)) if \
-                (sMag[streamID] > 0.0) else 0.0
+        return magnitudes
 
-            # Distance calculation
-            sta = self.filtered[n, s]
-            delta, az, baz = seiscomp3.Math.delazi(self.event.lat,
-                                                   self.event.lon,
-                                                   sta.latitude(),
-                                                   sta.longitude())
+    def finalize(self):
+        # FIXME Some of these tasks could be moved to feed. For instance,
+        # the magnitude, which should be stored in an attribute of the
+        # class.
+
+        # The records still waiting to be processed are processed now
+        waveproc.Processor.finalize(self)
+
+        self.combineFinal(self.summary(), self.streamMagnitudes)
 
-            # The final magnitude includes also an extra term depending
-            # on the distance of the station and the depth of the event
-            sMag[streamID] += Q_PV(delta, self.event.dep)
+        # Delete results from previous run to be able to save new results
+        if self.dumpWaveforms:
+            self.removeResults()
+            self.saveStreams()
+
+    def combineFinal(self, summary, magnitudes):
+        """Final results (see combine)."""
 
-            # Save also in a list of magnitudes to be worked further
-            magnitudes.append((sMag[streamID], self.duration[streamID] if
-                               streamID in self.duration else 0.0, streamID))
+        durations = self.durationStats.durations
+        self.durationStats.update(summary)
+
+        # Calculate a common duration based on the value located in the 50 % of
+        # the order values
+        if len(durations) > 5:
+            self.meanDuration = durations[int((len(durations) - 1) * 0.5)]
+        else:
+            self.meanDuration = sum(durations.values()) / len(durations) \
+                if len(durations) else 1.0
+
+        # List with all magnitudes from streams
+        magnitudes = magnitudes(self.meanDuration, True)
 
         # Discard 25 % of the values
         magnitudes.sort()
@@ -791,10 +1096,5 @@ class Processor(waveproc.Processor):
         print '%s(final) Mag(avg): %3.2f Dur(3/4): %3.2f (%d streams)' % \
             (self.name, finalMag, self.meanDuration, len(magnitudes))
 
-        self.__save2File("%s.txt" % self.name, magnitudes, 'w')
-
-        # Delete results from previous run to be able to save new results
-        if self.dumpWaveforms:
-            self.__saveResult()
-
-        return
+        self._replaceOutput("%s.txt" % self.name, self.__save2File,
+                            "%s.txt" % self.name, magnitudes, 'w')
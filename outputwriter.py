@@ -0,0 +1,186 @@
+"""Writing of the output files in a background thread.
+
+The processors pass the functions that write to disk to an OutputWriter
+instead of calling them, so that a slow file system does not delay the
+processing of the waveforms. Three kinds of tasks are accepted:
+
+* submit(): tasks executed in the order they were submitted (e.g. the
+  creation or removal of files). They are kept in a bounded queue. If it is
+  full, the caller waits until there is space, unless overflow is "drop":
+  then they are queued anyway, as they are never discarded.
+
+* append(): tasks which only add data to a file (e.g. blocks of the
+  waveform dumps), in the same queue and order as the ones of submit(). If
+  the queue is full and overflow is "drop", they are discarded.
+
+* replace(): tasks that rewrite a complete file (e.g. the partial results
+  saved on every update). Only the last task with the same key is kept while
+  it is pending, so they never wait or fill the queue. They are executed
+  after every "replaceEvery" tasks of the queue, or when the oldest one has
+  been pending for "replaceDelay" seconds, so that they are not delayed
+  indefinitely while the queue is never empty.
+"""
+
+import sys
+import time
+import threading
+import traceback
+import collections
+import seiscomp3.Logging
+
+
+class OutputWriter:
+
+    def __init__(self, maxPending=1000, overflow='block', replaceEvery=100,
+                 replaceDelay=1.0):
+        """maxPending: maximum number of tasks in the queue
+        overflow: what to do when the queue is full ("block" or "drop")
+        replaceEvery, replaceDelay: maximum number of tasks of the queue
+                                    executed, and seconds, before a pending
+                                    task of replace()"""
+
+        if overflow not in ('block', 'drop'):
+            raise ValueError("Unknown overflow policy '%s'" % overflow)
+
+        self.maxPending = maxPending
+        self.overflow = overflow
+        self.replaceEvery = replaceEvery
+        self.replaceDelay = replaceDelay
+
+        self._tasks = collections.deque()
+        self._latest = collections.OrderedDict()
+        # Tasks of the queue executed since the last task of replace(), and
+        # time since the oldest one is pending
+        self._sinceReplace = 0
+        self._replaceTime = None
+        self._cond = threading.Condition()
+        self._busy = False
+        self._closing = False
+
+        # Counters
+        self.submitted = 0
+        self.written = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.errors = 0
+        self.maxQueued = 0
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='OutputWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, function, *args):
+        """Execute function(*args) in the writer thread after the tasks
+        already submitted. The task is never discarded."""
+
+        return self._queue(function, args, False)
+
+    def append(self, function, *args):
+        """Like submit(), for a task which only adds data to a file. Returns
+        False if the task was discarded."""
+
+        return self._queue(function, args, True)
+
+    def _queue(self, function, args, droppable):
+        with self._cond:
+            if len(self._tasks) >= self.maxPending:
+                if self.overflow == 'drop':
+                    if droppable:
+                        self.dropped += 1
+                        return False
+                else:
+                    self.blocked += 1
+                    while len(self._tasks) >= self.maxPending:
+                        self._cond.wait()
+
+            self._tasks.append((function, args))
+            self.submitted += 1
+            self.maxQueued = max(self.maxQueued, len(self._tasks))
+            self._cond.notify_all()
+        return True
+
+    def replace(self, key, function, *args):
+        """Execute function(*args) in the writer thread, replacing a task
+        with the same key which is still pending."""
+
+        with self._cond:
+            if key in self._latest:
+                self.coalesced += 1
+            elif not self._latest:
+                self._replaceTime = time.time()
+            self._latest[key] = (function, args)
+            self.submitted += 1
+            self._cond.notify_all()
+
+    def _next(self):
+        with self._cond:
+            while not self._tasks and not self._latest:
+                if self._closing:
+                    return None
+                self._cond.wait()
+
+            self._busy = True
+            if self._latest and (not self._tasks or
+                                 self._sinceReplace >= self.replaceEvery or
+                                 time.time() - self._replaceTime >=
+                                 self.replaceDelay):
+                task = self._latest.popitem(last=False)[1]
+                self._sinceReplace = 0
+                self._replaceTime = time.time() if self._latest else None
+            else:
+                task = self._tasks.popleft()
+                self._sinceReplace += 1
+            # There is space in the queue again
+            self._cond.notify_all()
+            return task
+
+    def _run(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+
+            function, args = task
+            try:
+                function(*args)
+                written = 1
+            except:
+                written = 0
+                info = traceback.format_exception(*sys.exc_info())
+                for i in info:
+                    sys.stderr.write(i)
+
+            with self._cond:
+                self._busy = False
+                if written:
+                    self.written += 1
+                else:
+                    self.errors += 1
+                self._cond.notify_all()
+
+    def pending(self):
+        with self._cond:
+            return len(self._tasks) + len(self._latest) + int(self._busy)
+
+    def flush(self):
+        """Wait until all the pending tasks are executed."""
+
+        with self._cond:
+            while self._tasks or self._latest or self._busy:
+                self._cond.wait()
+
+    def close(self):
+        """Execute the pending tasks and stop the thread."""
+
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+
+        seiscomp3.Logging.info(
+            "Output: %d tasks submitted, %d written, %d coalesced, "
+            "%d dropped, %d blocked, %d errors, max. queue %d" %
+            (self.submitted, self.written, self.coalesced, self.dropped,
+             self.blocked, self.errors, self.maxQueued))
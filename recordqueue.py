@@ -0,0 +1,208 @@
+"""Hand-off of the records from the acquisition to the processing.
+
+The records received are put in a bounded RecordQueue and processed by the
+magnitude modules in a separate thread, so that the acquisition is not
+stopped while the processing falls behind (e.g. during a spike of CPU
+usage). If the queue is full, the acquisition waits until there is space
+or, if overflow is "drop", the record is discarded (the processors handle
+the gap as any other).
+
+The queue keeps track of its depth and of the lag of the processing: the
+age of the records once they are processed (wall clock minus their end
+time) and the time they waited in the queue. They are logged periodically
+by report() and when the queue is closed.
+"""
+
+import sys
+import time
+import threading
+import traceback
+import collections
+import seiscomp3.Core
+import seiscomp3.Logging
+
+# Minimum seconds between two reports of the state of the queue
+reportInterval = 60.0
+
+
+class RecordQueue:
+
+    def __init__(self, handler, maxRecords=10000, overflow='block',
+                 lock=None, name='RecordQueue'):
+        """handler: function called with every record in the processing
+                 thread
+        maxRecords: maximum number of records in the queue
+        overflow: what to do when the queue is full ("block" or "drop")
+        lock: lock held while a record is processed, so that other threads
+              can use the processors between records (a new one by
+              default)"""
+
+        if overflow not in ('block', 'drop'):
+            raise ValueError("Unknown overflow policy '%s'" % overflow)
+
+        self.handler = handler
+        self.maxRecords = maxRecords
+        self.overflow = overflow
+        self.name = name
+        self.lock = lock if lock is not None else threading.Lock()
+
+        # Records with the wall clock time they were queued
+        self._records = collections.deque()
+        self._cond = threading.Condition()
+        self._busy = False
+        self._closing = False
+
+        # Counters
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.errors = 0
+        self.maxDepth = 0
+        # Age (seconds) of the last record processed and maximum age
+        self.age = None
+        self.maxAge = None
+        # Seconds waited in the queue by the last record and maximum
+        self.wait = 0.0
+        self.maxWait = 0.0
+
+        # Counters at the time of the last report
+        self._reported = (0, 0)
+        self._lastReport = time.time()
+
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, rec):
+        """Queue a record to be processed. Returns False if it was
+        discarded."""
+
+        with self._cond:
+            if not self._closing and len(self._records) >= self.maxRecords:
+                if self.overflow == 'drop':
+                    self.dropped += 1
+                    return False
+                self.blocked += 1
+                while len(self._records) >= self.maxRecords and \
+                        not self._closing:
+                    self._cond.wait()
+
+            if self._closing:
+                self.dropped += 1
+                return False
+
+            self._records.append((time.time(), rec))
+            self.received += 1
+            self.maxDepth = max(self.maxDepth, len(self._records))
+            self._cond.notify_all()
+        return True
+
+    def _next(self):
+        with self._cond:
+            while not self._records:
+                if self._closing:
+                    return None
+                self._cond.wait()
+
+            self._busy = True
+            task = self._records.popleft()
+            # There is space in the queue again
+            self._cond.notify_all()
+            return task
+
+    def _run(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+
+            queued, rec = task
+            try:
+                with self.lock:
+                    self.handler(rec)
+                failed = 0
+            except:
+                failed = 1
+                info = traceback.format_exception(*sys.exc_info())
+                for i in info:
+                    sys.stderr.write(i)
+
+            try:
+                age = (seiscomp3.Core.Time.GMT() - rec.endTime()).length()
+            except:
+                age = None
+
+            with self._cond:
+                self._busy = False
+                self.processed += 1
+                self.errors += failed
+                self.wait = time.time() - queued
+                self.maxWait = max(self.maxWait, self.wait)
+                if age is not None:
+                    self.age = age
+                    self.maxAge = age if self.maxAge is None else \
+                        max(self.maxAge, age)
+                self._cond.notify_all()
+
+    def depth(self):
+        """Records waiting or being processed."""
+
+        with self._cond:
+            return len(self._records) + int(self._busy)
+
+    def flush(self):
+        """Wait until all the records queued are processed."""
+
+        with self._cond:
+            while self._records or self._busy:
+                self._cond.wait()
+
+    def status(self):
+        with self._cond:
+            return "%s: depth %d (max. %d), lag %s (max. %s), waited " \
+                "%.1f s (max. %.1f s), %d received, %d processed, " \
+                "%d dropped, %d blocked, %d errors" % \
+                (self.name, len(self._records) + int(self._busy),
+                 self.maxDepth, _seconds(self.age), _seconds(self.maxAge),
+                 self.wait, self.maxWait, self.received, self.processed,
+                 self.dropped, self.blocked, self.errors)
+
+    def report(self, interval=None):
+        """Log the status of the queue if more than "interval" seconds
+        (reportInterval by default) passed since the last report. A warning
+        is logged if records were discarded or the acquisition had to wait
+        since then."""
+
+        if interval is None:
+            interval = reportInterval
+        now = time.time()
+        if now - self._lastReport < interval:
+            return
+        self._lastReport = now
+
+        with self._cond:
+            overflows = (self.dropped, self.blocked)
+        if overflows != self._reported:
+            seiscomp3.Logging.warning(
+                "%s: queue full, %d records dropped and acquisition blocked "
+                "%d times since the last report" %
+                (self.name, overflows[0] - self._reported[0],
+                 overflows[1] - self._reported[1]))
+            self._reported = overflows
+        seiscomp3.Logging.info(self.status())
+
+    def close(self):
+        """Process the records queued and stop the thread. Records put
+        afterwards are discarded."""
+
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+
+        seiscomp3.Logging.info(self.status())
+
+
+def _seconds(value):
+    return '-' if value is None else '%.1f s' % value
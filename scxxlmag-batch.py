@@ -0,0 +1,237 @@
+#! /usr/bin/env python
+
+"""Reprocess a list of events in parallel.
+
+The waveforms of every event are read from "<evt>.mseed" in a directory and
+scxxlmag-compute.py is run for each of them. Several events are processed at
+the same time (one process per event). Every event is processed in its own
+directory, where its output ("<evt>.evid"), its log ("<evt>.log") and the
+files saved by the magnitude modules are kept. At the end a table with the
+final magnitude, rupture duration and runtime of every event is written.
+
+Arguments after "--" are passed to scxxlmag-compute.py. The values of its
+options naming a file (pathOptions) are made absolute, whether the file
+exists or not (e.g. a snapshot created by the first run), as the events are
+processed in a different working directory. If the grid of travel times
+given with --ttt-grid does not exist, it is created once before processing
+the events. For instance::
+
+    ./scxxlmag-batch.py -w ~/temp/events -o results -l events.txt -- \\
+        --inventory-db inventory.xml --blacklist blacklist.txt \\
+        --inventory-snapshot inventory.npz
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import subprocess
+import multiprocessing
+import multiprocessing.pool
+
+compute = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'scxxlmag-compute.py')
+traveltime = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'traveltime.py')
+
+# Options of scxxlmag-compute.py whose value is a file
+pathOptions = ('--ttt-grid', '--inventory-snapshot', '--inventory-db',
+               '--config-db', '--input', '-i', '--blacklist', '-b')
+
+# Final result printed by the mBc module
+finalLine = re.compile(r'mBc\(final\) Mag\(avg\): *(\S+) Dur\(3/4\): *(\S+) '
+                       r'\((\d+) streams\)')
+
+
+def readEventList(filename):
+    """Event IDs in the first column of a file. Empty lines and comments
+    (#) are skipped."""
+
+    events = []
+    with open(filename) as fin:
+        for line in fin:
+            line = line.split('#', 1)[0].split()
+            if line:
+                events.append(line[0])
+    return events
+
+
+def parseResult(filename):
+    """Magnitude, duration and number of streams of the last final result
+    in the output of scxxlmag-compute.py. None if there is no result."""
+
+    result = None
+    with open(filename) as fin:
+        for line in fin:
+            m = finalLine.search(line)
+            if m:
+                result = (float(m.group(1)), float(m.group(2)),
+                          int(m.group(3)))
+    return result
+
+
+def absolutePaths(args):
+    """Arguments of scxxlmag-compute.py with the values of pathOptions made
+    absolute. They can be given as "--option value" or "--option=value"."""
+
+    result = []
+    isPath = False
+    for arg in args:
+        if isPath:
+            arg = os.path.abspath(arg)
+            isPath = False
+        elif arg in pathOptions:
+            isPath = True
+        elif '=' in arg and arg.split('=', 1)[0] in pathOptions:
+            option, value = arg.split('=', 1)
+            arg = '%s=%s' % (option, os.path.abspath(value))
+        result.append(arg)
+    return result
+
+
+def optionValue(args, option):
+    """Value of an option in the arguments of scxxlmag-compute.py (None if
+    it is not given)."""
+
+    value = None
+    for pos, arg in enumerate(args):
+        if arg == option and pos + 1 < len(args):
+            value = args[pos + 1]
+        elif arg.startswith(option + '='):
+            value = arg.split('=', 1)[1]
+    return value
+
+
+def processEvent(task):
+    """Run scxxlmag-compute.py for one event.
+
+    Returns the event ID, the status, the result (see parseResult) and the
+    runtime in seconds."""
+
+    evt, waveforms, outputDir, extraArgs = task
+
+    mseed = os.path.join(waveforms, '%s.mseed' % evt)
+    if not os.path.isfile(mseed):
+        return evt, 'no data', None, 0.0
+
+    eventDir = os.path.join(outputDir, evt)
+    if not os.path.isdir(eventDir):
+        os.makedirs(eventDir)
+
+    cmd = [sys.executable, compute, '-I', 'file://%s' % mseed, '-E', evt] + \
+        extraArgs
+
+    start = time.time()
+    with open(os.path.join(eventDir, '%s.evid' % evt), 'w') as fout:
+        with open(os.path.join(eventDir, '%s.log' % evt), 'w') as flog:
+            code = subprocess.call(cmd, cwd=eventDir, stdout=fout,
+                                   stderr=flog)
+    runtime = time.time() - start
+
+    result = parseResult(os.path.join(eventDir, '%s.evid' % evt))
+    if code:
+        status = 'error %d' % code
+    elif result is None:
+        status = 'no result'
+    else:
+        status = 'ok'
+
+    return evt, status, result, runtime
+
+
+def writeSummary(filename, summary):
+    with open(filename, 'w') as fout:
+        fout.write('# %-18s %6s %8s %7s %9s  %s\n' %
+                   ('event', 'mBc', 'duration', 'streams', 'runtime',
+                    'status'))
+        for evt, status, result, runtime in summary:
+            if result is None:
+                fout.write('%-20s %6s %8s %7s %9.1f  %s\n' %
+                           (evt, '-', '-', '-', runtime, status))
+            else:
+                fout.write('%-20s %6.2f %8.2f %7d %9.1f  %s\n' %
+                           ((evt,) + result + (runtime, status)))
+
+
+def main():
+    args = sys.argv[1:]
+    extraArgs = []
+    if '--' in args:
+        pos = args.index('--')
+        args, extraArgs = args[:pos], args[pos + 1:]
+
+    parser = argparse.ArgumentParser(
+        description='Reprocess a list of events in parallel with '
+        'scxxlmag-compute.py. Arguments after "--" are passed to it.')
+    parser.add_argument('events', nargs='*', help='IDs of the events')
+    parser.add_argument('-l', '--event-list',
+                        help='file with the IDs of the events (first column)')
+    parser.add_argument('-w', '--waveforms', default='.',
+                        help='directory with the waveforms of every event '
+                        '(<evt>.mseed)')
+    parser.add_argument('-o', '--output', default='.',
+                        help='directory where a subdirectory per event is '
+                        'created')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of events processed at the same time '
+                        '(default: number of CPUs)')
+    parser.add_argument('-s', '--summary', default='summary.txt',
+                        help='file with the results of all the events, '
+                        'relative to the output directory')
+    options = parser.parse_args(args)
+
+    events = list(options.events)
+    if options.event_list:
+        events.extend(readEventList(options.event_list))
+    # Without repetitions, as the directory of an event is used only once
+    events = [evt for pos, evt in enumerate(events)
+              if evt not in events[:pos]]
+    if not events:
+        parser.error('no events to process')
+
+    # Events are processed in their own directory
+    extraArgs = absolutePaths(extraArgs)
+
+    # The grid of travel times is created once instead of by every event
+    grid = optionValue(extraArgs, '--ttt-grid')
+    if grid is not None and not os.path.exists(grid):
+        print 'Creating the P travel time grid %s' % grid
+        sys.stdout.flush()
+        if subprocess.call([sys.executable, traveltime, grid]):
+            sys.stderr.write('Could not create %s\n' % grid)
+            return 1
+    waveforms = os.path.abspath(options.waveforms)
+    outputDir = os.path.abspath(options.output)
+    if not os.path.isdir(outputDir):
+        os.makedirs(outputDir)
+
+    tasks = [(evt, waveforms, outputDir, extraArgs) for evt in events]
+
+    # Every event runs in its own process, so threads are enough to keep
+    # "jobs" of them running
+    pool = multiprocessing.pool.ThreadPool(max(1, options.jobs))
+    summary = []
+    try:
+        for item in pool.imap_unordered(processEvent, tasks):
+            evt, status, result, runtime = item
+            print '%-20s %-10s %s (%.1f s)' % (
+                evt, status, '' if result is None else
+                'mBc %.2f duration %.2f' % result[:2], runtime)
+            sys.stdout.flush()
+            summary.append(item)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Same order as the list of events
+    order = dict((evt, pos) for pos, evt in enumerate(events))
+    summary.sort(key=lambda item: order[item[0]])
+    writeSummary(os.path.join(outputDir, options.summary), summary)
+
+    return 0 if all(item[1] == 'ok' for item in summary) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+#! /usr/bin/env python
+
+"""Measure the speed-up of processing the streams of an event in several
+processes (--workers of scxxlmag-compute.py).
+
+A synthetic event is recorded by a number of stations (2000 by default)
+between 10 and 95 degrees. Every stream has white noise and a P wave train
+of random duration and amplitude. The same records are fed, ordered by time
+as they would be received, to the mBc processor alone and to pools of
+worker processes, updating the results every --update seconds of data. The
+time from the first record to the final result is printed for every number
+of workers, and the final results (mBc.txt) of all the runs are compared.
+
+The speed-up of every run is relative to a run with a single process, which
+is always measured first. It can only be as large as the number of cores,
+which is printed as well. The CPU seconds used by the main process are also
+printed: with workers, they are the part of the processing which is not
+distributed (sending the records and combining the results), so the speed-up
+cannot be larger than the seconds of the single process divided by them.
+
+The travel times are calculated with the tables of SeisComP3, so it must be
+run in a SeisComP3 environment, e.g.::
+
+    seiscomp exec ./scxxlmag-bench.py --workers 1,2,4,8
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import numpy
+import seiscomp3.Core
+import waveproc
+import streampool
+import filterbank
+import mBc
+
+
+class _Value:
+    def __init__(self, value):
+        self._value = value
+
+    def value(self):
+        return self._value
+
+
+class _Origin:
+    def __init__(self, time, lat, lon, dep):
+        self._time = time
+        self._lat = lat
+        self._lon = lon
+        self._dep = dep
+
+    def time(self):
+        return _Value(self._time)
+
+    def latitude(self):
+        return _Value(self._lat)
+
+    def longitude(self):
+        return _Value(self._lon)
+
+    def depth(self):
+        return _Value(self._dep)
+
+
+class _Station:
+    def __init__(self, lat, lon):
+        self._lat = lat
+        self._lon = lon
+
+    def latitude(self):
+        return self._lat
+
+    def longitude(self):
+        return self._lon
+
+    def elevation(self):
+        return 0.0
+
+
+class _Stream:
+    def gain(self):
+        # One count per nanometer
+        return 1E9
+
+
+def syntheticInventory(channels, rng):
+    """Inventory (as prepared by scxxlmag-compute.py) with "channels"
+    stations at random distances and azimuths from (0, 0)."""
+
+    delta = numpy.radians(rng.uniform(10.0, 95.0, channels))
+    azimuth = numpy.radians(rng.uniform(0.0, 360.0, channels))
+    lat = numpy.arcsin(numpy.sin(delta) * numpy.cos(azimuth))
+    lon = numpy.arctan2(numpy.sin(azimuth) * numpy.sin(delta),
+                        numpy.cos(delta))
+
+    inventory = {'SY': None}
+    for i in range(channels):
+        sta = 'S%04d' % i
+        inventory['SY', sta] = _Station(float(numpy.degrees(lat[i])),
+                                        float(numpy.degrees(lon[i])))
+        inventory['SY', sta, ''] = None
+        inventory['SY', sta, '', 'BHZ'] = _Stream()
+    return inventory
+
+
+def createProcessor(origin, inventory, index, outputDir, args):
+    processor = mBc.Processor()
+    processor.outputDir = outputDir
+    processor.input.batchSize = args.batch_samples
+    if args.filter_bank:
+        processor.input.filterBank = filterbank.FilterBank()
+    processor.setEvent(origin)
+    processor._filterInventory(inventory, index)
+    processor.timeWindows()
+    return processor
+
+
+def syntheticRecords(processor, args, rng):
+    """List of the records of all the streams (time, streamID, start,
+    values), ordered by time."""
+
+    # Seconds from the start of the window to the P arrival
+    pOffset = processor.margin_begin + processor.peepAvg
+    reference = processor.event.timeSC3
+
+    records = []
+    for key in sorted(processor.timeWinDict):
+        t_from, t_to = processor.timeWinDict[key]
+        n = int(min((t_to - t_from).length(), args.length) * args.sps)
+        signal = rng.normal(0.0, 5.0, n) + rng.uniform(-500.0, 500.0)
+
+        p = int(pOffset * args.sps)
+        duration = int(rng.uniform(20.0, 120.0) * args.sps)
+        t = numpy.arange(duration) / args.sps
+        train = rng.uniform(500.0, 5000.0) * \
+            numpy.sin(2 * numpy.pi * rng.uniform(0.5, 2.0) * t) * \
+            numpy.exp(-3.0 * t / t[-1]) + rng.normal(0.0, 200.0, duration)
+        signal[p:p + duration] += train[:len(signal[p:p + duration])]
+
+        streamID = '.'.join(key)
+        offset = (t_from - reference).length()
+        for k in range(0, n, args.record_samples):
+            start = t_from + seiscomp3.Core.TimeSpan(k / args.sps)
+            records.append((offset + k / args.sps, streamID, start,
+                            signal[k:k + args.record_samples]))
+
+    records.sort(key=lambda r: r[:2])
+    return records
+
+
+def run(processor, records, workers, args):
+    """Process the records and return the time (wall clock) needed and the
+    CPU time used by this process (with workers, the part of the processing
+    which is not distributed among them)."""
+
+    if workers > 1:
+        processor = streampool.ProcessorPool(processor, workers)
+
+    start = time.time()
+    cpu = sum(os.times()[:2])
+    last = None
+    for t, streamID, begin, values in records:
+        processor.feed(waveproc.Block(streamID, begin, args.sps, values))
+        if last is None or t - last >= args.update:
+            processor.flush()
+            processor.update()
+            last = t
+    processor.flush()
+    processor.update()
+    processor.finalize()
+    return time.time() - start, sum(os.times()[:2]) - cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--channels', type=int, default=2000,
+                        help='number of stations of the event (default '
+                        '%(default)s)')
+    parser.add_argument('-w', '--workers', default=None,
+                        help='comma separated numbers of worker processes '
+                        '(default 1, 2, 4... up to the number of cores)')
+    parser.add_argument('-l', '--length', type=float, default=300.0,
+                        help='maximum seconds of data per stream (default '
+                        '%(default)s)')
+    parser.add_argument('--sps', type=float, default=20.0,
+                        help='sampling rate (default %(default)s)')
+    parser.add_argument('--record-samples', type=int, default=400,
+                        help='samples per record (default %(default)s)')
+    parser.add_argument('-u', '--update', type=float, default=60.0,
+                        help='seconds of data between updates (default '
+                        '%(default)s)')
+    parser.add_argument('-b', '--batch-samples', type=int, default=0,
+                        help='process the records of every stream in batches '
+                        'of at least this number of samples (default '
+                        '%(default)s, see --batch-samples of '
+                        'scxxlmag-compute.py)')
+    parser.add_argument('-f', '--filter-bank', action='store_true',
+                        help='filter all the streams together in the '
+                        'preprocessing (see filterbank.py; the magnitudes '
+                        'may differ from the ones of scxxlmag-compute.py)')
+    parser.add_argument('-s', '--seed', type=int, default=1,
+                        help='seed of the random numbers (default '
+                        '%(default)s)')
+    parser.add_argument('-k', '--keep', action='store_true',
+                        help='keep the output of every run')
+    args = parser.parse_args()
+
+    if args.workers is None:
+        workers = [1]
+        while workers[-1] * 2 <= multiprocessing.cpu_count():
+            workers.append(workers[-1] * 2)
+    else:
+        try:
+            workers = [int(w) for w in args.workers.split(',')]
+        except ValueError:
+            parser.error('wrong number of workers')
+        if min(workers) < 1:
+            parser.error('wrong number of workers')
+        # The reference run with a single process
+        workers = [1] + [n for n in workers if n != 1]
+
+    rng = numpy.random.RandomState(args.seed)
+    inventory = syntheticInventory(args.channels, rng)
+    index = waveproc.InventoryIndex(inventory)
+    origin = _Origin(seiscomp3.Core.Time.GMT(), 0.0, 0.0, 30.0)
+
+    workDir = tempfile.mkdtemp(prefix='scxxlmag-bench-')
+    processor = createProcessor(origin, inventory, index, workDir, args)
+    records = syntheticRecords(processor, args, rng)
+    print '%d streams, %d records, %d samples, %d cores' % \
+        (len(processor.timeWinDict), len(records),
+         sum(len(r[3]) for r in records), multiprocessing.cpu_count())
+
+    reference = None
+    single = None
+    print '%7s %9s %11s %7s %10s %8s %s' % ('workers', 'seconds', 'records/s',
+                                            'speedup', 'efficiency', 'main cpu',
+                                            'result')
+    for i, n in enumerate(workers):
+        outputDir = os.path.join(workDir, 'run%d-workers%d' % (i, n))
+        os.mkdir(outputDir)
+        processor = createProcessor(origin, inventory, index, outputDir,
+                                    args)
+
+        # The processor prints the results of every update
+        stdout = sys.stdout
+        sys.stdout = open(os.path.join(outputDir, 'output.txt'), 'w')
+        try:
+            seconds, cpu = run(processor, records, n, args)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        with open(os.path.join(outputDir, 'mBc.txt')) as fin:
+            result = fin.read()
+        if reference is None:
+            reference = result
+            single = seconds
+        print '%7d %9.2f %11.0f %7.2f %10.2f %8.2f %s' % \
+            (n, seconds, len(records) / seconds, single / seconds,
+             single / seconds / n, cpu,
+             'identical' if result == reference else 'DIFFERENT')
+
+    if max(workers) > multiprocessing.cpu_count():
+        print 'More workers than cores: the speed-up of those runs is ' \
+            'limited by the cores'
+
+    if args.keep:
+        print 'Output kept in %s' % workDir
+    else:
+        shutil.rmtree(workDir)
+
+
+if __name__ == '__main__':
+    main()
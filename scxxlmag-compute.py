@@ -1,13 +1,46 @@
 #! /usr/bin/env python
 
+import os
+import re
 import sys
-import fnmatch
+import threading
 import traceback
+import collections
+import seiscomp3.IO
 import seiscomp3.Client
+import waveproc
+import dispatcher
+import outputwriter
+import recordqueue
+import traveltime
+import invsnapshot
+import blacklist
+import streampool
 
 # every so many seconds updates are computed on newly available data
 timerIntervalSeconds = 1
 
+# In listen mode, minimum magnitude of the events to process
+defaultMinMagnitude = 6.0
+# In listen mode, number of recent events kept to check whether an origin or
+# magnitude received is their preferred one
+maxRecentEvents = 100
+# In listen mode, the operational streams are selected again if the inventory
+# was prepared longer than this ago (seconds)
+inventoryRefreshSeconds = 86400
+
+# Maximum number of pending writes of output files
+outputQueueSize = 1000
+
+# Maximum number of records received and waiting to be processed
+defaultRecordQueueSize = 10000
+
+# Streams with longer gaps (seconds) are discarded
+defaultMaxGap = 5.0
+
+# Seconds of newer data to wait for records arriving out of order
+defaultHoldTime = 0.0
+
 # magnitudeModules = ["mBc", "otherMagnitudes"]
 magnitudeModules = ["mBc"]
 magnitudeModules = {m: __import__(m) for m in magnitudeModules}
@@ -40,19 +73,37 @@ class AcquiApp(seiscomp3.Client.StreamApplication):
         try:
             self.eventID = self.commandline().optionString("event")
         except:
-            sys.stderr.write("You must specify event id\n")
-            return False
-
-        self._blacklist = []
+            # In listen mode the events are received later
+            if not self._listen:
+                sys.stderr.write("You must specify event id\n")
+                return False
+            self.eventID = None
+
+        # Records received and waiting to be processed by another thread
+        # (recordqueue.RecordQueue), if they are processed by this
+        # application (see ProcessorApp)
+        self._records = None
+
+        # Streams rejected by all the magnitude modules
+        self._discarded = set()
+        # Streams rejected in the processing thread which are still not
+        # discarded. The record stream is only used by the acquisition, so
+        # they are removed from it in handleRecord.
+        self._rejected = []
+        self._rejectedLock = threading.Lock()
+
+        self._blacklist = blacklist.Blacklist()
         try:
-            blacklist = self.commandline().optionString("blacklist")
-            for line in file(blacklist).xreadlines():
-                self._blacklist.append(line.strip())
-        except IOError:
-            sys.stderr.write("Couldn't read blacklist file '%s'\n" % blacklist)
-            return False
+            filename = self.commandline().optionString("blacklist")
         except:
-            pass
+            filename = None
+        if filename:
+            try:
+                self._blacklist = blacklist.Blacklist.fromFile(filename)
+            except (IOError, OSError):
+                sys.stderr.write("Couldn't read blacklist file '%s'\n" %
+                                 filename)
+                return False
         for item in self._blacklist:
             seiscomp3.Logging.info(item)
 
@@ -62,6 +113,9 @@ class AcquiApp(seiscomp3.Client.StreamApplication):
             sys.stderr.write("ERROR in init(): " + str(exc) + "\n")
             return False
 
+        if not self._configureProcessing():
+            return False
+
         # FIXME ???
         if timerIntervalSeconds:
             self.enableTimer(timerIntervalSeconds)
@@ -75,22 +129,92 @@ class AcquiApp(seiscomp3.Client.StreamApplication):
                 msg = "ID of event to process"
                 self.commandline().addStringOption("Processing",
                                                    "event,E", msg)
+                msg = "file with the precomputed P travel times, " + \
+                    "created with traveltime.py (if it does not exist, " + \
+                    "they are calculated for every station)"
+                self.commandline().addStringOption("Processing",
+                                                   "ttt-grid", msg)
+                msg = "listen to the messaging system (or read --input) " + \
+                    "and process every event with a magnitude over " + \
+                    "--min-magnitude"
+                self.commandline().addOption("Processing", "listen", msg)
+                msg = "minimum magnitude of the events processed in " + \
+                    "listen mode (default %.1f)" % defaultMinMagnitude
+                self.commandline().addStringOption("Processing",
+                                                   "min-magnitude", msg)
+                msg = "seconds of newer data to wait for records of a " + \
+                    "stream arriving out of order (default %.0f: a " % \
+                    defaultHoldTime + "stream is discarded if its " + \
+                    "records are not in order)"
+                self.commandline().addStringOption("Processing",
+                                                   "hold-time", msg)
+                msg = "fill the gaps up to 5 s: linear (interpolation) " + \
+                    "or zero (average of the signal). By default they " + \
+                    "are not filled"
+                self.commandline().addStringOption("Processing",
+                                                   "gap-fill", msg)
+                msg = "streams with longer gaps are discarded; after a " + \
+                    "gap over 5 s, the processing of the stream is " + \
+                    "resumed (seconds, default %.0f)" % defaultMaxGap
+                self.commandline().addStringOption("Processing",
+                                                   "max-gap", msg)
+                msg = "center the signal with the mean of its first " + \
+                    "seconds without the samples further than 5 MAD " + \
+                    "from their median (for streams with spikes)"
+                self.commandline().addOption("Processing",
+                                             "robust-baseline", msg)
+                msg = "seconds of the last records of every stream to " + \
+                    "keep in memory (default 0, released once processed)"
+                self.commandline().addStringOption("Processing",
+                                                   "retention", msg)
+                msg = "keep the samples of the records as received " + \
+                    "instead of the decoded ones (see --retention)"
+                self.commandline().addOption("Processing", "retention-raw",
+                                             msg)
+                msg = "process the records of a stream in batches of at " + \
+                    "least this number of samples, or on every update " + \
+                    "(default 0, every record as it arrives)"
+                self.commandline().addStringOption("Processing",
+                                                   "batch-samples", msg)
+                msg = "number of processes among which the streams of " + \
+                    "an event are distributed (default 1, processed by " + \
+                    "the application itself)"
+                self.commandline().addStringOption("Processing", "workers",
+                                                   msg)
 
                 self.commandline().addGroup("Input")
                 msg = "input format to use (xml [default], zxml (zipped " + \
                     "xml), binary)"
                 self.commandline().addStringOption("Input", "format,f", msg)
 
-                msg = "input file, default: stdin"
+                msg = "input file with event parameters to process in " + \
+                    "listen mode"
                 self.commandline().addStringOption("Input", "input,i", msg)
 
+                msg = "file with a snapshot of the inventory. It is " + \
+                    "used instead of loading the inventory and it is " + \
+                    "created again if the inventory changes"
+                self.commandline().addStringOption("Input",
+                                                   "inventory-snapshot", msg)
+
                 self.commandline().addGroup("Control")
                 msg = "stream blacklist"
                 self.commandline().addStringOption("Control", "blacklist,b",
                                                    msg)
+                msg = "discard the blocks of the waveforms dumped " + \
+                    "instead of waiting when too many writes of files " + \
+                    "are pending"
+                self.commandline().addOption("Control", "drop-output", msg)
+                msg = "maximum number of records received and waiting " + \
+                    "to be processed (default %d)" % defaultRecordQueueSize
+                self.commandline().addStringOption("Control",
+                                                   "record-queue", msg)
+                msg = "discard records received instead of waiting " + \
+                    "when the record queue is full"
+                self.commandline().addOption("Control", "drop-records", msg)
 
                 self.commandline().addGroup("Debugging")
-                msg = "Save the requested waveforms in ASCII format"
+                msg = "Save the requested waveforms in binary format"
                 self.commandline().addOption("Control",
                                              "dump-waveforms,w", msg)
             except:
@@ -109,8 +233,21 @@ class AcquiApp(seiscomp3.Client.StreamApplication):
             if (seiscomp3.Client.StreamApplication.validateParameters(self)
                     is False):
                 return False
-            if not self.commandline().hasOption("event"):
+
+            self._listen = self.commandline().hasOption("listen")
+            self._inputFile = self.commandline().optionString("input") \
+                if self.commandline().hasOption("input") else None
+            # In listen mode the events come from the messaging system unless
+            # they are read from a file
+            messaging = self._listen and self._inputFile is None
+            if self._listen:
+                # Waveforms are requested separately for every event
+                self.setRecordStreamEnabled(False)
+                self.setMessagingEnabled(messaging)
+
+            if not self.commandline().hasOption("event") and not messaging:
                 self.setDatabaseEnabled(False, False)
+            self._checkSnapshot()
             return True
         except:
             info = traceback.format_exception(*sys.exc_info())
@@ -118,6 +255,37 @@ class AcquiApp(seiscomp3.Client.StreamApplication):
                 sys.stderr.write(i)
             sys.exit(-1)
 
+    def _checkSnapshot(self):
+        """Check whether the snapshot of the inventory can be used. In that
+        case, the inventory is not loaded by SC3."""
+
+        self._snapshot = None
+        self._snapshotFile = None
+        self._snapshotKey = None
+
+        if not self.commandline().hasOption("inventory-snapshot"):
+            return
+
+        self._snapshotFile = self.commandline().optionString(
+            "inventory-snapshot")
+        source = self.commandline().optionString("inventory-db") \
+            if self.commandline().hasOption("inventory-db") else None
+        self._snapshotKey = invsnapshot.inventoryKey(source,
+                                                     self.databaseURI())
+
+        if self._snapshotKey is None:
+            seiscomp3.Logging.warning("The state of the inventory is " +
+                                      "unknown. Snapshot is not used.")
+            return
+
+        if (invsnapshot.InventorySnapshot.loadKey(self._snapshotFile) ==
+                self._snapshotKey):
+            self._snapshot = invsnapshot.InventorySnapshot.load(
+                self._snapshotFile)
+            self.setLoadInventoryEnabled(False)
+            seiscomp3.Logging.info("Inventory read from snapshot %s" %
+                                   self._snapshotFile)
+
     def _loadEvent(self, eventID):
         """Retrieve event information based on eventID and the
         preferred origin."""
@@ -142,16 +310,46 @@ class AcquiApp(seiscomp3.Client.StreamApplication):
     def _blacklisted(self, stream_id):
         """Check whether the stream should be discarded"""
 
-        for pattern in self._blacklist:
-            if fnmatch.fnmatch(stream_id, pattern):
+        return stream_id in self._blacklist
+
+    def _reloadBlacklist(self):
+        """The blacklist can be changed without restarting the application.
+        Returns True if it was reloaded."""
+
+        try:
+            if self._blacklist.reload():
+                seiscomp3.Logging.info("blacklist reloaded (%d patterns)" %
+                                       len(self._blacklist))
                 return True
+        except (IOError, OSError), e:
+            seiscomp3.Logging.warning("Couldn't reload blacklist: %s" % e)
         return False
 
     def _prepareInventory(self, time):
+        self._reloadBlacklist()
+        self._inventoryTime = time
+
+        if self._snapshot is not None:
+            self._inventory = self._snapshot.inventory(time.length(),
+                                                       self._blacklisted)
+            return self._inventory
+
         self._inventory = dict()
 
         # Retrieve a network list from the SeisComP3 inventory
         inv = seiscomp3.Client.Inventory.Instance().inventory()
+
+        # Save a snapshot to be used the next time
+        if self._snapshotFile and self._snapshotKey:
+            try:
+                invsnapshot.InventorySnapshot.fromInventory(
+                    inv, self._snapshotKey).save(self._snapshotFile)
+                seiscomp3.Logging.info("Inventory snapshot saved in %s" %
+                                       self._snapshotFile)
+            except (IOError, OSError), e:
+                seiscomp3.Logging.warning("Could not save the inventory " +
+                                          "snapshot: %s" % str(e))
+
         nnet = inv.networkCount()
         for inet in xrange(nnet):
             network = inv.network(inet)
@@ -207,7 +405,8 @@ class AcquiApp(seiscomp3.Client.StreamApplication):
         return self._inventory
 
     def _initializeProcessing(self):
-        self._loadEvent(self.eventID)
+        if self.eventID is not None:
+            self._loadEvent(self.eventID)
 
         # XXX
         now = seiscomp3.Core.Time.GMT()
@@ -215,6 +414,13 @@ class AcquiApp(seiscomp3.Client.StreamApplication):
 
         return
 
+    def _configureProcessing(self):
+        """Prepare the processing once the event and the inventory are
+        loaded. It is called before the timer and any thread of the
+        application are started. Returns False if it cannot be done."""
+
+        return True
+
     def _requestWaveforms(self, waveform_windows):
         """Based on the timewindows received as a parameter, those are
         requested."""
@@ -244,20 +450,46 @@ class AcquiApp(seiscomp3.Client.StreamApplication):
         self._updateProcessing()
 
     def handleRecord(self, rec):
-        # Check whether stream is new and prepare a list to store data if
-        # necessary
+        if self._rejected:
+            self._discardRejected()
+
         streamID = rec.streamID()
-        n, s, l, c = streamID.split('.')
+        if streamID in self._discarded:
+            return False
+
+        # The record is processed in a separate thread (see _feed), so that
+        # the acquisition does not wait for the processing
+        return self._records.put(rec)
+
+    def _feed(self, rec):
+        # Pass the received record to the preprocessing shared by the
+        # magnitude calculator modules
+        for input in self._inputs:
+            input.feed(rec)
+
+    def _streamRejected(self, streamID):
+        """Stop receiving the records of a stream once all the magnitude
+        modules rejected it. Called from the processing thread."""
 
-        # Check whether the record is accepted by at least one module
-        accepted = False
-        # Call the magnitude calculator modules with the received record
         for name in self._processor:
-            processor = self._processor[name]
-            # If the module accepted the record, this is saved in "accept"
-            accepted = accepted or processor.feed(rec)
+            if streamID not in self._processor[name].quarantine:
+                return
+
+        with self._rejectedLock:
+            self._rejected.append(streamID)
 
-        return accepted
+    def _discardRejected(self):
+        """Discard the streams rejected since the last record received."""
+
+        with self._rejectedLock:
+            rejected, self._rejected = self._rejected, []
+
+        stream = self.recordStream()
+        for streamID in rejected:
+            self._discarded.add(streamID)
+            if stream is not None and hasattr(stream, 'removeStream'):
+                n, s, l, c = streamID.split('.')
+                stream.removeStream(n, s, l, c)
 
     def addObject(self, parentID, obj):
         try:
@@ -270,9 +502,13 @@ class AcquiApp(seiscomp3.Client.StreamApplication):
             if org:
                 self._cache.feed(org)
                 seiscomp3.Logging.debug("got new origin '%s'" % org.publicID())
-                for name in self._processor:
-                    processor = self._processor[name]
-                    processor.setEvent(org)
+                if self._records is None:
+                    self._setOrigin(org)
+                else:
+                    # The processors are updated while the processing
+                    # thread does not use them
+                    with self._records.lock:
+                        self._setOrigin(org)
                 return
             mag = seiscomp3.DataModel.Magnitude.Cast(obj)
             if mag:
@@ -285,6 +521,11 @@ class AcquiApp(seiscomp3.Client.StreamApplication):
             for i in info:
                 sys.stderr.write(i)
 
+    def _setOrigin(self, org):
+        for name in self._processor:
+            processor = self._processor[name]
+            processor.setEvent(org)
+
     def updateObject(self, parentID, obj):
         # FIXME This should be taken into account to recompute the magnitude if
         # an origin changes
@@ -314,35 +555,381 @@ class AcquiApp(seiscomp3.Client.StreamApplication):
 
 class ProcessorApp(AcquiApp):
 
+    def _configureProcessing(self):
+        # Coordinates and preferred streams of the inventory are indexed only
+        # once for all the magnitude modules
+        self._index = waveproc.InventoryIndex(self._inventory)
+
+        # Grid of P travel times shared by all the magnitude modules
+        self._tttGrid = None
+        if self.commandline().hasOption("ttt-grid"):
+            self._tttGrid = traveltime.loadGrid(
+                self.commandline().optionString("ttt-grid"))
+
+        # Travel time table shared by all the magnitude modules
+        self._ttt = seiscomp3.Seismology.TravelTimeTable()
+
+        self._holdTime = defaultHoldTime
+        if self.commandline().hasOption("hold-time"):
+            try:
+                self._holdTime = float(
+                    self.commandline().optionString("hold-time"))
+            except ValueError:
+                sys.stderr.write("Wrong hold time\n")
+                return False
+
+        self._gapFill = None
+        if self.commandline().hasOption("gap-fill"):
+            self._gapFill = self.commandline().optionString("gap-fill")
+            if self._gapFill not in ('linear', 'zero'):
+                sys.stderr.write("Wrong gap filling '%s'\n" % self._gapFill)
+                return False
+
+        self._maxGap = defaultMaxGap
+        if self.commandline().hasOption("max-gap"):
+            try:
+                self._maxGap = float(
+                    self.commandline().optionString("max-gap"))
+            except ValueError:
+                sys.stderr.write("Wrong maximum gap\n")
+                return False
+
+        self._retention = 0.0
+        if self.commandline().hasOption("retention"):
+            try:
+                self._retention = float(
+                    self.commandline().optionString("retention"))
+            except ValueError:
+                sys.stderr.write("Wrong retention\n")
+                return False
+
+        self._batchSize = 0
+        if self.commandline().hasOption("batch-samples"):
+            try:
+                self._batchSize = int(
+                    self.commandline().optionString("batch-samples"))
+            except ValueError:
+                sys.stderr.write("Wrong number of samples per batch\n")
+                return False
+
+        self._workers = 1
+        if self.commandline().hasOption("workers"):
+            try:
+                self._workers = int(
+                    self.commandline().optionString("workers"))
+            except ValueError:
+                sys.stderr.write("Wrong number of workers\n")
+                return False
+
+        self._recordQueueSize = defaultRecordQueueSize
+        if self.commandline().hasOption("record-queue"):
+            try:
+                self._recordQueueSize = int(
+                    self.commandline().optionString("record-queue"))
+            except ValueError:
+                sys.stderr.write("Wrong size of the record queue\n")
+                return False
+        self._recordOverflow = 'drop' if \
+            self.commandline().hasOption("drop-records") else 'block'
+
+        # The worker processes are forked now, before any thread is started,
+        # and they create their own copy of the processors of every event
+        # (see _createWorkerProcessor)
+        self._workerGroup = None
+        if self._workers > 1:
+            self._workerGroup = streampool.WorkerGroup(
+                self._createWorkerProcessor, self._workers, 'scxxlmag')
+
+        return True
+
     def init(self):
-        AcquiApp.init(self)
+        if not AcquiApp.init(self):
+            return False
 
-        timeWin = []
+        # Files are written in the background by all the magnitude modules
+        self._writer = outputwriter.OutputWriter(
+            outputQueueSize,
+            'drop' if self.commandline().hasOption("drop-output")
+            else 'block')
 
-        self._processor = dict()
+        if self._listen:
+            return self._startListening()
+
+        if not hasattr(self, "org"):
+            sys.exit(-2)
+
+        # Records received and waiting to be processed
+        self._records = recordqueue.RecordQueue(
+            self._feed, self._recordQueueSize, self._recordOverflow,
+            name='Records')
+
+        self._processor, timeWin = self._createProcessors(self.org)
+        for name in self._processor:
+            self._processor[name].onReject = self._streamRejected
+        # Objects fed with the records (see _feed)
+        self._inputs = waveproc.processorInputs(self._processor.values())
+
+        # We do not need inventory as a filtered version exist in every
+        # magnitude module
+        self._inventory = dict()
+        AcquiApp._requestWaveforms(self, timeWin)
+
+        return True
+
+    def _createProcessors(self, origin, outputDir='.'):
+        """Create the processors of all the magnitude modules for an origin.
+
+        Returns a dictionary with the processors by name and the list of time
+        windows they request (t_from, t_to, net, sta, loc, cha)."""
+
+        processors = dict()
+        timeWin = []
+        # The records are checked, scaled and centered once for all the
+        # magnitude modules
+        input = self._createInput()
         for name in magnitudeModules:
-            # To shorten notation
-            mm = magnitudeModules[name]
-            processor = self._processor[name] = mm.Processor(
-                self.commandline().hasOption("dump-waveforms"))
-            if hasattr(self, "org"):
-                processor.setEvent(self.org)
-            else:
-                sys.exit(-2)
-            processor._filterInventory(self._inventory)
+            processor = processors[name] = self._createProcessor(name,
+                                                                 outputDir)
+            processor.writer = self._writer
+            processor.setEvent(origin)
+            processor._filterInventory(self._inventory, self._index)
 
             processor.timeWindows()
             for net, sta, loc, cha in processor.timeWinDict:
                 t_from, t_to = processor.timeWinDict[net, sta, loc, cha]
                 timeWin.append((t_from, t_to, net, sta, loc, cha))
 
-        # We do not need inventory as a filtered version exist in every
-        # magnitude module
-        self._inventory = dict()
-        AcquiApp._requestWaveforms(self, timeWin)
+            # The workers create a copy of the processor with the same
+            # arguments. The workers of every module preprocess the records
+            # on their own.
+            if self._workerGroup is not None:
+                self._createInput().register(processor)
+                time = origin.time().value()
+                event = (time.seconds(), time.microseconds(),
+                         origin.latitude().value(),
+                         origin.longitude().value(),
+                         origin.depth().value())
+                inventoryTime = (self._inventoryTime.seconds(),
+                                 self._inventoryTime.microseconds())
+                processors[name] = streampool.ProcessorPool(
+                    processor, self._workerGroup,
+                    args=(name, event, outputDir, inventoryTime))
+            else:
+                input.register(processor)
+
+        return processors, timeWin
+
+    def _createProcessor(self, name, outputDir):
+        """Processor of a magnitude module, without event."""
+
+        processor = magnitudeModules[name].Processor(
+            self.commandline().hasOption("dump-waveforms"), ttt=self._ttt)
+        processor.outputDir = outputDir
+        processor.tttGrid = self._tttGrid
+        return processor
+
+    def _createWorkerProcessor(self, name, event, outputDir, inventoryTime):
+        """Create the processor of a magnitude module in a worker process
+        (see streampool.WorkerGroup), ready to receive the records of an
+        event like the one created by _createProcessors.
+
+        event: (seconds, microseconds, latitude, longitude, depth) of the
+               origin
+        inventoryTime: (seconds, microseconds) of the time when the
+                       inventory was prepared by the application"""
+
+        # The inventory may have been prepared again since the worker was
+        # forked
+        if (self._inventoryTime.seconds(),
+                self._inventoryTime.microseconds()) != inventoryTime:
+            # The snapshot is only saved by the application
+            self._snapshotFile = None
+            self._prepareInventory(seiscomp3.Core.Time(*inventoryTime))
+            self._index = waveproc.InventoryIndex(self._inventory)
+
+        sec, usec, lat, lon, dep = event
+        processor = self._createProcessor(name, outputDir)
+        processor.moveEvent(seiscomp3.Core.Time(sec, usec), lat, lon, dep)
+        processor._filterInventory(self._inventory, self._index)
+        processor.timeWindows()
+        self._createInput().register(processor)
+        return processor
+
+    def _createInput(self):
+        """Preprocessing stage of the records (waveproc.Preprocessor)
+        configured with the options of the application."""
+
+        input = waveproc.Preprocessor()
+        input.holdTime = self._holdTime
+        input.gapFill = self._gapFill
+        input.maxGap = self._maxGap
+        input.robustBaseline = self.commandline().hasOption("robust-baseline")
+        input.retention = self._retention
+        input.retainRaw = self.commandline().hasOption("retention-raw")
+        input.batchSize = self._batchSize
+        return input
+
+    def _startListening(self):
+        minMagnitude = defaultMinMagnitude
+        if self.commandline().hasOption("min-magnitude"):
+            try:
+                minMagnitude = float(
+                    self.commandline().optionString("min-magnitude"))
+            except ValueError:
+                sys.stderr.write("Wrong minimum magnitude\n")
+                return False
+
+        self._processor = dict()
+        # Recent events by ID
+        self._events = collections.OrderedDict()
+        self._dispatcher = dispatcher.EventDispatcher(self._createJob,
+                                                      self._openSource,
+                                                      minMagnitude)
+        seiscomp3.Logging.info("Listening for events with magnitude >= %.1f"
+                               % minMagnitude)
+
+        if self._inputFile is not None:
+            return self._readInput(self._inputFile)
+
+        return True
+
+    def _readInput(self, filename):
+        """Replay the origins, magnitudes and events of an EventParameters
+        file as if they had been received from the messaging system."""
+
+        try:
+            fmt = self.commandline().optionString("format")
+        except:
+            fmt = "xml"
+
+        if fmt == "binary":
+            ar = seiscomp3.IO.BinaryArchive()
+        else:
+            ar = seiscomp3.IO.XMLArchive()
+            if fmt == "zxml":
+                ar.setCompression(True)
+
+        if not ar.open(filename):
+            sys.stderr.write("Couldn't open input file '%s'\n" % filename)
+            return False
+        obj = ar.readObject()
+        ar.close()
+
+        # Keep a reference to the objects while the application runs
+        self._ep = seiscomp3.DataModel.EventParameters.Cast(obj)
+        if self._ep is None:
+            sys.stderr.write("No event parameters found in '%s'\n" %
+                             filename)
+            return False
+
+        for i in xrange(self._ep.originCount()):
+            org = self._ep.origin(i)
+            self._receive(org)
+            for j in xrange(org.magnitudeCount()):
+                self._receive(org.magnitude(j))
+        for i in xrange(self._ep.eventCount()):
+            self._receive(self._ep.event(i))
 
         return True
 
+    def _eventDirectory(self, eventID):
+        """Directory where the results of an event are saved in listen
+        mode."""
+
+        path = re.sub('[^A-Za-z0-9._-]', '_', eventID)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    def _createJob(self, eventID, origin):
+        # The inventory is kept between events and only prepared again if
+        # the blacklist changed or it is too old
+        now = seiscomp3.Core.Time.GMT()
+        if self._reloadBlacklist() or \
+                (now - self._inventoryTime).length() > inventoryRefreshSeconds:
+            self._prepareInventory(now)
+            self._index = waveproc.InventoryIndex(self._inventory)
+
+        processors, timeWin = self._createProcessors(
+            origin, self._eventDirectory(eventID))
+        return dispatcher.EventJob(eventID, processors, timeWin,
+                                   self._recordQueueSize,
+                                   self._recordOverflow)
+
+    def _openSource(self, windows):
+        return dispatcher.RecordStreamSource(self.recordStreamURL(), windows)
+
+    def _receive(self, obj):
+        """Pass the events whose preferred origin or magnitude changed to
+        the dispatcher."""
+
+        evt = seiscomp3.DataModel.Event.Cast(obj)
+        if evt:
+            self._events.pop(evt.publicID(), None)
+            self._events[evt.publicID()] = evt
+            if len(self._events) > maxRecentEvents:
+                self._events.popitem(last=False)
+            self._dispatch(evt)
+            return
+
+        org = seiscomp3.DataModel.Origin.Cast(obj)
+        mag = seiscomp3.DataModel.Magnitude.Cast(obj)
+        if org:
+            self._cache.feed(org)
+            publicID = org.publicID()
+        elif mag:
+            self._cache.feed(mag)
+            publicID = mag.publicID()
+        else:
+            return
+
+        for evt in self._events.values():
+            if publicID in (evt.preferredOriginID(),
+                            evt.preferredMagnitudeID()):
+                self._dispatch(evt)
+
+    def _dispatch(self, evt):
+        try:
+            if evt.type() == seiscomp3.DataModel.NOT_EXISTING:
+                return
+        except ValueError:
+            # Type not set
+            pass
+
+        org = self._cache.get(seiscomp3.DataModel.Origin,
+                              evt.preferredOriginID())
+        if not org:
+            return
+
+        magnitude = None
+        if evt.preferredMagnitudeID():
+            mag = self._cache.get(seiscomp3.DataModel.Magnitude,
+                                  evt.preferredMagnitudeID())
+            if mag:
+                magnitude = mag.magnitude().value()
+
+        self._dispatcher.setEvent(evt.publicID(), org, magnitude)
+
+    def addObject(self, parentID, obj):
+        if not self._listen:
+            return AcquiApp.addObject(self, parentID, obj)
+        try:
+            self._receive(obj)
+        except:
+            info = traceback.format_exception(*sys.exc_info())
+            for i in info:
+                sys.stderr.write(i)
+
+    def updateObject(self, parentID, obj):
+        if not self._listen:
+            return AcquiApp.updateObject(self, parentID, obj)
+        try:
+            self._receive(obj)
+        except:
+            info = traceback.format_exception(*sys.exc_info())
+            for i in info:
+                sys.stderr.write(i)
+
     def _updateProcessing(self):
         # This is where the actual waveform processing is delegated to the
         # individual magnitude modules.
@@ -353,20 +940,46 @@ class ProcessorApp(AcquiApp):
         #     seiscomp3.Logging.debug("_updateProcessing %-20s %6d new records"
         #     % (streamID,n))
 
-        # Call update in every magnitude calculator module
-        for name in self._processor:
-            processor = self._processor[name]
-            processor.update()
+        if self._listen:
+            self._dispatcher.update()
+            # Events read from a file: stop when all of them are processed
+            if self._inputFile is not None and not self._dispatcher.jobs:
+                self.quit()
+            seiscomp3.Logging.debug("_updateProcessing end")
+            return
+
+        # Call update in every magnitude calculator module, after processing
+        # the records batched since the last one. The records queued are
+        # processed meanwhile in the processing thread.
+        with self._records.lock:
+            for name in self._processor:
+                processor = self._processor[name]
+                processor.flush()
+                processor.update()
+        self._records.report()
 
         seiscomp3.Logging.debug("_updateProcessing end")
 
     def _finalizeProcessing(self):
         seiscomp3.Logging.debug("_finalizeProcessing begin")
+        if self._listen:
+            self._dispatcher.close()
+
+        # Process the records still queued
+        if self._records is not None:
+            self._records.close()
+
         for name in self._processor:
             processor = self._processor[name]
             # Check that this is OK here
             processor.finalize()
 
+        if self._workerGroup is not None:
+            self._workerGroup.close()
+
+        # Wait until all the files are written
+        self._writer.close()
+
         seiscomp3.Logging.debug("_finalizeProcessing end")
 
     def handleRecord(self, rec):
@@ -17,5 +17,5 @@ for evt in "$@"
 do
     ii="/home/javier/temp/events/$evt.mseed"
     debug=--debug
-    ./scxxlmag-compute.py --dump-waveforms --inventory-db "$db" $debug --blacklist blacklist.txt -I "$ii" -d "$db" -H $proc -E "$evt" >$evt.evid || continue
+    ./scxxlmag-compute.py --dump-waveforms --inventory-db "$db" $debug --blacklist blacklist.txt --inventory-snapshot inventory.npz -I "$ii" -d "$db" -H $proc -E "$evt" >$evt.evid || continue
 done
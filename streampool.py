@@ -0,0 +1,393 @@
+"""Processing of the streams of an event in several processes.
+
+The streams are independent until their results are combined to calculate
+the magnitude of the event. A ProcessorPool sends the records of a fixed
+subset of the streams to each of the worker processes of a WorkerGroup,
+which have a copy of the magnitude processor ready to receive records
+(inventory filtered and time windows calculated). To update the results, the
+summaries of the streams of all the workers are combined by the original
+processor, which asks the workers for the magnitudes of their streams.
+
+The workers are forked when the WorkerGroup is created. A process should not
+be forked while other threads are running (a lock held by one of them, e.g.
+by the thread writing the output, would never be released in the child), so
+an application creates the group while it starts and the workers create the
+processors of every event on their own, with the same arguments as the
+application. A ProcessorPool created with a number of workers forks its own
+group with a copy of the processor, which is only safe if no other thread
+is running (e.g. in scxxlmag-bench).
+
+Every stream is always processed by the same worker and its records are
+processed in the order they were received, so the results are the same as
+with a single processor. The records are sent to every worker in batches
+(RecordBatch): the samples of many records are copied to a single array,
+which is sent without pickling it.
+
+The processor must provide summary(), combine(), combineFinal(),
+streamMagnitudes(), removeResults() and saveStreams() (see mBc).
+"""
+
+import sys
+import zlib
+import numpy
+import itertools
+import threading
+import traceback
+import multiprocessing
+import seiscomp3.Core
+import seiscomp3.Logging
+import waveproc
+
+
+class RecordBatch:
+    """Records to be sent at once to a worker. The samples of all of them
+    are copied to a single array, which grows as needed, and sent as raw
+    bytes after a message describing the records with tuples of numbers
+    (see add), so that only the message is pickled."""
+
+    def __init__(self, samples=65536):
+        self.headers = []
+        self.samples = numpy.empty(samples)
+        self.size = 0
+
+    def __len__(self):
+        return len(self.headers)
+
+    def add(self, stream, rec):
+        """Add a record of the stream with the given position in the sorted
+        time windows of the processor."""
+
+        values = rec.data().numpy()
+        nsamp = len(values)
+        if self.size + nsamp > len(self.samples):
+            samples = numpy.empty(max(2 * len(self.samples),
+                                      self.size + nsamp))
+            samples[:self.size] = self.samples[:self.size]
+            self.samples = samples
+        self.samples[self.size:self.size + nsamp] = values
+        self.size += nsamp
+
+        start = rec.startTime()
+        self.headers.append((stream, start.seconds(), start.microseconds(),
+                             rec.samplingFrequency(), nsamp))
+
+    def send(self, conn, poolID):
+        """Send the records to the processor of a worker (see _serve)."""
+
+        conn.send(('feed', poolID, self.headers))
+        conn.send_bytes(self.samples[:self.size])
+
+    def clear(self):
+        self.headers = []
+        self.size = 0
+
+
+def _serve(factory, conn):
+    """Main loop of a worker process. It keeps the processors of all the
+    pools by their ID, with the IDs of the streams they requested."""
+
+    processors = dict()
+    streamIDs = dict()
+    while True:
+        message = conn.recv()
+        if message[0] == 'feed':
+            processor = processors[message[1]]
+            streams = streamIDs[message[1]]
+            headers = message[2]
+            samples = numpy.frombuffer(conn.recv_bytes(), dtype=numpy.double)
+            pos = 0
+            for stream, sec, usec, sps, nsamp in headers:
+                try:
+                    processor.feed(waveproc.Block(
+                        streams[stream], seiscomp3.Core.Time(sec, usec), sps,
+                        samples[pos:pos + nsamp]))
+                except:
+                    info = traceback.format_exception(*sys.exc_info())
+                    for i in info:
+                        sys.stderr.write(i)
+                pos += nsamp
+            continue
+
+        if message[0] == 'release':
+            processors.pop(message[1], None)
+            streamIDs.pop(message[1], None)
+            continue
+
+        if message[0] == 'stop':
+            break
+
+        try:
+            if message[0] == 'create':
+                processor = factory(*message[2])
+                # The files are written directly by every worker, as the
+                # thread of the writer is not running in this process. The
+                # rejected streams are reported in the summary.
+                processor.writer = None
+                processor.onReject = None
+                processors[message[1]] = processor
+                result = sorted(processor.timeWinDict)
+                streamIDs[message[1]] = ['.'.join(key) for key in result]
+            else:
+                method, args = message[2:]
+                if method == 'moveEvent':
+                    # The time of the event cannot be pickled
+                    sec, usec = args[0]
+                    args = (seiscomp3.Core.Time(sec, usec),) + args[1:]
+                result = getattr(processors[message[1]], method)(*args)
+            conn.send((True, result))
+        except:
+            conn.send((False, ''.join(traceback.format_exception(
+                *sys.exc_info()))))
+
+    conn.close()
+
+
+class WorkerGroup:
+    """Worker processes which create and run the processors of any number
+    of ProcessorPools. They can be used by several threads."""
+
+    def __init__(self, factory, workers, name='worker'):
+        """factory: function called in the workers with the arguments of
+                    a ProcessorPool, returning a magnitude processor ready
+                    to receive records
+        workers: number of worker processes"""
+
+        self.name = name
+        self._ids = itertools.count()
+
+        self._conns = []
+        self._locks = []
+        self._workers = []
+        for i in range(workers):
+            parent, child = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_serve,
+                                             args=(factory, child),
+                                             name='%s-%d' % (name, i))
+            worker.daemon = True
+            worker.start()
+            child.close()
+            self._conns.append(parent)
+            self._locks.append(threading.Lock())
+            self._workers.append(worker)
+
+        seiscomp3.Logging.info("%s: %d worker processes" % (name, workers))
+
+    def __len__(self):
+        return len(self._conns)
+
+    def create(self, args):
+        """Create a processor in every worker calling the factory with
+        "args". Returns the ID of the processors and the time windows (sorted
+        keys) requested by each of them."""
+
+        poolID = next(self._ids)
+        return poolID, self._call('create', poolID, args)
+
+    def send(self, worker, poolID, batch):
+        """Send the records of a RecordBatch to the processor of a
+        worker."""
+
+        with self._locks[worker]:
+            batch.send(self._conns[worker], poolID)
+
+    def call(self, poolID, method, *args):
+        """Call a method of the processors of all the workers and return
+        their results."""
+
+        return self._call('call', poolID, method, args)
+
+    def _call(self, kind, poolID, *args):
+        # The workers are locked in order, so that the calls from several
+        # threads do not receive the results of each other
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            for conn in self._conns:
+                conn.send((kind, poolID) + args)
+
+            results = []
+            errors = []
+            for conn in self._conns:
+                ok, result = conn.recv()
+                if not ok:
+                    errors.append(result)
+                results.append(result)
+        finally:
+            for lock in self._locks:
+                lock.release()
+
+        if errors:
+            raise RuntimeError("worker of %s failed:\n%s" %
+                               (self.name, errors[0]))
+        return results
+
+    def release(self, poolID):
+        """Delete the processors of a pool."""
+
+        for worker, conn in enumerate(self._conns):
+            with self._locks[worker]:
+                conn.send(('release', poolID))
+
+    def close(self):
+        """Stop the workers."""
+
+        for worker, conn in enumerate(self._conns):
+            with self._locks[worker]:
+                conn.send(('stop',))
+        for worker in self._workers:
+            worker.join()
+
+
+class ProcessorPool:
+    """Magnitude processor whose streams are processed by several worker
+    processes. It can be used instead of the processor by the application
+    and the dispatcher (feed, flush, update, setEvent, finalize)."""
+
+    def __init__(self, processor, workers, chunk=64, args=()):
+        """processor: magnitude processor ready to receive records
+        workers: WorkerGroup creating a copy of the processor with "args",
+                 or number of worker processes to fork now with a copy of
+                 "processor"
+        chunk: number of records sent at once to a worker"""
+
+        self.processor = processor
+        self.name = processor.name
+        self.timeWinDict = processor.timeWinDict
+        self.chunk = chunk
+
+        self.quarantine = waveproc.Quarantine()
+        self.onReject = None
+
+        # The group is stopped with the pool if it is its own one
+        self._ownGroup = not isinstance(workers, WorkerGroup)
+        if self._ownGroup:
+            workers = WorkerGroup(lambda: processor, workers, self.name)
+        self._group = workers
+
+        # Worker of every stream requested and position of the stream in
+        # the sorted time windows (which identifies it in a RecordBatch)
+        self._assigned = dict()
+        for stream, key in enumerate(sorted(self.timeWinDict)):
+            streamID = '.'.join(key)
+            # The same for every run, so that the workers are balanced in
+            # the same way
+            self._assigned[streamID] = \
+                ((zlib.crc32(streamID) & 0xffffffff) % len(self._group),
+                 stream)
+        self._pending = [RecordBatch() for i in range(len(self._group))]
+        # Records sent to every worker
+        self.records = [0] * len(self._group)
+
+        try:
+            self._id, windows = self._group.create(args)
+        except:
+            if self._ownGroup:
+                self._group.close()
+            raise
+        for keys in windows:
+            if keys != sorted(self.timeWinDict):
+                self.close()
+                raise RuntimeError("processor of %s created by a worker "
+                                   "requests %d streams instead of %d" %
+                                   (self.name, len(keys),
+                                    len(self.timeWinDict)))
+
+    def feed(self, rec):
+        streamID = rec.streamID()
+        if streamID in self.quarantine:
+            return False
+        assigned = self._assigned.get(streamID)
+        if assigned is None:
+            return False
+
+        worker, stream = assigned
+        batch = self._pending[worker]
+        batch.add(stream, rec)
+        if len(batch) >= self.chunk:
+            self._send(worker)
+        return True
+
+    def _send(self, worker):
+        batch = self._pending[worker]
+        if len(batch):
+            self._group.send(worker, self._id, batch)
+            self.records[worker] += len(batch)
+            batch.clear()
+
+    def _call(self, method, *args):
+        """Call a method of the processors of all the workers and return
+        their results."""
+
+        for worker in range(len(self._group)):
+            self._send(worker)
+        return self._group.call(self._id, method, *args)
+
+    def _summary(self):
+        """Summary of the streams of all the workers (see
+        waveproc.Processor.summary)."""
+
+        summaries = self._call('summary')
+        ends = [s['end'] for s in summaries if s['end'] is not None]
+        summary = dict(streamID=sum((s['streamID'] for s in summaries), []),
+                       table=numpy.concatenate([s['table']
+                                                for s in summaries]),
+                       end=max(ends) if ends else None,
+                       quarantine=dict())
+        for s in summaries:
+            summary['quarantine'].update(s['quarantine'])
+
+        # Streams rejected since the last summary
+        for streamID in sorted(summary['quarantine']):
+            if self.quarantine.add(streamID,
+                                   summary['quarantine'][streamID]) and \
+                    self.onReject is not None:
+                self.onReject(streamID)
+
+        return summary
+
+    def _magnitudes(self, meanDuration, final=False):
+        return sum(self._call('streamMagnitudes', meanDuration, final), [])
+
+    def flush(self):
+        self._call('flush')
+
+    def update(self):
+        self.flush()
+        return self.processor.combine(self._summary(), self._magnitudes)
+
+    def setEvent(self, origin):
+        time = origin.time().value()
+        lat = origin.latitude().value()
+        lon = origin.longitude().value()
+        dep = origin.depth().value()
+
+        self._call('moveEvent', (time.seconds(), time.microseconds()), lat,
+                   lon, dep)
+        if self.processor.moveEvent(time, lat, lon, dep):
+            self.update()
+
+    def finalize(self):
+        self._call('finishStreams')
+        self.processor.combineFinal(self._summary(), self._magnitudes)
+
+        if self.processor.dumpWaveforms:
+            # The files of the previous run must be removed before the
+            # workers save the new ones
+            self.processor.removeResults()
+            if self.processor.writer is not None:
+                self.processor.writer.flush()
+            self._call('saveStreams')
+
+        self.close()
+
+    def close(self):
+        """Delete the processors of the workers (and stop them if the
+        group is the own one of the pool)."""
+
+        if self._ownGroup:
+            self._group.close()
+        else:
+            self._group.release(self._id)
+
+        seiscomp3.Logging.info("Processor %s: records per worker %s" %
+                               (self.name, self.records))
@@ -0,0 +1,169 @@
+"""Statistics of a signal updated with blocks of samples.
+
+RunningStats is used by the processors to calculate the baseline of the
+signal and the level of the noise before the event, without keeping the
+samples (unless a robust estimation is requested, see robustMean).
+
+The sum of the values and of their squares are accumulated one value after
+the other (numpy.cumsum), so that mean() and rms() are exactly the same as
+adding the samples in a loop. The variance is combined from the mean and the
+sum of squared deviations of every block (Welford/Chan), which is stable
+also for signals with a large offset.
+
+OrderStatistics keeps values of the streams (e.g. their durations) sorted
+as they change, so that the processors read their percentiles without
+sorting all of them on every update.
+"""
+
+import bisect
+import numpy
+
+
+class RunningStats:
+
+    def __init__(self, robust=False):
+        """robust: keep the samples to calculate median(), mad() and
+        robustMean()"""
+
+        self.robust = robust
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.squares = 0.0
+        # Mean and sum of squared deviations (Welford)
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._samples = []
+
+    def add(self, values):
+        """Add a block of samples."""
+
+        values = numpy.asarray(values, dtype=numpy.double)
+        n = len(values)
+        if not n:
+            return
+
+        self.total = numpy.cumsum(numpy.append(self.total, values))[-1]
+        self.squares = numpy.cumsum(numpy.append(self.squares,
+                                                 values * values))[-1]
+
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        delta = mean - self._mean
+        count = self.count + n
+        self._mean += delta * n / count
+        self._m2 += m2 + delta * delta * self.count * n / count
+        self.count = count
+
+        if self.robust:
+            self._samples.append(values.copy())
+
+    def __len__(self):
+        return self.count
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def rms(self):
+        return float(numpy.sqrt(self.squares / self.count)) if self.count \
+            else 0.0
+
+    def variance(self):
+        return self._m2 / self.count if self.count else 0.0
+
+    def std(self):
+        return float(numpy.sqrt(self.variance()))
+
+    def median(self):
+        """Median of the samples (only if robust)."""
+
+        if not self._samples:
+            return 0.0
+        return float(numpy.median(numpy.concatenate(self._samples)))
+
+    def mad(self):
+        """Median absolute deviation of the samples (only if robust)."""
+
+        if not self._samples:
+            return 0.0
+        values = numpy.concatenate(self._samples)
+        return float(numpy.median(numpy.abs(values - numpy.median(values))))
+
+    def robustMean(self, limit=5.0):
+        """Mean of the samples which are not further from the median than
+        "limit" times the median absolute deviation (only if robust), so
+        that spikes are ignored."""
+
+        if not self._samples:
+            return 0.0
+        values = numpy.concatenate(self._samples)
+        median = numpy.median(values)
+        deviation = numpy.abs(values - median)
+        mad = numpy.median(deviation)
+        return float(values[deviation <= limit * mad].mean())
+
+
+class OrderStatistics:
+    """Sorted multiset of values. A value is added or removed with a binary
+    search (and a move of the values after it, which is fast for
+    thousands of them) and the k-th smallest one is read directly."""
+
+    def __init__(self):
+        self._values = []
+
+    def add(self, value):
+        bisect.insort(self._values, value)
+
+    def remove(self, value):
+        pos = bisect.bisect_left(self._values, value)
+        if pos == len(self._values) or self._values[pos] != value:
+            raise ValueError("%r is not in the values" % value)
+        del self._values[pos]
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, k):
+        """k-th smallest value."""
+
+        return self._values[k]
+
+    def values(self):
+        """Sorted list of the values."""
+
+        return list(self._values)
+
+    def countAbove(self, limit):
+        """Number of values greater than "limit"."""
+
+        return len(self._values) - bisect.bisect_right(self._values, limit)
+
+    def select(self, k, other, limit=None):
+        """k-th smallest value of the values greater than "limit" (all if
+        it is None) together with the ones of "other" (OrderStatistics)."""
+
+        a = self._values
+        start = 0 if limit is None else bisect.bisect_right(a, limit)
+        b = other._values
+        na = len(a) - start
+        if not 0 <= k < na + len(b):
+            raise IndexError("k-th value out of range")
+
+        # Number of values taken from a among the k + 1 smallest ones
+        lo = max(0, k + 1 - len(b))
+        hi = min(k + 1, na)
+        while lo < hi:
+            i = (lo + hi) // 2
+            if a[start + i] < b[k - i]:
+                lo = i + 1
+            else:
+                hi = i
+
+        j = k + 1 - lo
+        if not lo:
+            return b[j - 1]
+        if not j:
+            return a[start + lo - 1]
+        return max(a[start + lo - 1], b[j - 1])
@@ -0,0 +1,7 @@
+import math
+
+
+def bmagn(amp, per, dist, depth):
+    """Stand-in for the body wave magnitude of seispy."""
+
+    return math.log10(amp / per) + 0.01 * dist + 0.001 * depth + 3.0
@@ -0,0 +1,117 @@
+"""The application without the SC3 framework: the command line is parsed
+from argv, the inventory is the one set with Inventory.Instance() and the
+tests call init() and the handlers (addObject, handleTimeout...)
+themselves."""
+
+import seiscomp3.DataModel
+
+
+class CommandLine(object):
+    """Options given as "--name value" or "--name" (long names only)."""
+
+    def __init__(self, argv):
+        self._options = dict()
+        name = None
+        for arg in argv:
+            if arg.startswith('--'):
+                name = arg[2:]
+                self._options[name] = None
+            elif name is not None:
+                self._options[name] = arg
+                name = None
+
+    def addGroup(self, name):
+        pass
+
+    def addOption(self, group, name, description):
+        pass
+
+    def addStringOption(self, group, name, description):
+        pass
+
+    def hasOption(self, name):
+        return name in self._options
+
+    def optionString(self, name):
+        if self._options.get(name) is None:
+            raise RuntimeError("option %s not given" % name)
+        return self._options[name]
+
+
+class Inventory(object):
+    _instance = None
+
+    def __init__(self):
+        self._inventory = None
+
+    @classmethod
+    def Instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def setInventory(self, inventory):
+        self._inventory = inventory
+
+    def inventory(self):
+        return self._inventory
+
+
+class StreamApplication(object):
+
+    def __init__(self, argc, argv):
+        self._commandline = CommandLine(argv[1:])
+        self.messagingEnabled = False
+        self.timer = None
+        self.quitting = False
+
+    def commandline(self):
+        return self._commandline
+
+    def setDatabaseEnabled(self, enable, fetch):
+        pass
+
+    def setLoadInventoryEnabled(self, enable):
+        pass
+
+    def setLoggingToStdErr(self, enable):
+        pass
+
+    def setDaemonEnabled(self, enable):
+        pass
+
+    def setRecordStreamEnabled(self, enable):
+        pass
+
+    def setMessagingEnabled(self, enable):
+        self.messagingEnabled = enable
+
+    def addMessagingSubscription(self, group):
+        pass
+
+    def setRecordInputHint(self, hint):
+        pass
+
+    def validateParameters(self):
+        return True
+
+    def init(self):
+        return True
+
+    def query(self):
+        return None
+
+    def databaseURI(self):
+        return None
+
+    def recordStream(self):
+        return None
+
+    def recordStreamURL(self):
+        return 'test://'
+
+    def enableTimer(self, seconds):
+        self.timer = seconds
+
+    def quit(self):
+        self.quitting = True
@@ -0,0 +1,93 @@
+import numpy
+
+
+class TimeSpan(object):
+    """Time span (seconds as a float)."""
+
+    def __init__(self, seconds=0.0):
+        self._seconds = float(seconds)
+
+    def length(self):
+        return self._seconds
+
+    def __float__(self):
+        return self._seconds
+
+    def __add__(self, other):
+        return self.__class__(self._seconds + float(other))
+
+    def __sub__(self, other):
+        return TimeSpan(self._seconds - float(other))
+
+    def __lt__(self, other):
+        return self._seconds < float(other)
+
+    def __gt__(self, other):
+        return self._seconds > float(other)
+
+    def __le__(self, other):
+        return self._seconds <= float(other)
+
+    def __ge__(self, other):
+        return self._seconds >= float(other)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._seconds)
+
+
+class Time(TimeSpan):
+    """Absolute time (seconds since the epoch as a float). seconds() returns
+    the whole float and microseconds() 0, so that a time sent as (seconds,
+    microseconds) is rebuilt exactly."""
+
+    def __init__(self, seconds=0.0, microseconds=0):
+        TimeSpan.__init__(self, seconds + microseconds / 1e6)
+
+    def seconds(self):
+        return self._seconds
+
+    def microseconds(self):
+        return 0
+
+    def __sub__(self, other):
+        if isinstance(other, Time):
+            return TimeSpan(self._seconds - other._seconds)
+        return Time(self._seconds - float(other))
+
+    def toString(self, fmt):
+        return '%020.6f' % self._seconds
+
+    @staticmethod
+    def GMT():
+        return Time(0.0)
+
+
+class DoubleArrayT(object):
+    def __init__(self):
+        self._values = numpy.zeros(0)
+
+    def resize(self, size):
+        self._values = numpy.zeros(size)
+
+    def set(self, pos, value):
+        self._values[pos] = value
+
+    def get(self, pos):
+        return float(self._values[pos])
+
+    def setNumpy(self, values):
+        self._values = numpy.array(values, dtype=numpy.double)
+
+    def numpy(self):
+        return self._values.copy()
+
+    def size(self):
+        return len(self._values)
+
+
+class Array(object):
+    DOUBLE = 'double'
+
+
+class Record(object):
+    SAVE_RAW = 1
@@ -0,0 +1,90 @@
+import seiscomp3.Core
+
+NOT_EXISTING = 'not existing'
+
+
+class _Value(object):
+    def __init__(self, value):
+        self._value = value
+
+    def value(self):
+        return self._value
+
+
+class PublicObject(object):
+    def __init__(self, publicID):
+        self._publicID = publicID
+
+    def publicID(self):
+        return self._publicID
+
+    @classmethod
+    def Cast(cls, obj):
+        return obj if isinstance(obj, cls) else None
+
+
+class Event(PublicObject):
+    def __init__(self, publicID, preferredOriginID, preferredMagnitudeID='',
+                 type=None):
+        PublicObject.__init__(self, publicID)
+        self._preferredOriginID = preferredOriginID
+        self._preferredMagnitudeID = preferredMagnitudeID
+        self._type = type
+
+    def preferredOriginID(self):
+        return self._preferredOriginID
+
+    def preferredMagnitudeID(self):
+        return self._preferredMagnitudeID
+
+    def type(self):
+        if self._type is None:
+            raise ValueError("Event.type is not set")
+        return self._type
+
+
+class Origin(PublicObject):
+    def __init__(self, publicID, time, lat, lon, depth):
+        PublicObject.__init__(self, publicID)
+        self._time = time
+        self._lat = lat
+        self._lon = lon
+        self._depth = depth
+
+    def time(self):
+        return _Value(seiscomp3.Core.Time(self._time))
+
+    def latitude(self):
+        return _Value(self._lat)
+
+    def longitude(self):
+        return _Value(self._lon)
+
+    def depth(self):
+        return _Value(self._depth)
+
+    def magnitudeCount(self):
+        return 0
+
+
+class Magnitude(PublicObject):
+    def __init__(self, publicID, value):
+        PublicObject.__init__(self, publicID)
+        self._value = value
+
+    def magnitude(self):
+        return _Value(self._value)
+
+
+class PublicObjectRingBuffer(object):
+    """Cache of the objects received (they are never loaded from the
+    database)."""
+
+    def __init__(self, query, size):
+        self._objects = dict()
+
+    def feed(self, obj):
+        self._objects[obj.publicID()] = obj
+
+    def get(self, cls, publicID):
+        return cls.Cast(self._objects.get(publicID))
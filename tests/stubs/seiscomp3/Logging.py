@@ -0,0 +1,14 @@
+# Messages logged, so that the tests can check them
+messages = []
+
+
+def _log(level):
+    def log(msg):
+        messages.append((level, msg))
+    return log
+
+
+debug = _log('debug')
+info = _log('info')
+warning = _log('warning')
+error = _log('error')
@@ -0,0 +1,35 @@
+import math
+
+
+def delazi(lat1, lon1, lat2, lon2):
+    """Distance (degrees) on a sphere. The azimuths are not calculated."""
+
+    r = math.radians
+    c = math.sin(r(lat1)) * math.sin(r(lat2)) + \
+        math.cos(r(lat1)) * math.cos(r(lat2)) * math.cos(r(lon2 - lon1))
+    return math.degrees(math.acos(max(-1.0, min(1.0, c)))), 0.0, 0.0
+
+
+class InPlaceFilterD(object):
+    """First order highpass, whatever filter is requested."""
+
+    @staticmethod
+    def Create(definition):
+        return InPlaceFilterD()
+
+    def __init__(self):
+        self._x1 = 0.0
+        self._y1 = 0.0
+        self.sps = None
+
+    def setSamplingFrequency(self, sps):
+        self.sps = sps
+
+    def apply(self, array):
+        values = array._values
+        for i in range(len(values)):
+            x = values[i]
+            y = 0.9 * self._y1 + x - self._x1
+            self._x1 = x
+            self._y1 = y
+            values[i] = y
@@ -0,0 +1,8 @@
+"""Minimal stand-in for the SeisComP3 Python API, enough to run the
+processing of scxxlmag with synthetic data (see tests/support.py).
+
+It is not a simulation of SeisComP3: times are plain floats, the filter is a
+simple recursive highpass and the travel times grow linearly with the
+distance. The results of the tests are only meaningful compared with the
+same stub.
+"""
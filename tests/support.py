@@ -0,0 +1,291 @@
+"""Common code for the tests of scxxlmag.
+
+The tests run without SeisComP3: the directory "stubs" provides a minimal
+version of the seiscomp3 API (and of the seispy magnitude function) and it
+is placed first in the path, so that the results are the same whether
+SeisComP3 is installed or not. The functions below create a synthetic event
+with its inventory and the records of a few streams, and feed them to a
+processor like scxxlmag-compute does.
+
+Run the tests from the root directory of the package with
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import contextlib
+from StringIO import StringIO
+
+import numpy
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+rootDir = os.path.dirname(testDir)
+dataDir = os.path.join(testDir, 'data')
+
+sys.path.insert(0, rootDir)
+sys.path.insert(0, os.path.join(testDir, 'stubs'))
+
+import seiscomp3.Core
+
+
+class Value(object):
+    def __init__(self, value):
+        self._value = value
+
+    def value(self):
+        return self._value
+
+
+class Origin(object):
+    def __init__(self, time, lat, lon, depth):
+        self._time = time
+        self._lat = lat
+        self._lon = lon
+        self._depth = depth
+
+    def time(self):
+        return Value(seiscomp3.Core.Time(self._time))
+
+    def latitude(self):
+        return Value(self._lat)
+
+    def longitude(self):
+        return Value(self._lon)
+
+    def depth(self):
+        return Value(self._depth)
+
+
+class Station(object):
+    def __init__(self, lat, lon, elevation=0.0):
+        self._lat = lat
+        self._lon = lon
+        self._elevation = elevation
+
+    def latitude(self):
+        return self._lat
+
+    def longitude(self):
+        return self._lon
+
+    def elevation(self):
+        return self._elevation
+
+
+class Stream(object):
+    def __init__(self, gain):
+        self._gain = gain
+
+    def gain(self):
+        return self._gain
+
+    def code(self):
+        return 'BHZ'
+
+
+class Array(object):
+    def __init__(self, values):
+        self.values = values
+
+    def numpy(self):
+        return self.values
+
+
+class Record(object):
+    def __init__(self, streamID, start, sps, values):
+        self._streamID = streamID
+        self._start = start
+        self._sps = sps
+        self._data = Array(values)
+
+    def streamID(self):
+        return self._streamID
+
+    def startTime(self):
+        return seiscomp3.Core.Time(self._start)
+
+    def endTime(self):
+        return seiscomp3.Core.Time(self._start +
+                                   len(self._data.values) / self._sps)
+
+    def samplingFrequency(self):
+        return self._sps
+
+    def data(self):
+        return self._data
+
+    def raw(self):
+        return None
+
+
+def origin():
+    """Origin of the synthetic event."""
+
+    return Origin(1000.0, 0.0, 0.0, 30.0)
+
+
+def inventory(nsta=12):
+    """Inventory with the same structure as the one filtered by
+    scxxlmag-compute (see invsnapshot): one vertical stream per station
+    along the equator, plus a station too far to be used."""
+
+    inv = dict()
+    for i in range(nsta):
+        net, sta, loc = 'XX', 'S%02d' % i, ''
+        inv[net] = object()
+        inv[net, sta] = Station(0.0, 8.0 + i * 7.0)
+        inv[net, sta, loc] = object()
+        inv[net, sta, loc, 'BHZ'] = Stream(1e9 * (1 + i))
+    inv['XX', 'FAR'] = Station(0.0, 150.0)
+    inv['XX', 'FAR', ''] = object()
+    inv['XX', 'FAR', '', 'BHZ'] = Stream(1.0)
+    return inv
+
+
+class InventoryItem(object):
+    """Object of a SC3 inventory (network, station, location or stream)
+    with the values given. The ones not given raise ValueError, as the SC3
+    objects do when a value is not set."""
+
+    def __init__(self, children=(), **values):
+        self.children = list(children)
+        self.values = values
+
+    def __getattr__(self, name):
+        values = self.__dict__['values']
+        if name in ('start', 'end', 'code', 'latitude', 'longitude',
+                    'elevation', 'gain'):
+            if name not in values:
+                def missing():
+                    raise ValueError("%s is not set" % name)
+                return missing
+            return lambda: values[name]
+        if name.endswith('Count'):
+            return lambda: len(self.children)
+        if name in ('network', 'station', 'sensorLocation', 'stream'):
+            return lambda pos: self.children[pos]
+        raise AttributeError(name)
+
+
+def sc3Inventory(nsta=12):
+    """SC3 inventory from which scxxlmag-compute prepares inventory(nsta)
+    (without epochs, so always operational)."""
+
+    inv = inventory(nsta)
+    stations = []
+    for key, s in sorted(inv.items()):
+        if not isinstance(key, tuple) or len(key) != 2:
+            continue
+        stream = InventoryItem(code='BHZ', gain=inv[key + ('', 'BHZ')].gain())
+        location = InventoryItem([stream], code='')
+        stations.append(InventoryItem([location], code=key[1],
+                                      latitude=s.latitude(),
+                                      longitude=s.longitude(),
+                                      elevation=s.elevation()))
+    return InventoryItem([InventoryItem(stations, code='XX')])
+
+
+def records(timeWindows, inv, seed=1, reclen=100, sps=20.0, maxLength=400):
+    """Records with noise and a P wave 50 seconds after the start of the
+    time window of every stream. Returns a list of (arrival, record),
+    sorted by arrival time, and a record covers reclen samples."""
+
+    sps = float(sps)
+    rng = numpy.random.RandomState(seed)
+    recs = list()
+    for key, (tFrom, tTo) in sorted(timeWindows.items()):
+        n = min(int((tTo - tFrom).length() * sps), int(maxLength * sps))
+        signal = rng.normal(0, 5, n) + 300
+        pos = int(50 * sps)
+        dur = int(rng.uniform(20, 60) * sps)
+        seg = numpy.arange(dur)
+        signal[pos:pos + dur] += 2000 * rng.uniform(0.5, 2) * \
+            numpy.sin(2 * numpy.pi * 2 * seg / sps + rng.uniform(0, 1)) * \
+            numpy.exp(-seg / (dur / 3.0)) + rng.normal(0, 200, dur)
+        signal = signal * inv[key].gain() * 1e-9
+        streamID = '.'.join(key)
+        for k in range(0, n, reclen):
+            start = tFrom.length() + k / sps
+            recs.append((start, streamID,
+                         Record(streamID, start, sps,
+                                numpy.array(signal[k:k + reclen],
+                                            dtype=numpy.float64))))
+    recs.sort(key=lambda r: (r[0], r[1]))
+    return [(t, rec) for t, sid, rec in recs]
+
+
+def withGaps(recs, seed):
+    """Drop about 1 % of the records, in groups of up to 4 records."""
+
+    rng = numpy.random.RandomState(seed)
+    drop = set()
+    for i in range(len(recs)):
+        if rng.rand() < 0.01:
+            drop.update(range(i, i + rng.randint(1, 5)))
+    return [r for i, r in enumerate(recs) if i not in drop]
+
+
+def prepare(processor, inv=None):
+    """Set the event and the inventory of the processor and return the
+    records of its time windows."""
+
+    inv = inventory() if inv is None else inv
+    processor.setEvent(origin())
+    processor._filterInventory(inv)
+    processor.timeWindows()
+    return records(processor.timeWinDict, inv)
+
+
+def feed(processor, recs, period=20.0):
+    """Feed the records to the processor and call update() every period
+    seconds of (arrival) time, and finalize() at the end."""
+
+    flush = getattr(processor, 'flush', lambda: None)
+    last = None
+    for t, rec in recs:
+        processor.feed(rec)
+        if last is None or t - last >= period:
+            flush()
+            processor.update()
+            last = t
+    flush()
+    processor.update()
+    processor.finalize()
+
+
+@contextlib.contextmanager
+def workDir():
+    """Run in a temporary directory (the output files of the processors are
+    written in the current directory by default)."""
+
+    cwd = os.getcwd()
+    path = tempfile.mkdtemp(prefix='scxxlmag-test-')
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def captured():
+    """Capture what is printed to stdout."""
+
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        yield sys.stdout
+    finally:
+        sys.stdout = stdout
+
+
+def summaryLines(text, name='mBc'):
+    """Lines with the partial and final magnitudes printed by a processor."""
+
+    return [line for line in text.splitlines()
+            if line.startswith(name + ' ') or
+            line.startswith(name + '(final)')]
@@ -0,0 +1,48 @@
+"""Reprocessing of a list of events in parallel."""
+
+import os
+import imp
+import unittest
+
+import support
+
+batch = imp.load_source('scxxlmag_batch',
+                        os.path.join(support.rootDir, 'scxxlmag-batch.py'))
+
+
+class TestArguments(unittest.TestCase):
+
+    def testAbsolutePaths(self):
+        with support.workDir() as path:
+            # The files do not need to exist
+            args = ['--inventory-snapshot', 'inventory.npz',
+                    '--ttt-grid=grid.npz', '-b', 'blacklist.txt',
+                    '--debug', '--hold-time', '30', 'inventory.xml']
+            self.assertEqual(batch.absolutePaths(args),
+                             ['--inventory-snapshot',
+                              os.path.join(path, 'inventory.npz'),
+                              '--ttt-grid=%s' % os.path.join(path,
+                                                             'grid.npz'),
+                              '-b', os.path.join(path, 'blacklist.txt'),
+                              '--debug', '--hold-time', '30',
+                              'inventory.xml'])
+
+    def testResults(self):
+        with support.workDir():
+            with open('events.txt', 'w') as fout:
+                fout.write('# events\nevt1 2010-02-27\n\n evt2 # second\n')
+            self.assertEqual(batch.readEventList('events.txt'),
+                             ['evt1', 'evt2'])
+            with open('evt1.evid', 'w') as fout:
+                fout.write('mBc(final) Mag(avg):  8.1 Dur(3/4):  120.00 '
+                           '(3 streams)\n'
+                           'mBc(final) Mag(avg):  8.30 Dur(3/4):  150.50 '
+                           '(25 streams)\n')
+            self.assertEqual(batch.parseResult('evt1.evid'),
+                             (8.3, 150.5, 25))
+            open('evt2.evid', 'w').close()
+            self.assertEqual(batch.parseResult('evt2.evid'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""Compiled matcher for a list of stream patterns."""
+
+import fnmatch
+import os
+import unittest
+
+import numpy
+
+import support
+import blacklist
+
+
+class TestBlacklist(unittest.TestCase):
+
+    patterns = ["GE.APE..BHZ", "GE.*.*.BH?", "G?.MORC..*", "*.*.00.HHZ",
+                "IU.[AB]*..LHZ", "XX", "II.S[!0-9]*.10.*", ""]
+
+    def testSameAsFnmatch(self):
+        rng = numpy.random.RandomState(1)
+        nets = ["GE", "GR", "IU", "II", "XX"]
+        stations = ["APE", "MORC", "ANMO", "BFO", "S1", "SUR"]
+        locs = ["", "00", "10"]
+        channels = ["BHZ", "BHN", "HHZ", "LHZ", "SHZ"]
+        bl = blacklist.Blacklist(self.patterns)
+        self.assertEqual(len(bl), len(self.patterns) - 1)
+        for i in range(2000):
+            streamID = '.'.join([nets[rng.randint(len(nets))],
+                                 stations[rng.randint(len(stations))],
+                                 locs[rng.randint(len(locs))],
+                                 channels[rng.randint(len(channels))]])
+            self.assertEqual(streamID in bl,
+                             any(fnmatch.fnmatchcase(streamID, p)
+                                 for p in bl), streamID)
+        self.assertTrue("XX" in bl)
+        self.assertFalse("XX.S1..BHZ" in blacklist.Blacklist())
+
+    def testReload(self):
+        with support.workDir():
+            with open('blacklist.txt', 'w') as fout:
+                fout.write("GE.*.*.BH?\n\n")
+            bl = blacklist.Blacklist.fromFile('blacklist.txt')
+            self.assertEqual(list(bl), ["GE.*.*.BH?"])
+            self.assertTrue("GE.APE..BHZ" in bl)
+            self.assertFalse(bl.reload())
+
+            with open('blacklist.txt', 'w') as fout:
+                fout.write("  IU.ANMO.00.BHZ \n")
+            # The size changed, so the time of modification does not matter
+            self.assertTrue(bl.reload())
+            self.assertEqual(list(bl), ["IU.ANMO.00.BHZ"])
+            self.assertFalse("GE.APE..BHZ" in bl)
+            self.assertTrue("IU.ANMO.00.BHZ" in bl)
+
+            os.remove('blacklist.txt')
+            self.assertRaises(OSError, bl.reload)
+            self.assertRaises(OSError, blacklist.Blacklist.fromFile,
+                              'blacklist.txt')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+"""Processing of the events received by a long-running application."""
+
+import sys
+import threading
+import time
+import unittest
+
+import support
+import dispatcher
+
+
+class Processor:
+    """Processor which rejects a stream with its first record."""
+
+    def __init__(self, rejected=None):
+        self.rejected = rejected
+        self.quarantine = set()
+        self.onReject = None
+        self.records = []
+        self.finalized = False
+
+    def feed(self, rec):
+        self.records.append(rec)
+        streamID = rec.streamID()
+        if streamID == self.rejected and streamID not in self.quarantine:
+            self.quarantine.add(streamID)
+            self.onReject(streamID)
+
+    def setEvent(self, origin):
+        pass
+
+    def flush(self):
+        pass
+
+    def update(self):
+        pass
+
+    def finalize(self):
+        self.finalized = True
+
+
+class Source:
+    """Records of two streams. The records after the first one of the
+    rejected stream are only read once it was rejected."""
+
+    def __init__(self, job, count=10):
+        self.job = job
+        self.count = count
+        self.removed = []
+
+    def __iter__(self):
+        for i in range(self.count):
+            for station in ('S01', 'S02'):
+                yield support.Record('XX.%s..BHZ' % station, 100.0 + i, 20.0,
+                                     [0.0])
+            while i == 0 and not self.job.processors['b'].quarantine:
+                time.sleep(0.01)
+
+    def removeStream(self, streamID):
+        self.removed.append((streamID, threading.current_thread().name))
+
+
+class TestEventJob(unittest.TestCase):
+
+    def wait(self, job):
+        while not job.finished():
+            time.sleep(0.01)
+        job.finalize()
+
+    def testRejected(self):
+        # A stream rejected by all the processors is removed from the source
+        # by the acquisition thread
+        processors = dict(a=Processor('XX.S01..BHZ'),
+                          b=Processor('XX.S01..BHZ'))
+        job = dispatcher.EventJob('event', processors, [])
+        source = Source(job)
+        job.start(source)
+        self.wait(job)
+
+        self.assertEqual(source.removed, [('XX.S01..BHZ', 'event')])
+        self.assertEqual(job.discarded, set(['XX.S01..BHZ']))
+        # The first record of the stream and all the other stream
+        for name in processors:
+            self.assertEqual([rec.streamID() for rec in
+                              processors[name].records],
+                             ['XX.S01..BHZ'] + ['XX.S02..BHZ'] * 10)
+            self.assertTrue(processors[name].finalized)
+        self.assertEqual(job.records, 11)
+
+    def testRejectedByOne(self):
+        # The stream is still needed by the other processor
+        processors = dict(a=Processor(), b=Processor('XX.S01..BHZ'))
+        job = dispatcher.EventJob('event', processors, [])
+        source = Source(job)
+        job.start(source)
+        self.wait(job)
+
+        self.assertEqual(source.removed, [])
+        self.assertEqual(len(processors['a'].records), 20)
+
+
+class TestEventDispatcher(unittest.TestCase):
+
+    def testEvents(self):
+        created = []
+
+        def createJob(eventID, origin):
+            if eventID == 'broken':
+                raise ValueError("cannot create the processors")
+            job = dispatcher.EventJob(eventID, dict(a=Processor()), [])
+            created.append(job)
+            return job
+
+        stderr = sys.stderr
+        with support.captured() as out:
+            sys.stderr = out
+            try:
+                events = dispatcher.EventDispatcher(
+                    createJob, lambda windows: [], minMagnitude=5.0)
+                self.assertEqual(events.setEvent('small', None, 4.9), None)
+                self.assertEqual(events.setEvent('unknown', None), None)
+                self.assertEqual(events.setEvent('broken', None, 6.0), None)
+                job = events.setEvent('big', None, 6.0)
+                self.assertTrue(job is not None)
+                # Updates of the event use the same job
+                self.assertTrue(events.setEvent('big', None, 6.1) is job)
+                while job._thread.is_alive():
+                    time.sleep(0.01)
+                self.assertEqual(events.update(), ['big'])
+                self.assertEqual(events.setEvent('big', None, 6.2), None)
+                # The event which could not be processed is not tried again
+                self.assertEqual(events.setEvent('broken', None, 6.0), None)
+            finally:
+                sys.stderr = stderr
+
+        self.assertTrue('cannot create the processors' in out.getvalue())
+        self.assertEqual(len(created), 1)
+        self.assertTrue(created[0].processors['a'].finalized)
+        self.assertEqual(events.done, set(['big', 'broken']))
+        self.assertEqual(events.jobs, dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
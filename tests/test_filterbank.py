@@ -0,0 +1,151 @@
+"""Filters applied to many streams at once.
+
+The filters of SeisComP3 are not available here (the stub is a simple
+highpass), so the comparison with them is done by running filterbank.py in
+a SeisComP3 environment. These tests check the design of the filters
+against the response of the analog Butterworth filters, and that the
+filtered signal does not depend (up to a relative 1E-9) on how it is split
+in blocks.
+"""
+
+import unittest
+
+import numpy
+
+import support
+import filterbank
+import mBc
+from test_mbc import cases, run
+
+# Relative difference accepted between the filtered signal in blocks of any
+# size and the signal filtered sample by sample
+tolerance = 1E-9
+
+
+def response(sos, freqs, sps):
+    """Magnitude of the response of the second-order sections."""
+
+    z = numpy.exp(2j * numpy.pi * numpy.asarray(freqs) / sps)
+    h = numpy.ones(len(z), dtype=complex)
+    for b0, b1, b2, a0, a1, a2 in sos:
+        h *= (b0 + b1 / z + b2 / z ** 2) / (a0 + a1 / z + a2 / z ** 2)
+    return numpy.abs(h)
+
+
+def analog(band, freqs, sps):
+    """Magnitude of the response of the analog Butterworth filter at the
+    frequencies prewarped by the bilinear transform."""
+
+    kind, order, corners = filterbank.parseBand(band)
+    w = numpy.tan(numpy.pi * numpy.asarray(freqs) / sps)
+    wc = [numpy.tan(numpy.pi * f / sps) for f in corners]
+    if kind == 'lowpass':
+        x = w / wc[0]
+    elif kind == 'highpass':
+        x = wc[0] / w
+    else:
+        x = (w * w - wc[0] * wc[1]) / (w * (wc[1] - wc[0]))
+    return 1.0 / numpy.sqrt(1.0 + x ** (2 * order))
+
+
+class TestDesign(unittest.TestCase):
+
+    def testResponse(self):
+        for band in ("BW(4, 1, 3)", "BW(2, 0.5, 8)", "BW(3, 0.01, 0.1)",
+                     "BW_LP(4, 2)", "BW_LP(5, 0.1)", "BW_HP(4, 1)",
+                     "BW_HP(3, 0.02)"):
+            for sps in (20.0, 40.0, 100.0):
+                freqs = numpy.linspace(0.001, sps / 2 * 0.999, 500)
+                sos = filterbank.butterworth(band, sps)
+                numpy.testing.assert_allclose(
+                    response(sos, freqs, sps), analog(band, freqs, sps),
+                    rtol=1E-6, atol=1E-9, err_msg='%s %g' % (band, sps))
+
+    def testWrongBands(self):
+        for band in ("BW(4, 3, 1)", "BW(4, 1)", "BW_LP(0, 1)", "BW_HP(2.5, 1)",
+                     "XX(4, 1, 3)", "BW(4, a, 3)"):
+            self.assertRaises(ValueError, filterbank.parseBand, band)
+        self.assertRaises(ValueError, filterbank.butterworth, "BW(4, 1, 12)",
+                          20.0)
+
+
+class TestFilterBank(unittest.TestCase):
+
+    def setUp(self):
+        # The numpy implementation is tested even if scipy is installed
+        self.sosfilt = filterbank._sosfilt
+        filterbank._sosfilt = None
+
+    def tearDown(self):
+        filterbank._sosfilt = self.sosfilt
+
+    def testBlocks(self):
+        rng = numpy.random.RandomState(1)
+        band = "BW(4, 1, 3)"
+        rates = [20.0, 40.0, 20.0, 100.0, 20.0, 40.0]
+        signals = [rng.normal(0, 1, 3000) + 300 for sps in rates]
+        expected = []
+        for sps, signal in zip(rates, signals):
+            sos = filterbank.butterworth(band, sps)
+            state = numpy.zeros((len(sos), 1, 2))
+            expected.append(filterbank._filterSamples(sos, signal[None, :],
+                                                      state)[0])
+
+        # The streams are filtered together in blocks of random sizes
+        # (including empty ones and a single sample)
+        for i in range(5):
+            bank = filterbank.FilterBank()
+            streams = [bank.addStream(sps, [band]) for sps in rates]
+            pos = [0] * len(rates)
+            result = [[] for sps in rates]
+            while min(pos) < 3000:
+                sizes = [min(rng.choice([0, 1, 7, 32, 33, 100, 517]),
+                             3000 - p) for p in pos]
+                blocks = [s[p:p + n] for s, p, n in zip(signals, pos, sizes)]
+                for r, y in zip(result, bank.filter(band, streams, blocks)):
+                    r.append(y)
+                pos = [p + n for p, n in zip(pos, sizes)]
+
+            for r, e in zip(result, expected):
+                r = numpy.concatenate(r)
+                self.assertEqual(len(r), len(e))
+                self.assertTrue(numpy.max(numpy.abs(r - e)) <=
+                                tolerance * numpy.sqrt(numpy.mean(e * e)))
+            self.assertEqual(bank.samples, 3000 * len(rates))
+
+    def testReset(self):
+        bank = filterbank.FilterBank()
+        stream = bank.addStream(20.0, ["BW(4, 1, 3)"])
+        signal = numpy.random.RandomState(2).normal(0, 1, 200)
+        first = bank.filter("BW(4, 1, 3)", [stream], [signal])[0]
+        bank.reset(stream)
+        again = bank.filter("BW(4, 1, 3)", [stream], [signal])[0]
+        numpy.testing.assert_allclose(again, first, rtol=0, atol=1E-12)
+
+    def testWrongStream(self):
+        bank = filterbank.FilterBank()
+        self.assertRaises(ValueError, bank.addStream, 4.0, ["BW(4, 1, 3)"])
+
+
+class TestPreprocessing(unittest.TestCase):
+
+    def values(self, txt):
+        return [[float(v) for v in line.split()[:2]]
+                for line in txt.splitlines()]
+
+    def testBatches(self):
+        # The magnitudes do not depend on how the records are batched
+        # (beyond the last digits)
+        for case in cases:
+            results = []
+            for size in (0, 500):
+                def setup(p):
+                    p.input.filterBank = filterbank.FilterBank()
+                    p.input.batchSize = size
+                results.append(self.values(run(case, setup)[1]))
+            numpy.testing.assert_allclose(results[1], results[0], rtol=1E-9,
+                                          err_msg=str(case))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+"""Compact snapshot of the inventory."""
+
+import unittest
+
+import support
+import seiscomp3.Core
+import seiscomp3.Logging
+import invsnapshot
+
+
+def epoch(start, end=None):
+    values = dict(start=seiscomp3.Core.Time(start))
+    if end is not None:
+        values['end'] = seiscomp3.Core.Time(end)
+    return values
+
+
+def inventory():
+    Item = support.InventoryItem
+
+    def station(code, streams, **values):
+        values.setdefault('latitude', 10.0)
+        values.setdefault('longitude', 20.0)
+        values.setdefault('elevation', 100.0)
+        if values['elevation'] is None:
+            del values['elevation']
+        return Item([Item([Item(code=cha, gain=1e9, **epoch(0.0))
+                           for cha in streams], code='', **epoch(0.0))],
+                    code=code, **values)
+
+    return Item([
+        Item([station('A', ['BHZ', 'BHN'], **epoch(0.0)),
+              # Closed epoch
+              station('B', ['BHZ'], **epoch(0.0, 500.0)),
+              # Without elevation
+              station('C', ['BHZ'], elevation=None, **epoch(0.0)),
+              # Without epoch: always operational
+              station('D', ['BHZ'])], code='XX'),
+        Item([station('E', ['HHZ'], **epoch(0.0))], code='YY')])
+
+
+class TestInventorySnapshot(unittest.TestCase):
+
+    def testInventory(self):
+        inv = inventory()
+        # A stream without gain
+        del inv.children[1].children[0].children[0].children[0].values['gain']
+
+        snapshot = invsnapshot.InventorySnapshot.fromInventory(inv, 'key')
+        with support.workDir():
+            snapshot.save('inventory.npz')
+            self.assertEqual(
+                invsnapshot.InventorySnapshot.loadKey('inventory.npz'), 'key')
+            self.assertEqual(
+                invsnapshot.InventorySnapshot.loadKey('missing.npz'), None)
+            snapshot = invsnapshot.InventorySnapshot.load('inventory.npz')
+
+        del seiscomp3.Logging.messages[:]
+        result = snapshot.inventory(1000.0, lambda s: s == 'XX.A..BHN')
+        keys = [k for k in result if isinstance(k, tuple)]
+        self.assertEqual(sorted(k for k in keys if len(k) == 4),
+                         [('XX', 'A', '', 'BHZ'), ('XX', 'D', '', 'BHZ'),
+                          ('YY', 'E', '', 'HHZ')])
+        self.assertEqual(sorted(k for k in keys if len(k) == 2),
+                         [('XX', 'A'), ('XX', 'D'), ('YY', 'E')])
+        self.assertEqual(sorted(k for k in result if isinstance(k, str)),
+                         ['XX', 'YY'])
+        self.assertTrue(('warning', 'XX.C has no coordinates or elevation, '
+                         'skipped') in seiscomp3.Logging.messages)
+
+        station = result['XX', 'A']
+        self.assertEqual((station.code(), station.latitude(),
+                          station.longitude(), station.elevation()),
+                         ('A', 10.0, 20.0, 100.0))
+        self.assertEqual(result['XX', 'A', '', 'BHZ'].gain(), 1e9)
+        self.assertRaises(ValueError, result['YY', 'E', '', 'HHZ'].gain)
+
+        # The closed epoch
+        self.assertTrue(('XX', 'B', '', 'BHZ') in snapshot.inventory(100.0))
+
+    def testKey(self):
+        with support.workDir():
+            with open('inventory.xml', 'w') as fout:
+                fout.write('<inventory/>')
+            key = invsnapshot.inventoryKey('inventory.xml')
+            self.assertEqual(invsnapshot.inventoryKey('inventory.xml'), key)
+            with open('inventory.xml', 'w') as fout:
+                fout.write('<inventory></inventory>')
+            self.assertNotEqual(invsnapshot.inventoryKey('inventory.xml'),
+                                key)
+        self.assertEqual(invsnapshot.inventoryKey(None), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
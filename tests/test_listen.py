@@ -0,0 +1,102 @@
+"""Listen mode of scxxlmag-compute: the events received from the messaging
+system (here, passed to addObject and updateObject by the test) are
+processed with the records of their own source."""
+
+import os
+import imp
+import time
+import unittest
+
+import support
+import seiscomp3.Client
+import seiscomp3.DataModel as DataModel
+from test_mbc import cases, expected
+
+compute = imp.load_source('scxxlmag_compute',
+                          os.path.join(support.rootDir,
+                                       'scxxlmag-compute.py'))
+
+
+def application(*args):
+    app = compute.ProcessorApp(0, ['scxxlmag-compute.py'] + list(args))
+    app.createCommandLineDescription()
+    app.validateParameters()
+    return app
+
+
+class TestListen(unittest.TestCase):
+
+    def testEvents(self):
+        nsta, seed, reclen, sps = case = cases[0]
+        seiscomp3.Client.Inventory.Instance().setInventory(
+            support.sc3Inventory(nsta))
+        # Time windows of the sources opened
+        requested = []
+
+        def openSource(windows):
+            timeWindows = dict(((net, sta, loc, cha), (t_from, t_to))
+                               for t_from, t_to, net, sta, loc, cha in windows)
+            requested.append(sorted(timeWindows))
+            return [rec for t, rec in
+                    support.records(timeWindows, support.inventory(nsta),
+                                    seed, reclen, sps)]
+
+        with support.workDir():
+            app = application('--listen', '--min-magnitude', '6')
+            self.assertTrue(app.messagingEnabled)
+            # The records are not read from a RecordStream
+            app._openSource = openSource
+            self.assertTrue(app.init())
+            jobs = app._dispatcher.jobs
+
+            with support.captured():
+                # The event is processed once its preferred magnitude is
+                # known
+                app.addObject('', DataModel.Origin('Origin/1', 1000.0, 0.0,
+                                                   0.0, 30.0))
+                app.addObject('', DataModel.Event('Event/big', 'Origin/1',
+                                                  'Magnitude/1'))
+                self.assertEqual(jobs, dict())
+                app.addObject('', DataModel.Magnitude('Magnitude/1', 7.5))
+                self.assertEqual(sorted(jobs), ['Event/big'])
+
+                # Small and fake events are not processed
+                app.addObject('', DataModel.Origin('Origin/2', 1100.0, 10.0,
+                                                   10.0, 10.0))
+                app.addObject('', DataModel.Magnitude('Magnitude/2', 5.0))
+                app.addObject('', DataModel.Event('Event/small', 'Origin/2',
+                                                  'Magnitude/2'))
+                app.addObject('', DataModel.Event(
+                    'Event/fake', 'Origin/2', 'Magnitude/1',
+                    DataModel.NOT_EXISTING))
+                self.assertEqual(sorted(jobs), ['Event/big'])
+
+                # An update of the event keeps the same job
+                job = jobs['Event/big']
+                app.updateObject('', DataModel.Event('Event/big', 'Origin/1',
+                                                     'Magnitude/1'))
+                self.assertTrue(jobs['Event/big'] is job)
+
+                while jobs:
+                    app.handleTimeout()
+                    time.sleep(0.01)
+                app.handleClose()
+
+            # The small event would be processed if its magnitude grew
+            self.assertEqual(app._dispatcher.done, set(['Event/big']))
+            self.assertEqual(len(requested), 1)
+            self.assertEqual(len(requested[0]), nsta)
+            with open(os.path.join('Event_big', 'mBc.txt')) as fstr:
+                self.assertEqual(fstr.read(), expected(case, 'txt'))
+
+    def testWithoutEvent(self):
+        # The event is optional in listen mode
+        with support.workDir():
+            app = application('--listen')
+            self.assertTrue(app.init())
+            self.assertEqual(app.eventID, None)
+            app.handleClose()
+
+
+if __name__ == '__main__':
+    unittest.main()
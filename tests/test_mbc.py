@@ -0,0 +1,150 @@
+"""Equivalence of mBc with the original implementation.
+
+The files in data/ were written by the implementation of mBc.Processor
+before the processing was vectorized (one DoubleArrayT copy and one
+__checkMax call per sample), fed with the records of support.records(). For
+every case there are the partial and final magnitudes printed (.out) and the
+final mBc.txt (.txt). The current implementation must reproduce them
+exactly, with all the options that should not change the results. The
+files named mBc-gaps-* were written with about 1 % of the records dropped
+(support.withGaps with seed 5), so by default the gaps must be handled as
+before.
+"""
+
+import os
+import unittest
+
+import support
+import mBc
+
+cases = [(12, 1, 100, 20), (20, 2, 37, 40), (8, 3, 512, 100)]
+
+
+def expected(case, ext, prefix='mBc'):
+    name = '%s-%d-%d-%d-%d.%s' % ((prefix,) + case + (ext,))
+    with open(os.path.join(support.dataDir, name)) as fstr:
+        return fstr.read()
+
+
+def run(case, setup=None, processor=None, gaps=None):
+    """Process a case and return what was printed and the final mBc.txt.
+    Some records are dropped if gaps (a seed) is given."""
+
+    nsta, seed, reclen, sps = case
+    with support.workDir():
+        p = mBc.Processor() if processor is None else processor
+        inv = support.inventory(nsta)
+        p.setEvent(support.origin())
+        p._filterInventory(inv)
+        p.timeWindows()
+        recs = support.records(p.timeWinDict, inv, seed, reclen, sps)
+        if gaps is not None:
+            recs = support.withGaps(recs, gaps)
+        if setup is not None:
+            setup(p)
+        with support.captured() as out:
+            support.feed(p, recs)
+        with open('mBc.txt') as fstr:
+            txt = fstr.read()
+    return '\n'.join(support.summaryLines(out.getvalue())) + '\n', txt
+
+
+class TestEquivalence(unittest.TestCase):
+
+    def check(self, setup=None, partial=True):
+        for case in cases:
+            out, txt = run(case, setup)
+            if partial:
+                self.assertEqual(out, expected(case, 'out'), case)
+            else:
+                self.assertEqual(out.splitlines()[-1],
+                                 expected(case, 'out').splitlines()[-1], case)
+            self.assertEqual(txt, expected(case, 'txt'), case)
+
+    def testDefault(self):
+        self.check()
+
+    def testGaps(self):
+        # Short gaps are not filled and the streams with longer ones are
+        # discarded
+        for case in cases:
+            out, txt = run(case, gaps=5)
+            self.assertEqual(out, expected(case, 'out', 'mBc-gaps'), case)
+            self.assertEqual(txt, expected(case, 'txt', 'mBc-gaps'), case)
+
+    def testHoldTime(self):
+        # Without a hold time (the default of scxxlmag-compute) the records
+        # are processed as they arrive
+        def setup(p):
+            p.input.holdTime = 0.0
+        self.check(setup)
+
+    def testReorderBuffer(self):
+        # The records are held for a while, so only the final results are
+        # the same
+        def setup(p):
+            p.input.holdTime = 30.0
+        self.check(setup, partial=False)
+
+    def testRetention(self):
+        def setup(p):
+            p.input.retention = 60.0
+        self.check(setup)
+
+    def testBatches(self):
+        # The batches are processed before every update
+        for size in (1, 500, 100000):
+            def setup(p):
+                p.input.batchSize = size
+            self.check(setup)
+
+    def testDumpWaveforms(self):
+        for case in cases:
+            out, txt = run(case, processor=mBc.Processor(dumpWaveforms=True))
+            self.assertEqual(out, expected(case, 'out'), case)
+            self.assertEqual(txt, expected(case, 'txt'), case)
+
+
+class TestBatches(unittest.TestCase):
+
+    def testGaps(self):
+        # There are no results to compare with but they must not depend on
+        # the batches
+        for case in cases:
+            expected = run(case, gaps=5)
+            for size in (1, 700):
+                def setup(p):
+                    p.input.batchSize = size
+                self.assertEqual(run(case, setup, gaps=5), expected, case)
+
+    def testStatistics(self):
+        def setup(p):
+            p.input.batchSize = 500
+            processors.append(p)
+        processors = []
+        run(cases[0], setup)
+        preprocessor = processors[0].input
+        self.assertTrue(preprocessor.batches > 0)
+        self.assertTrue(preprocessor.maxBatch >= 500)
+        self.assertTrue(preprocessor.batchedBlocks >= preprocessor.batches)
+
+
+class TestOutput(unittest.TestCase):
+
+    def testOnlyMagnitudes(self):
+        # Nothing but the magnitudes is printed, the rest goes to the log
+        for case in cases:
+            nsta, seed, reclen, sps = case
+            with support.workDir():
+                p = mBc.Processor()
+                inv = support.inventory(nsta)
+                support.prepare(p, inv)
+                recs = support.records(p.timeWinDict, inv, seed, reclen, sps)
+                with support.captured() as out:
+                    support.feed(p, support.withGaps(recs, 5))
+            lines = out.getvalue().splitlines()
+            self.assertEqual(support.summaryLines(out.getvalue()), lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
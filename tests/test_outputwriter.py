@@ -0,0 +1,137 @@
+"""Writing of the output files in the background."""
+
+import sys
+import threading
+import unittest
+
+import support
+import outputwriter
+
+
+class Gate:
+    """Task which waits until the test lets it finish, to fill the queue."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.started.set()
+        self.release.wait()
+
+
+class TestOutputWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.done = []
+
+    def task(self, name):
+        self.done.append(name)
+
+    def blocked(self, writer):
+        """Block the thread of the writer until the gate is released."""
+
+        gate = Gate()
+        writer.submit(gate)
+        gate.started.wait()
+        return gate
+
+    def testOrder(self):
+        writer = outputwriter.OutputWriter(1000)
+        for i in range(50):
+            writer.submit(self.task, i)
+            writer.append(self.task, 'a%d' % i)
+        writer.close()
+        self.assertEqual(self.done, [x for i in range(50)
+                                     for x in (i, 'a%d' % i)])
+        self.assertEqual(writer.written, 100)
+
+    def testDropOnlyAppends(self):
+        writer = outputwriter.OutputWriter(3, 'drop')
+        gate = self.blocked(writer)
+        for i in range(5):
+            writer.append(self.task, 'a%d' % i)
+        writer.submit(self.task, 'remove')
+        self.assertFalse(writer.append(self.task, 'late'))
+        self.assertTrue(writer.submit(self.task, 'truncate'))
+        gate.release.set()
+        writer.close()
+        self.assertEqual(self.done, ['a0', 'a1', 'a2', 'remove', 'truncate'])
+        self.assertEqual(writer.dropped, 3)
+        self.assertEqual(writer.blocked, 0)
+
+    def testBlock(self):
+        writer = outputwriter.OutputWriter(2, 'block')
+        gate = self.blocked(writer)
+        writer.append(self.task, 1)
+        writer.append(self.task, 2)
+        # The next one waits until there is space in the queue
+        thread = threading.Thread(target=writer.append, args=(self.task, 3))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        gate.release.set()
+        thread.join()
+        writer.close()
+        self.assertEqual(self.done, [1, 2, 3])
+        self.assertEqual(writer.blocked, 1)
+
+    def testReplaceCoalesced(self):
+        writer = outputwriter.OutputWriter(1000)
+        gate = self.blocked(writer)
+        for i in range(10):
+            writer.replace('mBc.txt', self.task, 'r%d' % i)
+        writer.replace('other', self.task, 'o')
+        gate.release.set()
+        writer.close()
+        self.assertEqual(self.done, ['r9', 'o'])
+        self.assertEqual(writer.coalesced, 9)
+
+    def testReplaceInterleaved(self):
+        # The replaced file is written while the queue is never empty
+        writer = outputwriter.OutputWriter(1000, replaceEvery=10,
+                                           replaceDelay=1000.0)
+        gate = self.blocked(writer)
+        for i in range(25):
+            writer.append(self.task, i)
+        writer.replace('mBc.txt', self.task, 'r')
+        gate.release.set()
+        writer.flush()
+        # The gate was the first task of the queue
+        self.assertEqual(self.done.index('r'), 9)
+
+        self.done = []
+        writer.replaceEvery = 1000
+        writer.replaceDelay = 0.0
+        gate = self.blocked(writer)
+        for i in range(5):
+            writer.append(self.task, i)
+        writer.replace('mBc.txt', self.task, 'r')
+        gate.release.set()
+        writer.close()
+        self.assertEqual(self.done[0], 'r')
+
+    def testErrors(self):
+        def fail():
+            raise IOError("disk full")
+        writer = outputwriter.OutputWriter()
+        # The traceback is printed to stderr
+        stderr = sys.stderr
+        with support.captured() as out:
+            sys.stderr = out
+            try:
+                writer.submit(fail)
+                writer.submit(self.task, 1)
+                writer.close()
+            finally:
+                sys.stderr = stderr
+        self.assertTrue('disk full' in out.getvalue())
+        self.assertEqual(self.done, [1])
+        self.assertEqual((writer.errors, writer.written), (1, 1))
+
+    def testWrongPolicy(self):
+        self.assertRaises(ValueError, outputwriter.OutputWriter, 10, 'wait')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+"""Peak detection and storage of the peaks in mBc."""
+
+import unittest
+
+import numpy
+
+import support
+import mBc
+from mBc import Peak
+
+
+def mysign(number):
+    if number == 0:
+        return 0
+    if number < 0:
+        return -1
+    return 1
+
+
+def checkMax(values, lowThresh=0.0, q=0.6):
+    """Peaks of a signal sample by sample, as the original __checkMax did.
+    Returns the positions where the peaks were recognized and the peaks."""
+
+    Vmaxt = Peak(0, 0)
+    Vlocal = None
+    signV = 0
+    positions = []
+    peaks = []
+    for pos, value in enumerate(values):
+        if mysign(value) != signV:
+            if Vlocal is not None and abs(Vlocal) > lowThresh:
+                if abs(Vmaxt) < abs(Vlocal):
+                    Vmaxt = Vlocal
+                    positions.append(pos)
+                    peaks.append(Vlocal)
+                elif abs(Vlocal) >= q * abs(Vmaxt):
+                    positions.append(pos)
+                    peaks.append(Vlocal)
+            Vlocal = None
+            signV = mysign(value)
+
+        if Vlocal is None or abs(value) > abs(Vlocal):
+            Vlocal = Peak(float(pos), value)
+
+    return positions, peaks
+
+
+def detect(detector, values, blocks, lowThresh=0.0):
+    """Feed the signal to the detector split at the positions given."""
+
+    positions = []
+    peaks = []
+    bounds = [0] + list(blocks) + [len(values)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        pos, new = detector.feed(values[start:end],
+                                 numpy.arange(start, end, dtype=float),
+                                 lowThresh)
+        positions.extend((pos + start).tolist())
+        peaks.extend(new)
+    return positions, peaks
+
+
+class TestPeakDetector(unittest.TestCase):
+
+    def signal(self, rng, n=2000):
+        values = rng.normal(0, 1, n) * numpy.exp(rng.normal(0, 1, n))
+        # Repeated values and zeros
+        values = numpy.round(values, 1)
+        values[rng.rand(n) < 0.05] = 0.0
+        return values
+
+    def testSampleBySample(self):
+        rng = numpy.random.RandomState(1)
+        for i in range(20):
+            values = self.signal(rng)
+            blocks = numpy.sort(rng.choice(numpy.arange(1, len(values)),
+                                           rng.randint(0, 50), False))
+            for lowThresh in (0.0, 0.5):
+                expected = checkMax(values, lowThresh)
+                result = detect(mBc.PeakDetector(), values, blocks, lowThresh)
+                self.assertEqual(result, expected)
+
+    def testOneSampleBlocks(self):
+        values = self.signal(numpy.random.RandomState(2), 300)
+        result = detect(mBc.PeakDetector(), values, range(1, len(values)))
+        self.assertEqual(result, checkMax(values))
+
+    def testEmptyBlock(self):
+        detector = mBc.PeakDetector()
+        positions, peaks = detector.feed(numpy.zeros(0), numpy.zeros(0))
+        self.assertEqual(len(positions), 0)
+        self.assertEqual(peaks, [])
+
+    def testRestart(self):
+        detector = mBc.PeakDetector()
+        detector.feed(numpy.array([1.0, 5.0, -2.0, 3.0]), numpy.arange(4.0))
+        self.assertEqual(detector.Vmaxt, Peak(1.0, 5.0))
+        detector.restart()
+        # The open segment (3.0) is discarded, the global maximum is kept
+        positions, peaks = detector.feed(numpy.array([-4.0, 1.0]),
+                                         numpy.arange(10.0, 12.0))
+        self.assertEqual(peaks, [Peak(10.0, -4.0)])
+        self.assertEqual(positions.tolist(), [1])
+        self.assertEqual(detector.Vmaxt, Peak(1.0, 5.0))
+
+
+class TestPeakList(unittest.TestCase):
+
+    def testGrowth(self):
+        peaks = [Peak(float(i), (-1) ** i * (i + 0.5)) for i in range(100)]
+        result = mBc.PeakList()
+        for pos in range(0, 100, 7):
+            result.extend(peaks[pos:pos + 7])
+        self.assertEqual(len(result), 100)
+        self.assertEqual(list(result), peaks)
+        self.assertEqual(result[-1], peaks[-1])
+        self.assertEqual(result[3], peaks[3])
+        self.assertRaises(IndexError, result.__getitem__, 100)
+
+    def testAmplitudeBefore(self):
+        rng = numpy.random.RandomState(3)
+        times = numpy.cumsum(rng.uniform(0.1, 1, 500))
+        values = rng.normal(0, 10, 500)
+        result = mBc.PeakList()
+        result.extendArrays(times[:250], values[:250])
+        result.extendArrays(times[250:], values[250:])
+        peaks = list(result)
+        for limit in rng.uniform(0, times[-1] + 1, 50).tolist() + \
+                [times[0], times[100]]:
+            expected = 0.0
+            for p in peaks:
+                expected += abs(p.value) / 2.0 if p.before(limit) else 0
+            self.assertEqual(result.amplitudeBefore(limit), expected)
+
+    def testBefore(self):
+        result = mBc.PeakList([Peak(1.0, 2.0), Peak(2.0, -3.0),
+                               Peak(3.0, 4.0)])
+        before = result.before(3.0)
+        self.assertEqual(list(before), [Peak(1.0, 2.0), Peak(2.0, -3.0)])
+        self.assertEqual(before.amplitudeBefore(10.0), 2.5)
+        # The original list is not modified
+        before.append(Peak(5.0, 1.0))
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result.amplitudeBefore(10.0), 4.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+"""Hand-off of the records from the acquisition to the processing."""
+
+import sys
+import threading
+import unittest
+
+import support
+import recordqueue
+import seiscomp3.DataModel as DataModel
+from test_listen import application
+
+
+def record(i):
+    return support.Record('XX.S%02d..BHZ' % (i % 3), 100.0 + i, 20.0, [0.0])
+
+
+class Handler:
+    """Records processed, which can be held until the test releases them."""
+
+    def __init__(self):
+        self.records = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, rec):
+        self.started.set()
+        self.release.wait()
+        self.records.append(rec)
+
+
+class TestRecordQueue(unittest.TestCase):
+
+    def blocked(self, queue, handler):
+        """Block the processing thread with a first record."""
+
+        handler.release.clear()
+        queue.put(record(-1))
+        handler.started.wait()
+
+    def testOrder(self):
+        handler = Handler()
+        queue = recordqueue.RecordQueue(handler, 10)
+        recs = [record(i) for i in range(100)]
+        for rec in recs:
+            self.assertTrue(queue.put(rec))
+        queue.flush()
+        self.assertEqual(queue.depth(), 0)
+        self.assertEqual(handler.records, recs)
+        queue.close()
+        self.assertEqual((queue.received, queue.processed, queue.dropped),
+                         (100, 100, 0))
+        self.assertTrue(queue.maxDepth <= 10)
+
+    def testDrop(self):
+        handler = Handler()
+        queue = recordqueue.RecordQueue(handler, 3, 'drop')
+        self.blocked(queue, handler)
+        recs = [record(i) for i in range(5)]
+        self.assertEqual([queue.put(rec) for rec in recs],
+                         [True, True, True, False, False])
+        self.assertEqual(queue.depth(), 4)
+        handler.release.set()
+        queue.close()
+        self.assertEqual(handler.records[1:], recs[:3])
+        self.assertEqual((queue.dropped, queue.blocked), (2, 0))
+
+    def testBlock(self):
+        handler = Handler()
+        queue = recordqueue.RecordQueue(handler, 2, 'block')
+        self.blocked(queue, handler)
+        recs = [record(i) for i in range(3)]
+        queue.put(recs[0])
+        queue.put(recs[1])
+        # The acquisition waits until there is space in the queue
+        thread = threading.Thread(target=queue.put, args=(recs[2],))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        handler.release.set()
+        thread.join()
+        queue.close()
+        self.assertEqual(handler.records[1:], recs)
+        self.assertEqual((queue.dropped, queue.blocked), (0, 1))
+
+    def testClose(self):
+        handler = Handler()
+        queue = recordqueue.RecordQueue(handler, 10)
+        self.blocked(queue, handler)
+        queue.put(record(0))
+        # The records queued are processed before the thread stops
+        handler.release.set()
+        queue.close()
+        self.assertEqual(len(handler.records), 2)
+        self.assertFalse(queue.put(record(1)))
+        self.assertEqual(queue.dropped, 1)
+
+    def testLock(self):
+        # The lock is held while a record is processed
+        lock = threading.Lock()
+        held = []
+        queue = recordqueue.RecordQueue(
+            lambda rec: held.append(not lock.acquire(False)), lock=lock)
+        queue.put(record(0))
+        queue.close()
+        self.assertEqual(held, [True])
+
+    def testErrors(self):
+        def fail(rec):
+            if rec.streamID().startswith('XX.S00'):
+                raise ValueError("wrong record")
+        queue = recordqueue.RecordQueue(fail)
+        stderr = sys.stderr
+        with support.captured() as out:
+            sys.stderr = out
+            try:
+                for i in range(6):
+                    queue.put(record(i))
+                queue.close()
+            finally:
+                sys.stderr = stderr
+        self.assertTrue('wrong record' in out.getvalue())
+        self.assertEqual((queue.processed, queue.errors), (6, 2))
+
+    def testOrigin(self):
+        # A new origin is passed to the processors of the application while
+        # no record is processed
+        class Processor:
+            def setEvent(self, origin):
+                events.append((origin.publicID(), lock.locked()))
+
+        events = []
+        lock = threading.Lock()
+        handler = Handler()
+        app = application('--event', 'Event/1')
+        app._cache = DataModel.PublicObjectRingBuffer(None, 10)
+        app._processor = dict(mBc=Processor())
+        app._records = recordqueue.RecordQueue(handler, 10, lock=lock)
+        self.blocked(app._records, handler)
+
+        origin = DataModel.Origin('Origin/1', 1000.0, 0.0, 0.0, 30.0)
+        thread = threading.Thread(target=app.addObject, args=('', origin))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(events, [])
+        handler.release.set()
+        thread.join()
+        app._records.close()
+        self.assertEqual(events, [('Origin/1', True)])
+
+    def testWrongPolicy(self):
+        self.assertRaises(ValueError, recordqueue.RecordQueue, len, 10,
+                          'wait')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""Processing of the streams of an event in several processes."""
+
+import os
+import threading
+import unittest
+import multiprocessing
+
+import numpy
+
+import support
+import streampool
+import mBc
+from test_mbc import cases, expected
+
+
+def createProcessor(nsta, outputDir='.'):
+    """Processor ready to receive the records of a case."""
+
+    processor = mBc.Processor()
+    processor.outputDir = outputDir
+    processor.setEvent(support.origin())
+    processor._filterInventory(support.inventory(nsta))
+    processor.timeWindows()
+    return processor
+
+
+class TestRecordBatch(unittest.TestCase):
+
+    def testSend(self):
+        parent, child = multiprocessing.Pipe()
+        batch = streampool.RecordBatch(samples=16)
+        values = [numpy.arange(10, dtype=numpy.int32), numpy.arange(20.0)]
+        for stream, data in enumerate(values):
+            batch.add(stream, support.Record('XX.S%02d..BHZ' % stream,
+                                             100.0 + stream, 20.0, data))
+        # The array of samples grows as needed
+        self.assertEqual((len(batch), batch.size), (2, 30))
+        batch.send(parent, 7)
+        self.assertEqual(child.recv(), ('feed', 7, [(0, 100.0, 0, 20.0, 10),
+                                                    (1, 101.0, 0, 20.0, 20)]))
+        samples = numpy.frombuffer(child.recv_bytes(), dtype=numpy.double)
+        self.assertEqual(samples.tolist(),
+                         numpy.concatenate(values).tolist())
+
+        batch.clear()
+        self.assertEqual((len(batch), batch.size), (0, 0))
+
+
+class TestProcessorPool(unittest.TestCase):
+
+    def testOwnWorkers(self):
+        for case in cases:
+            nsta, seed, reclen, sps = case
+            for workers in (2, 3):
+                with support.workDir():
+                    pool = streampool.ProcessorPool(createProcessor(nsta),
+                                                    workers)
+                    recs = support.records(pool.timeWinDict,
+                                           support.inventory(nsta), seed,
+                                           reclen, sps)
+                    with support.captured() as out:
+                        support.feed(pool, recs)
+                    with open('mBc.txt') as fstr:
+                        txt = fstr.read()
+                self.assertEqual(support.summaryLines(out.getvalue()),
+                                 expected(case, 'out').splitlines(), case)
+                self.assertEqual(txt, expected(case, 'txt'), case)
+                self.assertEqual(len(pool.records), workers)
+                self.assertTrue(min(pool.records) > 0)
+
+    def testWorkerGroup(self):
+        # Several events processed at the same time by the same workers,
+        # which create the processors themselves
+        group = streampool.WorkerGroup(createProcessor, 2, 'test')
+        try:
+            with support.workDir() as path:
+                results = dict()
+
+                def process(case):
+                    nsta, seed, reclen, sps = case
+                    outputDir = os.path.join(path, '%d' % seed)
+                    os.mkdir(outputDir)
+                    pool = streampool.ProcessorPool(
+                        createProcessor(nsta, outputDir), group,
+                        args=(nsta, outputDir))
+                    recs = support.records(pool.timeWinDict,
+                                           support.inventory(nsta), seed,
+                                           reclen, sps)
+                    support.feed(pool, recs)
+                    with open(os.path.join(outputDir, 'mBc.txt')) as fstr:
+                        results[case] = fstr.read()
+
+                with support.captured():
+                    threads = [threading.Thread(target=process, args=(case,))
+                               for case in cases]
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+
+            for case in cases:
+                self.assertEqual(results[case], expected(case, 'txt'), case)
+        finally:
+            group.close()
+
+    def testDifferentStreams(self):
+        # The processors of the workers must request the same streams
+        group = streampool.WorkerGroup(createProcessor, 2, 'test')
+        try:
+            self.assertRaises(RuntimeError, streampool.ProcessorPool,
+                              createProcessor(12), group, args=(8,))
+            # The group can still be used
+            pool = streampool.ProcessorPool(createProcessor(8), group,
+                                            args=(8,))
+            pool.close()
+        finally:
+            group.close()
+
+    def testFactoryError(self):
+        group = streampool.WorkerGroup(createProcessor, 2, 'test')
+        try:
+            self.assertRaises(RuntimeError, streampool.ProcessorPool,
+                              createProcessor(8), group, args=('x',))
+        finally:
+            group.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
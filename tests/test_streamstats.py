@@ -0,0 +1,165 @@
+"""Statistics of the signal and of the streams."""
+
+import unittest
+
+import numpy
+
+import support
+import streamstats
+import mBc
+
+
+class TestRunningStats(unittest.TestCase):
+
+    def testBlocks(self):
+        rng = numpy.random.RandomState(1)
+        values = rng.normal(1e6, 3.0, 1000)
+        stats = streamstats.RunningStats(robust=True)
+        for pos in range(0, 1000, 77):
+            stats.add(values[pos:pos + 77])
+
+        total = 0.0
+        squares = 0.0
+        for v in values.tolist():
+            total += v
+            squares += v * v
+        self.assertEqual(len(stats), 1000)
+        self.assertEqual(stats.mean(), total / 1000)
+        self.assertEqual(stats.rms(), numpy.sqrt(squares / 1000))
+        self.assertAlmostEqual(stats.variance() / numpy.var(values), 1.0,
+                               places=9)
+        self.assertEqual(stats.median(), numpy.median(values))
+
+    def testSpikes(self):
+        # The spikes are ignored by the robust mean
+        rng = numpy.random.RandomState(2)
+        values = rng.normal(100.0, 3.0, 1000)
+        spikes = [10, 500, 501, 900]
+        values[spikes] = [1e5, -1e5, 1e6, 5e4]
+        clean = numpy.delete(values, spikes).mean()
+        stats = streamstats.RunningStats(robust=True)
+        for pos in range(0, 1000, 300):
+            stats.add(values[pos:pos + 300])
+        self.assertTrue(abs(stats.mean() - clean) > 1000.0)
+        self.assertEqual(stats.mad(), numpy.median(
+            numpy.abs(values - numpy.median(values))))
+        self.assertAlmostEqual(stats.robustMean(), clean, delta=0.05)
+        # Only the samples further than the limit are ignored
+        limit = 5.0 * stats.mad()
+        kept = values[numpy.abs(values - numpy.median(values)) <= limit]
+        self.assertTrue(990 < len(kept) < 996)
+        self.assertTrue(numpy.abs(kept - 100.0).max() < 20.0)
+        self.assertEqual(stats.robustMean(), kept.mean())
+
+    def testEmpty(self):
+        stats = streamstats.RunningStats()
+        stats.add([])
+        self.assertEqual((stats.mean(), stats.rms(), stats.std()),
+                         (0.0, 0.0, 0.0))
+        self.assertEqual(streamstats.RunningStats(True).robustMean(), 0.0)
+
+
+class TestOrderStatistics(unittest.TestCase):
+
+    def testAddRemove(self):
+        rng = numpy.random.RandomState(2)
+        stats = streamstats.OrderStatistics()
+        values = []
+        for i in range(2000):
+            if values and rng.rand() < 0.4:
+                value = values.pop(rng.randint(len(values)))
+                stats.remove(value)
+            else:
+                value = float(rng.randint(100))
+                values.append(value)
+                stats.add(value)
+            self.assertEqual(stats.values(), sorted(values))
+        self.assertRaises(ValueError, stats.remove, 1000.0)
+
+    def testSelect(self):
+        rng = numpy.random.RandomState(3)
+        for i in range(200):
+            a = streamstats.OrderStatistics()
+            b = streamstats.OrderStatistics()
+            for v in rng.randint(0, 20, rng.randint(0, 15)).tolist():
+                a.add(float(v))
+            for v in rng.randint(0, 20, rng.randint(0, 15)).tolist():
+                b.add(float(v))
+            limit = None if rng.rand() < 0.3 else float(rng.randint(20))
+            merged = sorted([v for v in a.values()
+                             if limit is None or v > limit] + b.values())
+            if limit is not None:
+                self.assertEqual(a.countAbove(limit),
+                                 len([v for v in a.values() if v > limit]))
+            for k in range(len(merged)):
+                self.assertEqual(a.select(k, b, limit), merged[k])
+            self.assertRaises(IndexError, a.select, len(merged), b, limit)
+
+
+def summary(streamIDs, rng):
+    """Random summary of the streams with the fields used by mBc."""
+
+    n = len(streamIDs)
+    table = numpy.zeros(n, dtype=[('stage', numpy.int8),
+                                  ('rejected', bool),
+                                  ('duration', numpy.double),
+                                  ('pExpected', numpy.double),
+                                  ('vmaxTime', numpy.double)])
+    table['stage'] = rng.randint(0, 4, n)
+    table['rejected'] = rng.rand(n) < 0.1
+    table['duration'] = numpy.where(rng.rand(n) < 0.2, numpy.nan,
+                                    rng.randint(0, 50, n))
+    table['pExpected'] = numpy.where(rng.rand(n) < 0.1, numpy.nan,
+                                     rng.randint(0, 50, n))
+    table['vmaxTime'] = rng.randint(0, 100, n)
+    return dict(table=table, streamID=streamIDs)
+
+
+def expected(summary):
+    """Values of DurationStats calculated directly from a summary."""
+
+    hara, active, finished, durations = [], [], [], []
+    for row in summary['table'].tolist():
+        stage, rejected, duration, pExpected, vmaxTime = row
+        if stage > 0 and vmaxTime > pExpected:
+            hara.append(vmaxTime - pExpected)
+        if duration == duration and not rejected:
+            (finished if stage == 3 else active).append(duration)
+        # NaN if the duration is not known
+        if duration != 0 and duration == duration:
+            durations.append(duration)
+    return [sorted(v) for v in (hara, active, finished, durations)]
+
+
+class TestDurationStats(unittest.TestCase):
+
+    def check(self, stats, summary):
+        values = [s.values() for s in (stats.hara, stats.active,
+                                       stats.finished, stats.durations)]
+        self.assertEqual(values, expected(summary))
+
+    def testNewStreams(self):
+        rng = numpy.random.RandomState(4)
+        stats = mBc.DurationStats()
+        streamIDs = []
+        for i in range(30):
+            streamIDs = streamIDs + ['XX.S%03d..BHZ' % (len(streamIDs) + j)
+                                     for j in range(rng.randint(0, 5))]
+            s = summary(streamIDs, rng)
+            stats.update(s)
+            self.check(stats, s)
+
+    def testReordered(self):
+        # As the summaries of the workers of a streampool.ProcessorPool
+        rng = numpy.random.RandomState(5)
+        stats = mBc.DurationStats()
+        allIDs = ['XX.S%03d..BHZ' % i for i in range(40)]
+        for i in range(30):
+            streamIDs = [allIDs[j] for j in rng.permutation(40)[:35]]
+            s = summary(streamIDs, rng)
+            stats.update(s)
+            self.check(stats, s)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+"""Precomputed grid of P travel times."""
+
+import unittest
+
+import numpy
+
+import support
+import seiscomp3.Logging
+import seiscomp3.Seismology
+import traveltime
+import mBc
+
+
+class ElevationTable(seiscomp3.Seismology.TravelTimeTable):
+    """Travel times with a correction of 0.2 s per km of elevation, which
+    the grid does not include."""
+
+    def compute(self, lat1, lon1, depth, lat2, lon2, elevation):
+        ttlist = seiscomp3.Seismology.TravelTimeTable.compute(
+            self, lat1, lon1, depth, lat2, lon2, elevation)
+        for tt in ttlist:
+            tt.time += 0.2 * elevation / 1000.0
+        return ttlist
+
+
+def grid():
+    return traveltime.PTravelTimeGrid.build(
+        seiscomp3.Seismology.TravelTimeTable(), deltaMax=110.0,
+        deltaStep=5.0, depthMax=100.0, depthStep=10.0)
+
+
+def timeWindows(ttt, tttGrid=None, elevation=None):
+    """Time windows of the streams and calls to ttt.compute."""
+
+    processor = mBc.Processor(ttt=ttt)
+    processor.tttGrid = tttGrid
+    inv = support.inventory()
+    if elevation is not None:
+        inv['XX', 'S05']._elevation = elevation
+    support.prepare(processor, inv)
+    return dict((key, (float(t0), float(t1))) for key, (t0, t1) in
+                processor.timeWinDict.iteritems()), ttt.calls
+
+
+class TestGrid(unittest.TestCase):
+
+    def testInterpolate(self):
+        g = grid()
+        self.assertEqual(g.times.shape, (23, 11))
+        deltas = numpy.array([0.0, 2.5, 33.3, 110.0, 110.1, -1.0, numpy.nan])
+        times = g.interpolate(deltas, 35.0)
+        numpy.testing.assert_allclose(times[:4], 10.0 * deltas[:4] + 0.35,
+                                      rtol=1E-12)
+        self.assertTrue(numpy.all(numpy.isnan(times[4:])))
+        self.assertTrue(g.maxError(seiscomp3.Seismology.TravelTimeTable())
+                        < 1E-9)
+
+    def testSaveLoad(self):
+        g = grid()
+        with support.workDir():
+            g.save('ptimes.npz')
+            self.assertEqual(traveltime.loadGrid('ptimes.npz').error, None)
+            g.error = 0.125
+            g.save('ptimes.npz')
+            del seiscomp3.Logging.messages[:]
+            loaded = traveltime.loadGrid('ptimes.npz')
+            # The error of the interpolation is logged
+            self.assertEqual(seiscomp3.Logging.messages,
+                             [('info', 'P travel time grid loaded from '
+                               'ptimes.npz: 23 distances x 11 depths, '
+                               'maximum error of the interpolation '
+                               '0.125 s')])
+            # The grid is not created by the application
+            del seiscomp3.Logging.messages[:]
+            self.assertEqual(traveltime.loadGrid('missing.npz'), None)
+        self.assertEqual(seiscomp3.Logging.messages[0][0], 'warning')
+        for name in ('distances', 'depths', 'times'):
+            self.assertEqual(getattr(loaded, name).tolist(),
+                             getattr(g, name).tolist())
+        self.assertEqual(loaded.error, 0.125)
+
+
+class TestTimeWindows(unittest.TestCase):
+
+    def testGrid(self):
+        g = grid()
+        windows, calls = timeWindows(seiscomp3.Seismology.TravelTimeTable())
+        gridWindows, gridCalls = timeWindows(
+            seiscomp3.Seismology.TravelTimeTable(), g)
+        self.assertEqual(sorted(gridWindows), sorted(windows))
+        for key in windows:
+            numpy.testing.assert_allclose(gridWindows[key], windows[key],
+                                          rtol=1E-12)
+        # Only a few stations are checked
+        self.assertEqual(calls, 12)
+        self.assertTrue(gridCalls <= traveltime.checkStations + 1)
+
+    def testElevation(self):
+        g = grid()
+        # Within the tolerance, the exact values of the stations checked are
+        # used and the grid for the rest
+        windows = timeWindows(ElevationTable(), elevation=2000.0)[0]
+        gridWindows, calls = timeWindows(ElevationTable(), g, 2000.0)
+        self.assertTrue(calls <= traveltime.checkStations + 1)
+        self.assertEqual(gridWindows['XX', 'S05', '', 'BHZ'],
+                         windows['XX', 'S05', '', 'BHZ'])
+
+        # Otherwise, the exact values are used for all the stations
+        windows = timeWindows(ElevationTable(), elevation=8000.0)[0]
+        del seiscomp3.Logging.messages[:]
+        gridWindows, calls = timeWindows(ElevationTable(), g, 8000.0)
+        self.assertEqual(gridWindows, windows)
+        self.assertEqual(calls, 12)
+        self.assertTrue([msg for level, msg in seiscomp3.Logging.messages
+                         if level == 'warning' and 'grid' in msg])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""Binary files with the waveforms and peaks saved for debugging."""
+
+import os
+import unittest
+
+import numpy
+
+import support
+import wavedump
+import mBc
+from test_mbc import cases, expected
+
+
+class TestDumpFile(unittest.TestCase):
+
+    def testAppend(self):
+        with support.workDir():
+            # Data from a previous run is discarded
+            wavedump.save('dump.bin', [1.0], [2.0])
+            dump = wavedump.DumpFile('dump.bin', bufferSize=10)
+            times = numpy.arange(25.0)
+            values = numpy.sin(times)
+            for pos in range(0, 25, 3):
+                dump.append(times[pos:pos + 3], values[pos:pos + 3])
+            # The buffer is written when it has at least 10 pairs
+            self.assertEqual(len(wavedump.load('dump.bin')), 24)
+            dump.append([], [])
+            dump.flush()
+            data = wavedump.load('dump.bin')
+            self.assertEqual(data['time'].tolist(), times.tolist())
+            self.assertEqual(data['value'].tolist(), values.tolist())
+
+    def testOutput(self):
+        calls = []
+
+        def output(function, *args):
+            calls.append(('output', function.__name__))
+            function(*args)
+
+        def append(function, *args):
+            calls.append(('append', function.__name__))
+            function(*args)
+
+        with support.workDir():
+            dump = wavedump.DumpFile('dump.bin', 2, output, append)
+            dump.append([1.0, 2.0], [3.0, 4.0])
+            self.assertEqual(calls, [('output', '_truncate'),
+                                     ('append', '_write')])
+            self.assertEqual(len(wavedump.load('dump.bin')), 2)
+
+    def testEmpty(self):
+        with support.workDir():
+            wavedump.save('empty.bin', [], [])
+            self.assertEqual(len(wavedump.load('empty.bin')), 0)
+
+
+class TestDumpWaveforms(unittest.TestCase):
+
+    def testFiles(self):
+        # The waveforms dumped are the signal received and filtered, and
+        # the peaks saved are the ones found
+        case = cases[0]
+        nsta, seed, reclen, sps = case
+        with support.workDir():
+            processor = mBc.Processor(dumpWaveforms=True)
+            inv = support.inventory(nsta)
+            support.prepare(processor, inv)
+            recs = support.records(processor.timeWinDict, inv, seed, reclen,
+                                   sps)
+            with support.captured():
+                support.feed(processor, recs)
+            with open('mBc.txt') as fstr:
+                self.assertEqual(fstr.read(), expected(case, 'txt'))
+
+            saved = 0
+            for state in processor.states:
+                if state.results is None or state.rejected:
+                    continue
+                name = 'mBc-%s' % ''.join(state.key)
+                raw = wavedump.load(name + '.bin')
+                filtered = wavedump.load(name + '-f.bin')
+                self.assertTrue(len(raw) and len(filtered))
+                self.assertTrue(numpy.all(numpy.diff(raw['time']) > 0))
+                peaks = wavedump.load(name + '-p.bin')
+                self.assertEqual(peaks['time'].tolist(),
+                                 list(state.results.times))
+                self.assertEqual(peaks['value'].tolist(),
+                                 list(state.results.values))
+                self.assertTrue(os.path.exists(name + '-m.dat'))
+                saved += 1
+            self.assertTrue(saved > 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,438 @@
+"""Preprocessing of the records shared by the processors of an event."""
+
+import os
+import unittest
+
+import numpy
+
+import support
+import seiscomp3.Core
+import seiscomp3.Logging
+import seiscomp3.Math
+import waveproc
+
+streamID = 'XX.S00..BHZ'
+
+
+class State(object):
+    rejected = False
+
+
+class Collector:
+    """Processor which keeps the blocks delivered by the preprocessing."""
+
+    name = 'test'
+    filterBands = []
+
+    def __init__(self):
+        self.timeWinDict = {tuple(streamID.split('.')):
+                            (seiscomp3.Core.Time(0.0),
+                             seiscomp3.Core.Time(1000.0))}
+        self.blocks = []
+        self.rejected = []
+
+    def getGain(self, net, sta, loc, cha):
+        return 1.0
+
+    def _addStream(self, input):
+        return State()
+
+    def process(self, state, block):
+        self.blocks.append((block.startTime().length(),
+                            numpy.array(block.numpy())))
+
+    def resume(self, state, missing):
+        pass
+
+    def _reject(self, streamID, reason):
+        self.rejected.append(streamID)
+
+
+class Processor(waveproc.Processor):
+    """Processor with a correction depending on the distance and depth."""
+
+    name = 'test'
+
+    def distanceCorrection(self, delta, depth):
+        if delta > 100.0:
+            return None
+        return delta + depth / 100.0
+
+
+def preprocess(recs, **options):
+    """Samples delivered (without the average) and their times."""
+
+    pre = waveproc.Preprocessor()
+    pre.peepAvg = 0.0
+    for name, value in options.items():
+        setattr(pre, name, value)
+    collector = Collector()
+    pre.register(collector)
+    for rec in recs:
+        pre.feed(rec)
+    pre.finish()
+    avg = pre.streams[streamID].avgValue
+    times = numpy.concatenate([start + numpy.arange(len(values)) / 10.0
+                               for start, values in collector.blocks])
+    values = numpy.concatenate([values for start, values in collector.blocks])
+    return pre, times, values + avg
+
+
+class TestPreprocessor(unittest.TestCase):
+
+    def testGaps(self):
+        # By default, short gaps are not filled and the stream is discarded
+        # after a gap over 5 s
+        recs = [support.Record(streamID, start, 10.0, numpy.arange(20.0))
+                for start in (100.0, 104.0, 106.0, 114.0)]
+        pre, times, values = preprocess(recs[:3])
+        self.assertEqual((pre.gapsFilled, pre.gapsResumed), (0, 0))
+        self.assertEqual(len(values), 60)
+        self.assertEqual(pre.streams[streamID].buffer.late, 0)
+
+        pre, times, values = preprocess(recs)
+        self.assertEqual(len(values), 60)
+        self.assertTrue(pre.streams[streamID].rejected)
+
+        # Unless they are filled and the stream resumed
+        pre, times, values = preprocess(recs, gapFill='zero', maxGap=10.0)
+        self.assertEqual((pre.gapsFilled, pre.gapsResumed), (1, 1))
+        self.assertEqual(len(values), 100)
+        self.assertFalse(pre.streams[streamID].rejected)
+
+    def testRobustBaseline(self):
+        # A spike in the first seconds does not shift the signal
+        signal = numpy.random.RandomState(1).normal(10.0, 1.0, 50)
+        signal[20] = 1e6
+        recs = [support.Record(streamID, 100.0, 10.0, signal)]
+        pre, times, values = preprocess(recs, peepAvg=4.0)
+        self.assertTrue(pre.streams[streamID].avgValue > 1e4)
+        # The first 4 s and the sample after them
+        first = numpy.delete(signal[:42], 20)
+        pre, times, values = preprocess(recs, peepAvg=4.0,
+                                        robustBaseline=True)
+        self.assertAlmostEqual(pre.streams[streamID].avgValue, first.mean(),
+                               places=12)
+
+    def testIntegerFill(self):
+        # The samples filling a gap are not truncated to integers
+        a = support.Record(streamID, 100.0, 10.0,
+                           numpy.arange(20, dtype=numpy.int32))
+        b = support.Record(streamID, 102.2, 10.0,
+                           numpy.arange(20, 40, dtype=numpy.int32))
+        pre, times, values = preprocess([a, b], gapFill='linear')
+        self.assertEqual(pre.gapsFilled, 1)
+        numpy.testing.assert_allclose(times, 100.0 + numpy.arange(42) / 10.0)
+        numpy.testing.assert_allclose(
+            values, numpy.concatenate([numpy.arange(20), [19 + 1 / 3.0,
+                                                          19 + 2 / 3.0],
+                                       numpy.arange(20, 40)]))
+
+    def testOverlap(self):
+        # The samples of a record before the end of the previous one are not
+        # processed twice
+        signal = numpy.arange(100, dtype=numpy.double)
+        recs = [support.Record(streamID, 100.0 + start / 10.0, 10.0,
+                               signal[start:end])
+                for start, end in ((0, 30), (25, 50), (30, 40), (45, 60),
+                                   (60, 100))]
+        del seiscomp3.Logging.messages[:]
+        pre, times, values = preprocess(recs, holdTime=1.0)
+        numpy.testing.assert_allclose(times, 100.0 + numpy.arange(100) / 10.0)
+        numpy.testing.assert_allclose(values, signal)
+        self.assertEqual(pre.overlapsTrimmed, 2)
+        self.assertEqual(pre.streams[streamID].buffer.late, 1)
+        self.assertEqual([level for level, msg in seiscomp3.Logging.messages
+                          if msg.startswith('Record arrived too late! ' +
+                                            streamID)], ['warning'])
+
+    def testOrder(self):
+        recs = [support.Record(streamID, start, 10.0, numpy.arange(20.0))
+                for start in (100.0, 104.0, 102.0, 106.0)]
+        # By default, a stream is discarded if its records are not in order
+        pre, times, values = preprocess(recs)
+        self.assertTrue(pre.streams[streamID].rejected)
+        self.assertEqual(len(values), 40)
+
+        # Unless they are reordered
+        pre, times, values = preprocess(recs, holdTime=5.0)
+        self.assertFalse(pre.streams[streamID].rejected)
+        numpy.testing.assert_allclose(times, 100.0 + numpy.arange(80) / 10.0)
+        self.assertEqual(pre.streams[streamID].buffer.reordered, 1)
+
+
+class TestStationGeometry(unittest.TestCase):
+
+    def testGeometry(self):
+        event = waveproc.Event(seiscomp3.Core.Time(1000.0), 0.0, 0.0, 30.0)
+        inv = support.inventory(3)
+        stations = dict((key, inv[key]) for key in inv
+                        if isinstance(key, tuple) and len(key) == 2)
+        geometry = waveproc.StationGeometry(
+            event, stations, Processor().distanceCorrection)
+        self.assertEqual(len(geometry), 4)
+        self.assertEqual(sorted(geometry.row.values()), [0, 1, 2, 3])
+        for (net, sta), pos in geometry.row.items():
+            self.assertEqual(geometry.longitude[pos],
+                             stations[net, sta].longitude())
+        self.assertAlmostEqual(geometry.distance('XX', 'S01'), 15.0)
+        self.assertAlmostEqual(geometry.distanceCorrection('XX', 'S01'), 15.3)
+        # The correction is not defined for the far station
+        self.assertAlmostEqual(geometry.distance('XX', 'FAR'), 150.0)
+        self.assertTrue(numpy.isnan(geometry.distanceCorrection('XX', 'FAR')))
+
+        # Without correction
+        geometry = waveproc.StationGeometry(event, stations)
+        self.assertEqual(geometry.distanceCorrection('XX', 'S01'), 0.0)
+
+    def testMoveEvent(self):
+        time = seiscomp3.Core.Time(1000.0)
+        proc = Processor()
+        self.assertFalse(proc.moveEvent(time, 0.0, 0.0, 30.0))
+        self.assertEqual(proc.geometry, None)
+        proc.filtered = support.inventory(3)
+        proc._updateGeometry()
+        geometry = proc.geometry
+
+        # The geometry is kept if the event moves up to 0.05 deg and 5 km
+        self.assertFalse(proc.moveEvent(time, 0.0, 0.04, 35.0))
+        self.assertTrue(proc.geometry is geometry)
+        self.assertEqual((proc.event.lon, proc.event.dep), (0.04, 35.0))
+
+        # and calculated again beyond that
+        self.assertTrue(proc.moveEvent(time, 0.0, 0.1, 35.0))
+        self.assertFalse(proc.geometry is geometry)
+        self.assertAlmostEqual(proc.geometry.distance('XX', 'S01'), 14.9)
+        self.assertAlmostEqual(proc.geometry.distanceCorrection('XX', 'S01'),
+                               15.25)
+        geometry = proc.geometry
+        self.assertTrue(proc.moveEvent(time, 0.0, 0.1, 41.0))
+        self.assertFalse(proc.geometry is geometry)
+        self.assertAlmostEqual(proc.geometry.distanceCorrection('XX', 'S01'),
+                               15.31)
+
+
+class TestInventoryIndex(unittest.TestCase):
+
+    def testStreams(self):
+        inv = dict()
+        for sta, streams in (('A', ['HHZ', 'BHN', 'BHZ']), ('B', ['HHZ']),
+                             ('C', ['BH3', 'BH2']), ('D', ['LHZ'])):
+            inv['XX'] = object()
+            inv['XX', sta] = support.Station(0.0, 10.0)
+            inv['XX', sta, ''] = object()
+            for cha in streams:
+                inv['XX', sta, '', cha] = support.Stream(1.0)
+        index = waveproc.InventoryIndex(inv)
+        self.assertEqual(len(index), 4)
+
+        streams = dict(zip(index.locations, index.streams(['BH', 'HH'])))
+        self.assertEqual(streams, {('XX', 'A', ''): [('XX', 'A', '', 'BHZ')],
+                                   ('XX', 'B', ''): [('XX', 'B', '', 'HHZ')],
+                                   ('XX', 'C', ''): [('XX', 'C', '', 'BH3')],
+                                   ('XX', 'D', ''): []})
+        streams = dict(zip(index.locations, index.streams(['HH', 'BH'])))
+        self.assertEqual(streams['XX', 'A', ''], [('XX', 'A', '', 'HHZ')])
+        # The selection is kept for every list of channels
+        self.assertTrue(index.streams(('BH', 'HH')) is
+                        index.streams(['BH', 'HH']))
+
+    def testWithin(self):
+        # Stations everywhere
+        rng = numpy.random.RandomState(1)
+        inv = dict()
+        for i in range(500):
+            inv['XX', 'S%03d' % i] = support.Station(rng.uniform(-90, 90),
+                                                     rng.uniform(-180, 180))
+            inv['XX', 'S%03d' % i, ''] = object()
+        # and just inside or outside of the distance range
+        for sta, lon in (('IN1', 5.001), ('OUT1', 4.999), ('IN2', 99.999),
+                         ('OUT2', 100.001)):
+            inv['XX', sta] = support.Station(0.0, lon)
+            inv['XX', sta, ''] = object()
+        index = waveproc.InventoryIndex(inv)
+
+        for lat, lon in ((0.0, 0.0), (45.0, 120.0), (-89.0, 10.0)):
+            selected = [pos for pos, (net, sta, loc)
+                        in enumerate(index.locations)
+                        if 5.0 <= seiscomp3.Math.delazi(
+                            lat, lon, inv[net, sta].latitude(),
+                            inv[net, sta].longitude())[0] <= 100.0]
+            self.assertEqual(index.within(lat, lon, 5.0, 100.0), selected)
+        within = [index.locations[pos][1]
+                  for pos in index.within(0.0, 0.0, 5.0, 100.0)]
+        self.assertEqual(sorted(sta for sta in within if sta[0] != 'S'),
+                         ['IN1', 'IN2'])
+
+        self.assertEqual(waveproc.InventoryIndex(dict()).within(0.0, 0.0, 5.0,
+                                                                100.0), [])
+
+
+class TestQuarantine(unittest.TestCase):
+
+    def testQuarantine(self):
+        quarantine = waveproc.Quarantine()
+        self.assertTrue(quarantine.add(streamID, 'gap'))
+        self.assertFalse(quarantine.add(streamID, 'clipped'))
+        self.assertTrue(quarantine.add('XX.S01..BHZ', 'clipped'))
+        self.assertTrue(streamID in quarantine)
+        self.assertFalse('XX.S02..BHZ' in quarantine)
+        self.assertEqual(len(quarantine), 2)
+        self.assertEqual(sorted(quarantine), [streamID, 'XX.S01..BHZ'])
+        # The first reason is kept
+        self.assertEqual(quarantine.reasons[streamID], 'gap')
+
+    def testReject(self):
+        processed = []
+        rejected = []
+
+        class Counter(Processor):
+            def process(self, state, rec):
+                processed.append(state.streamID)
+
+        proc = Counter(dumpWaveforms=True)
+        proc.onReject = rejected.append
+        window = (seiscomp3.Core.Time(0.0), seiscomp3.Core.Time(1000.0))
+        for sid in (streamID, 'XX.S01..BHZ'):
+            proc.timeWinDict[tuple(sid.split('.'))] = window
+            proc.gain[tuple(sid.split('.'))] = 1.0
+
+        with support.workDir():
+            open('test-XXS00BHZ.txt', 'w').close()
+            proc.feed(support.Record(streamID, 100.0, 10.0,
+                                     numpy.arange(20.0)))
+            proc.flush()
+            self.assertEqual(processed, [streamID])
+
+            del seiscomp3.Logging.messages[:]
+            proc._reject(streamID, 'gap')
+            # The files of the stream are removed
+            self.assertFalse(os.path.exists('test-XXS00BHZ.txt'))
+            open('test-XXS00BHZ.txt', 'w').close()
+            # The stream is discarded once
+            proc._reject(streamID, 'clipped')
+            self.assertTrue(os.path.exists('test-XXS00BHZ.txt'))
+        self.assertEqual(rejected, [streamID])
+        self.assertEqual(seiscomp3.Logging.messages,
+                         [('warning', 'Processor test: %s discarded (gap)' %
+                           streamID)])
+        self.assertTrue(proc.streams[streamID].rejected)
+
+        # and for good: its records are not processed anymore
+        proc._reject('XX.S01..BHZ', 'clipped')
+        for sid in (streamID, 'XX.S01..BHZ'):
+            proc.feed(support.Record(sid, 102.0, 10.0, numpy.arange(20.0)))
+        proc.flush()
+        self.assertEqual(processed, [streamID])
+        self.assertTrue(proc.streams['XX.S01..BHZ'].rejected)
+        self.assertEqual(rejected, [streamID, 'XX.S01..BHZ'])
+
+
+class RawRecord(support.Record):
+    """Record with the integer samples it was decoded from."""
+
+    def raw(self):
+        return support.Array(self.data().numpy().astype(numpy.int32))
+
+
+class TestRecordRetention(unittest.TestCase):
+
+    def testLength(self):
+        retention = waveproc.RecordRetention(3.0)
+        recs = [support.Record(streamID, 100.0 + i, 10.0, numpy.arange(10.0))
+                for i in range(10)]
+        for rec in recs:
+            retention.append(rec)
+            # 3 s and one record at most
+            self.assertTrue(len(retention) <= 4)
+            self.assertEqual(retention.bytes,
+                             sum(values.nbytes for start, sps, values
+                                 in retention.records()))
+        self.assertEqual([start.length() for start, sps, values
+                          in retention.records()],
+                         [106.0, 107.0, 108.0, 109.0])
+        self.assertEqual(retention.bytes, 40 * 8)
+        # With the new record, before the oldest one is released
+        self.assertEqual(retention.maxBytes, 50 * 8)
+
+        # The samples are copies
+        recs[-1].data().numpy()[:] = 0.0
+        numpy.testing.assert_array_equal(retention.records()[-1][2],
+                                         numpy.arange(10.0))
+
+        # A record longer than the retention is kept
+        retention.append(support.Record(streamID, 110.0, 10.0,
+                                        numpy.arange(50.0)))
+        self.assertEqual(len(retention), 1)
+        self.assertEqual(retention.bytes, 50 * 8)
+        self.assertEqual(retention.maxBytes, 90 * 8)
+
+    def testRaw(self):
+        recs = [RawRecord(streamID, 100.0 + i, 10.0, numpy.arange(10.0))
+                for i in range(10)]
+        processed = waveproc.RecordRetention(3.0)
+        raw = waveproc.RecordRetention(3.0, raw=True)
+        for rec in recs:
+            processed.append(rec)
+            raw.append(rec)
+        self.assertEqual(raw.records()[-1][2].dtype, numpy.int32)
+        self.assertEqual(raw.bytes, 40 * 4)
+        self.assertEqual(processed.bytes, 40 * 8)
+
+        # The decoded samples without the raw ones
+        raw.append(support.Record(streamID, 110.0, 10.0, numpy.arange(10.0)))
+        self.assertEqual(raw.records()[-1][2].dtype, numpy.float64)
+        self.assertEqual(raw.bytes, 30 * 4 + 10 * 8)
+
+
+class TestStreamTable(unittest.TestCase):
+
+    def testTable(self):
+        table = waveproc.StreamTable([('count', numpy.int32, 7),
+                                      ('value', numpy.double, 0.5)])
+        # Beyond the 16 rows allocated first
+        for i in range(40):
+            self.assertEqual(table.add(), i)
+            table.set(i, 'count', table.get(i, 'count') + i)
+        self.assertEqual(len(table), 40)
+        numpy.testing.assert_array_equal(table['count'], 7 + numpy.arange(40))
+        numpy.testing.assert_array_equal(table['value'], 0.5)
+        self.assertEqual(table.get(39, 'count'), 46)
+        self.assertTrue(isinstance(table.get(39, 'value'), float))
+
+        # The columns are views and the rows a copy
+        table['value'][table['count'] > 40] = 2.0
+        rows = table.rows()
+        rows['value'] = 0.0
+        self.assertEqual(list(table['value']).count(2.0), 6)
+
+    def testState(self):
+        inputs = waveproc.StreamTable(waveproc.Preprocessor.streamFields)
+        input = waveproc.StreamInput(streamID, inputs)
+        self.assertEqual(input.key, ('XX', 'S00', '', 'BHZ'))
+        self.assertTrue(numpy.isnan(input.sps))
+        input.sps = 20.0
+        input.avgValue = 300.0
+
+        tables = [waveproc.StreamTable(waveproc.Processor.streamFields)
+                  for i in range(2)]
+        states = [waveproc.StreamState(input, table) for table in tables]
+        for state in states:
+            self.assertEqual((state.streamID, state.key, state.sps,
+                              state.avgValue), (streamID, input.key, 20.0,
+                                                300.0))
+        input.sps = 40.0
+        self.assertEqual(states[1].sps, 40.0)
+        self.assertRaises(AttributeError, setattr, states[0], 'sps', 10.0)
+        self.assertRaises(AttributeError, setattr, input, 'other', 1)
+
+        # A stream rejected by a processor is not rejected by the others nor
+        # by the preprocessing
+        states[0].rejected = True
+        self.assertEqual([state.rejected for state in states], [True, False])
+        self.assertFalse(input.rejected)
+        self.assertEqual(list(tables[0]['rejected']), [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
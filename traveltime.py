@@ -0,0 +1,221 @@
+#! /usr/bin/env python
+
+"""Precomputed grid of P (or Pdiff) travel times.
+
+The grid covers distance x depth and is stored on disk, so that it can be
+loaded once and used to calculate the P arrival of all the stations of an
+event at the same time, instead of calling TravelTimeTable.compute for every
+stream.
+
+The grid is calculated with TravelTimeTable.compute for sources and stations
+on the equator, at sea level, so it includes the ellipticity correction of
+the tables for equatorial paths only. The travel times interpolated differ
+from the exact ones of an event by the error of the interpolation (see
+maxError, which is saved with the grid and logged when it is loaded), plus
+the difference between the ellipticity correction of the actual path and
+the one of the equator, which can reach about one second for teleseismic P
+at high latitudes, plus 0.2 s per km of elevation of the station. The
+magnitude modules compare the grid with the exact travel times of
+"checkStations" stations of every event and calculate all of them exactly
+if the difference exceeds "tolerance".
+
+Building the grid takes some thousands of calls to TravelTimeTable.compute,
+so it is done once from the command line (or by scxxlmag-batch.py)::
+
+    ./traveltime.py ptimes.npz
+"""
+
+import os
+import sys
+import numpy
+import seiscomp3.Logging
+import seiscomp3.Seismology
+
+# Maximum difference (s) accepted between the grid and the exact travel times
+# of the stations of an event
+tolerance = 1.0
+
+# Number of stations of an event whose exact travel times are compared with
+# the grid (besides the highest one)
+checkStations = 8
+
+
+def firstP(ttlist):
+    """Return the travel time of the first P or Pdiff phase in the list
+    or None if there is no such phase."""
+
+    # Check all the entries in the table
+    for tt in ttlist:
+        # until I find the P phase (or similar)
+        if tt.phase == 'P' or tt.phase == 'Pdiff':
+            return tt.time
+    return None
+
+
+class PTravelTimeGrid:
+    """Travel times of the first P/Pdiff phase on a regular grid of distances
+    (deg) and depths (km). Bilinear interpolation is used between the nodes.
+    Nodes without a P phase are stored as NaN."""
+
+    def __init__(self, distances, depths, times, error=None):
+        self.distances = numpy.asarray(distances, dtype=float)
+        self.depths = numpy.asarray(depths, dtype=float)
+        self.times = numpy.asarray(times, dtype=float)
+        # Maximum error of the interpolation (see maxError), None if it is
+        # not known
+        self.error = error
+
+    @classmethod
+    def build(cls, ttt=None, deltaMax=110.0, deltaStep=0.5, depthMax=800.0,
+              depthStep=10.0):
+        """Create the grid with the exact values from a TravelTimeTable."""
+
+        if ttt is None:
+            ttt = seiscomp3.Seismology.TravelTimeTable()
+
+        distances = numpy.arange(0.0, deltaMax + deltaStep / 2.0, deltaStep)
+        depths = numpy.arange(0.0, depthMax + depthStep / 2.0, depthStep)
+        times = numpy.empty((len(distances), len(depths)))
+        times.fill(numpy.nan)
+
+        for i, delta in enumerate(distances):
+            for j, depth in enumerate(depths):
+                try:
+                    t = firstP(ttt.compute(0.0, 0.0, depth, 0.0, delta, 0.0))
+                except Exception, e:
+                    msg = "Exception from ttt.compute(): " + str(e)
+                    seiscomp3.Logging.debug(msg)
+                    continue
+                if t is not None:
+                    times[i, j] = t
+
+        return cls(distances, depths, times)
+
+    @classmethod
+    def load(cls, filename):
+        with numpy.load(filename) as npz:
+            error = float(npz['error']) if 'error' in npz.files else None
+            return cls(npz['distances'], npz['depths'], npz['times'], error)
+
+    def save(self, filename):
+        # Write with a temporary name, so that a grid being written is never
+        # read by another instance of the application
+        tmpName = '%s.%d.tmp' % (filename, os.getpid())
+        arrays = dict(distances=self.distances, depths=self.depths,
+                      times=self.times)
+        if self.error is not None:
+            arrays['error'] = self.error
+        with open(tmpName, 'wb') as fout:
+            numpy.savez(fout, **arrays)
+        os.rename(tmpName, filename)
+
+    def interpolate(self, delta, depth):
+        """Travel time of the P phase for an array of distances (deg) and
+        depths (km). NaN is returned for the points outside the grid or
+        without a P phase."""
+
+        delta = numpy.asarray(delta, dtype=float)
+        depth = numpy.asarray(depth, dtype=float)
+        delta, depth = numpy.broadcast_arrays(delta, depth)
+
+        d0 = self.distances[0]
+        dStep = self.distances[1] - d0
+        z0 = self.depths[0]
+        zStep = self.depths[1] - z0
+
+        x = (delta - d0) / dStep
+        y = (depth - z0) / zStep
+        with numpy.errstate(invalid='ignore'):
+            outside = (x < 0) | (x > len(self.distances) - 1) | \
+                (y < 0) | (y > len(self.depths) - 1) | \
+                numpy.isnan(x) | numpy.isnan(y)
+        x = numpy.where(outside, 0.0, x)
+        y = numpy.where(outside, 0.0, y)
+
+        i = numpy.minimum(numpy.floor(x).astype(int), len(self.distances) - 2)
+        j = numpy.minimum(numpy.floor(y).astype(int), len(self.depths) - 2)
+        fx = x - i
+        fy = y - j
+
+        t = self.times
+        result = (1 - fx) * (1 - fy) * t[i, j] + fx * (1 - fy) * t[i + 1, j] + \
+            (1 - fx) * fy * t[i, j + 1] + fx * fy * t[i + 1, j + 1]
+
+        return numpy.where(outside, numpy.nan, result)
+
+    def maxError(self, ttt=None, deltas=None, depths=None):
+        """Maximum absolute difference (s) between the interpolated and the
+        exact travel times.
+
+        By default the comparison is done in the middle of every cell of the
+        grid, where the interpolation error is expected to be the largest.
+        Points without P phase in one of the two methods are ignored."""
+
+        if ttt is None:
+            ttt = seiscomp3.Seismology.TravelTimeTable()
+
+        if deltas is None:
+            deltas = (self.distances[1:] + self.distances[:-1]) / 2.0
+        if depths is None:
+            depths = (self.depths[1:] + self.depths[:-1]) / 2.0
+
+        deltas, depths = numpy.meshgrid(deltas, depths)
+        deltas = deltas.ravel()
+        depths = depths.ravel()
+
+        interp = self.interpolate(deltas, depths)
+        maxErr = 0.0
+        for delta, depth, t in zip(deltas, depths, interp):
+            if numpy.isnan(t):
+                continue
+            try:
+                exact = firstP(ttt.compute(0.0, 0.0, depth, 0.0, delta, 0.0))
+            except Exception:
+                continue
+            if exact is not None:
+                maxErr = max(maxErr, abs(exact - t))
+
+        return maxErr
+
+
+def loadGrid(filename):
+    """Load the grid from a file. None is returned if the file does not
+    exist, as building it is too slow to be done by the application."""
+
+    if not os.path.exists(filename):
+        seiscomp3.Logging.warning(
+            "P travel time grid %s does not exist, the travel times are "
+            "calculated exactly (create it with './traveltime.py %s')" %
+            (filename, filename))
+        return None
+
+    grid = PTravelTimeGrid.load(filename)
+    if grid.error is None:
+        error = "unknown, create it again with './traveltime.py %s'" % \
+            filename
+    else:
+        error = "%.3f s" % grid.error
+    seiscomp3.Logging.info("P travel time grid loaded from %s: %d "
+                           "distances x %d depths, maximum error of the "
+                           "interpolation %s" %
+                           (filename, len(grid.distances), len(grid.depths),
+                            error))
+    return grid
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: %s filename\n" % sys.argv[0])
+        return 1
+
+    grid = PTravelTimeGrid.build()
+    grid.error = grid.maxError()
+    grid.save(sys.argv[1])
+    print 'Grid %d distances x %d depths saved in %s' % \
+        (len(grid.distances), len(grid.depths), sys.argv[1])
+    print 'Maximum error: %.3f s' % grid.error
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""Binary files with the waveforms and peaks saved for debugging.
+
+Every file contains consecutive (time, value) pairs stored as little-endian
+doubles, without header. They can be read with load() or mapped directly in
+memory, e.g. from another program::
+
+    numpy.memmap(filename, dtype=[('time', '<f8'), ('value', '<f8')])
+"""
+
+import os
+import numpy
+
+dumpType = numpy.dtype([('time', '<f8'), ('value', '<f8')])
+
+
+def _pairs(times, values):
+    result = numpy.empty(len(times), dtype=dumpType)
+    result['time'] = times
+    result['value'] = values
+    return result
+
+
+class DumpFile:
+    """File to which (time, value) pairs are appended. They are kept in
+    memory and written in one go when "bufferSize" pairs are pending or
+    flush() is called.
+
+    output: function used to call the functions that write to disk (e.g.
+            OutputWriter.submit). By default they are called directly.
+    append: function used to call the ones that append the data (e.g.
+            OutputWriter.append, whose tasks can be discarded). By default,
+            "output"."""
+
+    def __init__(self, filename, bufferSize=4096, output=None, append=None):
+        self.filename = filename
+        self.bufferSize = bufferSize
+        self._output = output if output is not None else \
+            lambda function, *args: function(*args)
+        self._append = append if append is not None else self._output
+        self._chunks = []
+        self._pending = 0
+
+        # Data from a previous run is discarded
+        self._output(self._truncate)
+
+    def append(self, times, values):
+        if not len(times):
+            return
+        self._chunks.append(_pairs(times, values))
+        self._pending += len(times)
+        if self._pending >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        if not self._chunks:
+            return
+        self._append(self._write, self._chunks)
+        self._chunks = []
+        self._pending = 0
+
+    def _truncate(self):
+        open(self.filename, 'wb').close()
+
+    def _write(self, chunks):
+        with open(self.filename, 'ab') as fout:
+            for chunk in chunks:
+                chunk.tofile(fout)
+
+
+def save(filename, times, values):
+    """Write a complete file."""
+
+    with open(filename, 'wb') as fout:
+        _pairs(times, values).tofile(fout)
+
+
+def load(filename):
+    """Array with the fields "time" and "value" mapped to the file."""
+
+    if not os.path.getsize(filename):
+        return numpy.zeros(0, dtype=dumpType)
+    return numpy.memmap(filename, dtype=dumpType, mode='r')
@@ -1,6 +1,10 @@
 import os
 import glob
+import bisect
+import numpy
+import collections
 import seiscomp3.Math
+import streamstats
 import seiscomp3.Logging
 
 
@@ -13,7 +17,1010 @@ class Event:
         self.dep = dep
 
 
+class InventoryIndex:
+    """Index of the locations of an inventory with the coordinates of their
+    stations.
+
+    It is built once from the dictionary created by the application (keys
+    (net,), (net, sta), (net, sta, loc) and (net, sta, loc, cha)) and allows
+    to select the locations inside a distance range of an event with
+    vectorized operations."""
+
+    def __init__(self, inventory):
+        self.inventory = inventory
+
+        # Only items at the location level
+        self.locations = [key for key in inventory
+                          if isinstance(key, tuple) and len(key) == 3]
+
+        self.latitude = numpy.array([inventory[key[:2]].latitude()
+                                     for key in self.locations], dtype=float)
+        self.longitude = numpy.array([inventory[key[:2]].longitude()
+                                      for key in self.locations], dtype=float)
+
+        # Preferred streams per location for every list of channels
+        self._streams = dict()
+
+    def __len__(self):
+        return len(self.locations)
+
+    def streams(self, channels):
+        """List with the keys of the selected streams for every location.
+
+        The streams are selected from the first channel type in "channels"
+        (e.g. BH, HH, SH...) with a vertical (Z or 3) component. The list is
+        empty if no suitable channel type was found."""
+
+        channels = tuple(channels)
+        if channels in self._streams:
+            return self._streams[channels]
+
+        result = []
+        for net, sta, loc in self.locations:
+            selected = []
+            for ch in channels:
+                for c in "Z3":
+                    if (net, sta, loc, ch + c) in self.inventory:
+                        selected.append((net, sta, loc, ch + c))
+                if selected:
+                    break
+            result.append(selected)
+
+        self._streams[channels] = result
+        return result
+
+    def distances(self, lat, lon):
+        """Great circle distance (deg) from a point to all the locations."""
+
+        lat1 = numpy.radians(lat)
+        lat2 = numpy.radians(self.latitude)
+        dlat = lat2 - lat1
+        dlon = numpy.radians(self.longitude - lon)
+        aux = numpy.sin(dlat / 2.0) ** 2 + \
+            numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(dlon / 2.0) ** 2
+        return numpy.degrees(2.0 * numpy.arcsin(numpy.sqrt(numpy.clip(aux, 0.0,
+                                                                      1.0))))
+
+    def within(self, lat, lon, deltaMin, deltaMax, margin=0.5):
+        """Positions of the locations between deltaMin and deltaMax degrees.
+
+        The distances are first estimated for all the locations at once. Only
+        the locations closer than "margin" degrees to one of the limits are
+        checked again with seiscomp3.Math.delazi, so that the selection is the
+        same as computing the distance to every location."""
+
+        if not len(self.locations):
+            return []
+
+        dist = self.distances(lat, lon)
+        inside = (dist >= deltaMin + margin) & (dist <= deltaMax - margin)
+        border = ((dist > deltaMin - margin) & (dist < deltaMin + margin)) | \
+            ((dist > deltaMax - margin) & (dist < deltaMax + margin))
+
+        for pos in numpy.flatnonzero(border & ~inside):
+            delta, az, baz = seiscomp3.Math.delazi(lat, lon,
+                                                   self.latitude[pos],
+                                                   self.longitude[pos])
+            inside[pos] = deltaMin <= delta <= deltaMax
+
+        return numpy.flatnonzero(inside).tolist()
+
+
+class StationGeometry:
+    """Geometry of the stations with respect to an event.
+
+    Coordinates, epicentral distance, azimuth and a correction depending on
+    the distance and the depth of the event are calculated once per event and
+    kept in numpy arrays. The position of a station in the arrays can be found
+    in "row", which is indexed by (net, sta)."""
+
+    def __init__(self, event, stations, correction=None):
+        """event: waveproc.Event
+        stations: dict of SC3 stations indexed by (net, sta)
+        correction: function receiving distance (deg) and depth (km)"""
+
+        keys = sorted(stations)
+        nsta = len(keys)
+
+        self.row = dict()
+        self.latitude = numpy.zeros(nsta)
+        self.longitude = numpy.zeros(nsta)
+        self.delta = numpy.zeros(nsta)
+        self.azimuth = numpy.zeros(nsta)
+        self.correction = numpy.zeros(nsta)
+
+        for pos, key in enumerate(keys):
+            s = stations[key]
+            self.row[key] = pos
+            self.latitude[pos] = s.latitude()
+            self.longitude[pos] = s.longitude()
+            delta, az, baz = seiscomp3.Math.delazi(event.lat, event.lon,
+                                                   s.latitude(),
+                                                   s.longitude())
+            self.delta[pos] = delta
+            self.azimuth[pos] = az
+            if correction is not None:
+                corr = correction(delta, event.dep)
+                self.correction[pos] = corr if corr is not None else \
+                    numpy.nan
+
+    def __len__(self):
+        return len(self.row)
+
+    def distance(self, net, sta):
+        """Epicentral distance (deg) of a station"""
+        return float(self.delta[self.row[net, sta]])
+
+    def distanceCorrection(self, net, sta):
+        """Correction for the distance and depth of a station"""
+        return float(self.correction[self.row[net, sta]])
+
+
+class ReorderBuffer:
+    """Records of a stream sorted by start time.
+
+    A record is released when it is contiguous to the last record released
+    or when there are "holdTime" seconds of newer data. Exact duplicates and
+    records arriving after newer data was released are discarded."""
+
+    def __init__(self, holdTime=0.0):
+        self.holdTime = holdTime
+        # Function called with every record discarded because it arrived too
+        # late
+        self.onLate = None
+
+        # Records held as (start, end, record)
+        self._records = []
+        # End of the newest record received and of the last one released
+        self._newest = None
+        self._lastEnd = None
+        # Tolerance to consider two records contiguous (half a sample)
+        self._tolerance = 0.0
+        # Start and end of the last records released to find duplicates
+        self._released = collections.deque(maxlen=64)
+
+        # Counters
+        self.reordered = 0
+        self.duplicates = 0
+        self.late = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def push(self, rec):
+        """Add a record. The list of records released is returned."""
+
+        start = rec.startTime().length()
+        end = rec.endTime().length()
+
+        if self._lastEnd is not None and end <= self._lastEnd:
+            if (start, end) in self._released:
+                self.duplicates += 1
+            else:
+                self._late(rec)
+            return []
+
+        pos = bisect.bisect_left(self._records, (start, end))
+        if pos < len(self._records) and \
+                self._records[pos][:2] == (start, end):
+            self.duplicates += 1
+            return []
+        if pos < len(self._records):
+            self.reordered += 1
+        self._records.insert(pos, (start, end, rec))
+
+        self._tolerance = 0.5 / rec.samplingFrequency()
+        self._newest = end if self._newest is None else \
+            max(self._newest, end)
+
+        return self._release()
+
+    def flush(self):
+        """Release all the records."""
+
+        return self._release(True)
+
+    def _release(self, all=False):
+        released = []
+        while self._records:
+            start, end, rec = self._records[0]
+            contiguous = self._lastEnd is not None and \
+                abs(start - self._lastEnd) <= self._tolerance
+            if not (all or contiguous or
+                    self._newest - start >= self.holdTime):
+                break
+
+            del self._records[0]
+            # Overlapped completely by the records released
+            if self._lastEnd is not None and end <= self._lastEnd:
+                self._late(rec)
+                continue
+
+            released.append(rec)
+            self._lastEnd = end
+            self._released.append((start, end))
+
+        return released
+
+    def _late(self, rec):
+        self.late += 1
+        if self.onLate is not None:
+            self.onLate(rec)
+
+
+class RecordRetention:
+    """Samples of the last records of a stream, up to "length" seconds
+    before the end of the newest one.
+
+    The samples are copied from the records, so that the processing does not
+    modify them. With raw, the samples are kept as they were received
+    (rec.raw(), e.g. integers for compressed miniSEED) instead of the decoded
+    doubles, if the record has them.
+
+    The memory used is at most the samples of "length" seconds plus one
+    record. It is given by "bytes" (and the maximum reached by "maxBytes")."""
+
+    def __init__(self, length, raw=False):
+        self.length = length
+        self.raw = raw
+        # (start time, sampling frequency, samples) per record
+        self._records = collections.deque()
+        self.bytes = 0
+        self.maxBytes = 0
+
+    def append(self, rec):
+        values = None
+        if self.raw and rec.raw() is not None:
+            values = rec.raw().numpy()
+        if values is None:
+            values = rec.data().numpy()
+        values = numpy.array(values)
+
+        self._records.append((rec.startTime(), rec.samplingFrequency(),
+                              values))
+        self.bytes += values.nbytes
+        self.maxBytes = max(self.maxBytes, self.bytes)
+
+        # Records ending before the retention period are released
+        limit = rec.endTime() - seiscomp3.Core.TimeSpan(self.length)
+        while len(self._records) > 1:
+            start, sps, values = self._records[0]
+            if start + seiscomp3.Core.TimeSpan(len(values) / sps) >= limit:
+                break
+            self._records.popleft()
+            self.bytes -= values.nbytes
+
+    def records(self):
+        """List of (start time, sampling frequency, samples)."""
+
+        return list(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+
+class Quarantine:
+    """Streams whose records are discarded and the reason."""
+
+    def __init__(self):
+        self.reasons = dict()
+
+    def add(self, streamID, reason):
+        """Returns False if the stream was already in quarantine."""
+
+        if streamID in self.reasons:
+            return False
+        self.reasons[streamID] = reason
+        return True
+
+    def __contains__(self, streamID):
+        return streamID in self.reasons
+
+    def __iter__(self):
+        return iter(self.reasons)
+
+    def __len__(self):
+        return len(self.reasons)
+
+
+class Block:
+    """Samples of a stream which were not received in a record, e.g. the
+    ones created to fill a gap. It provides the methods of a record used by
+    the processors."""
+
+    def __init__(self, streamID, start, sps, values):
+        self._streamID = streamID
+        self._start = start
+        self._sps = sps
+        self._values = values
+        # Position of the first sample of every record joined in the block
+        # (None if it is not a batch)
+        self.recordStarts = None
+        # Signal filtered by the preprocessing in every band requested by the
+        # processors (None if there is no filter bank, see Preprocessor)
+        self.filtered = None
+
+    def streamID(self):
+        return self._streamID
+
+    def startTime(self):
+        return self._start
+
+    def endTime(self):
+        return self._start + seiscomp3.Core.TimeSpan(
+            len(self._values) / self._sps)
+
+    def samplingFrequency(self):
+        return self._sps
+
+    def data(self):
+        return self
+
+    def numpy(self):
+        return self._values
+
+    def raw(self):
+        return None
+
+
+def recordLimits(rec, pos):
+    """First and last position (excluded) of the record which contained the
+    sample "pos" of a block. Batches join several records (see
+    Preprocessor.batchSize)."""
+
+    nsamp = len(rec.data().numpy())
+    starts = getattr(rec, 'recordStarts', None)
+    if starts is None:
+        return 0, nsamp
+
+    k = numpy.searchsorted(starts, pos, 'right') - 1
+    return int(starts[k]), int(starts[k + 1]) if k + 1 < len(starts) else \
+        nsamp
+
+
+class StreamTable:
+    """Numeric attributes of all the streams of a processor in contiguous
+    numpy arrays, one row per stream, so that they can be processed at once
+    (e.g. table['duration'][table['stage'] == 3]).
+
+    The arrays are reallocated when they are full, so the arrays returned
+    by table[name] must not be kept after a row is added."""
+
+    def __init__(self, fields):
+        """fields: list of (name, numpy type, value of a new row)"""
+
+        self.dtype = numpy.dtype([(name, kind) for name, kind, d in fields])
+        self._defaults = tuple(default for n, k, default in fields)
+        self._data = numpy.zeros(16, dtype=self.dtype)
+        self.size = 0
+
+    def add(self):
+        """Add a row with the default values and return its position."""
+
+        if self.size == len(self._data):
+            data = numpy.zeros(2 * len(self._data), dtype=self.dtype)
+            data[:self.size] = self._data[:self.size]
+            self._data = data
+        self._data[self.size] = self._defaults
+        self.size += 1
+        return self.size - 1
+
+    def get(self, row, name):
+        return self._data[name][row].item()
+
+    def set(self, row, name, value):
+        self._data[name][row] = value
+
+    def __getitem__(self, name):
+        return self._data[name][:self.size]
+
+    def rows(self):
+        """Copy of all the rows (structured array)."""
+
+        return self._data[:self.size].copy()
+
+    def __len__(self):
+        return self.size
+
+
+def tableField(name):
+    """Attribute of a StreamInput or StreamState stored in the row of the
+    stream in a StreamTable."""
+
+    return property(lambda self: self.table.get(self.row, name),
+                    lambda self, value: self.table.set(self.row, name, value),
+                    doc="Column '%s' of the stream table" % name)
+
+
+def inputField(name):
+    """Attribute of a StreamState read from the StreamInput of the
+    stream."""
+
+    return property(lambda self: getattr(self.input, name),
+                    doc="Attribute '%s' of the stream input" % name)
+
+
+class StreamInput(object):
+    """State of the preprocessing of a stream, shared by all the processors
+    which requested it (see Preprocessor).
+
+    It is created with the first record of the stream, so that the stream ID
+    is split and the values depending on it are looked up once."""
+
+    __slots__ = ('streamID', 'key', 'table', 'row', 'gain', 'window',
+                 'timeStream', 'avgValue', 'baseline', 'lastSample', 'buffer',
+                 'retained', 'batch', 'batchSamples', 'bands', 'filterRow',
+                 'states')
+
+    def __init__(self, streamID, table):
+        self.streamID = streamID
+        # (net, sta, loc, cha)
+        self.key = tuple(streamID.split('.'))
+        self.table = table
+        self.row = table.add()
+        self.gain = None
+        # Time window requested by all the processors (from, to)
+        self.window = None
+        # End of the last record accepted (None until the first one)
+        self.timeStream = None
+        # Average value to center the signal (None until it is calculated)
+        # and the statistics to calculate it
+        self.avgValue = None
+        self.baseline = None
+        # Last sample received (to fill gaps)
+        self.lastSample = None
+        # Records waiting to be processed in chronological order
+        self.buffer = None
+        # Last records kept (RecordRetention)
+        self.retained = None
+        # Contiguous blocks waiting to be processed together and their
+        # number of samples
+        self.batch = []
+        self.batchSamples = 0
+        # Bands of the filter bank requested by the processors and handle of
+        # the state of the filters (created with the first block delivered)
+        self.bands = []
+        self.filterRow = None
+        # Processors which requested the stream and their StreamState
+        self.states = []
+
+    # Samples/second
+    sps = tableField('sps')
+    # Time (seconds) when the stream actually starts
+    startTime = tableField('startTime')
+    # The stream is in quarantine (for all the processors)
+    rejected = tableField('rejected')
+
+
+class StreamState(object):
+    """State of the processing of a stream by a processor.
+
+    The magnitude modules derive it to add their own attributes (__slots__)
+    and columns of the StreamTable (see Processor.streamFields). The
+    attributes of the preprocessing are read from the StreamInput."""
+
+    __slots__ = ('streamID', 'key', 'table', 'row', 'input')
+
+    def __init__(self, input, table):
+        self.streamID = input.streamID
+        self.key = input.key
+        self.table = table
+        self.row = table.add()
+        self.input = input
+
+    sps = inputField('sps')
+    startTime = inputField('startTime')
+    gain = inputField('gain')
+    avgValue = inputField('avgValue')
+    timeStream = inputField('timeStream')
+    # The stream is in quarantine for this processor
+    rejected = tableField('rejected')
+
+
+def processorInputs(processors):
+    """Objects to feed with the records of the given processors: the
+    preprocessing stages they are registered to, each one once, or the
+    processors themselves if they do not have one (e.g.
+    streampool.ProcessorPool)."""
+
+    result = []
+    for processor in processors:
+        input = getattr(processor, 'input', processor)
+        if not [i for i in result if i is input]:
+            result.append(input)
+    return result
+
+
+class Preprocessor:
+    """Preprocessing of the records shared by the processors of an event.
+
+    The records of every stream are checked once (time window, order, gaps),
+    scaled with the gain of the stream and centered with the average of its
+    first "peepAvg" seconds. The resulting blocks are passed to the
+    process() method of every processor registered which requested the
+    stream, as read-only arrays, so that every magnitude module only adds
+    the cost of its own processing.
+
+    If there is a filter bank, the blocks are also filtered once in the
+    bands requested by the processors (Processor.filterBands). The blocks
+    of all the streams delivered together (e.g. the batches flushed before
+    an update) are filtered in a single call per band."""
+
+    # Columns of the StreamTable (name, numpy type, initial value)
+    streamFields = [('sps', numpy.double, numpy.nan),
+                    ('startTime', numpy.double, numpy.nan),
+                    ('rejected', numpy.bool_, False)]
+
+    def __init__(self):
+        # Processors fed by this stage
+        self.processors = []
+
+        # Input of every stream (StreamInput) by stream ID and in the order
+        # of the rows of the table with their numeric attributes
+        self.streams = dict()
+        self.inputs = []
+        self.table = StreamTable(self.streamFields)
+
+        # Center the signal with the mean of the first seconds of the stream
+        # without the samples further from their median than "spikeLimit"
+        # times their median absolute deviation (for streams with spikes)
+        self.robustBaseline = False
+        self.spikeLimit = 5.0
+
+        # Number of seconds from the beginning of the signal to be used in the
+        # calculation of the average value.
+        self.peepAvg = 20
+
+        # Seconds of the last accepted records kept for each stream (see
+        # RecordRetention). By default they are released once processed.
+        self.retention = 0.0
+        # Keep the samples as received instead of the decoded ones
+        self.retainRaw = False
+
+        # Seconds of newer data to wait for a record which is missing before
+        # processing the next ones. With 0, the records must arrive in
+        # chronological order and a stream is discarded if one of its
+        # records ends before the previous one.
+        self.holdTime = 0.0
+
+        # Gaps up to "fillGap" seconds are filled with samples interpolated
+        # linearly ("linear") or with the average of the signal ("zero"), or
+        # not filled at all (None, the record is processed as if it followed
+        # the previous one). After a longer gap, up to "maxGap" seconds, the
+        # processing of the stream is resumed (see Processor.resume). Streams
+        # with longer gaps are discarded. By default nothing is filled or
+        # resumed.
+        self.gapFill = None
+        self.fillGap = 5.0
+        self.maxGap = 5.0
+        # Number of gaps filled and resumed
+        self.gapsFilled = 0
+        self.gapsResumed = 0
+        # Number of records overlapping the samples already processed, which
+        # were trimmed
+        self.overlapsTrimmed = 0
+
+        # Once the average of a stream is calculated, its records are
+        # processed in batches of at least "batchSize" samples (or when
+        # flush() is called, e.g. before every update). 0 to process every
+        # record as it arrives.
+        self.batchSize = 0
+        # Number of batches processed, records (or blocks) and samples in
+        # them and maximum number of samples of a batch
+        self.batches = 0
+        self.batchedBlocks = 0
+        self.batchedSamples = 0
+        self.maxBatch = 0
+
+        # Filters applied to the scaled signal (before centering it) of all
+        # the streams (filterbank.FilterBank). None to let every processor
+        # filter the signal itself.
+        self.filterBank = None
+
+        # All the records were processed (see finish)
+        self._finished = False
+
+    def register(self, processor):
+        """Feed a processor with the records of this stage. It must be
+        registered before the first record is received."""
+
+        processor.input = self
+        self.processors.append(processor)
+
+    def feed(self, rec):
+        """Check that the record is inside the requested timewindow and add
+        it to the reordering buffer of its stream. The records released by
+        the buffer are checked (see _accept) and passed to the
+        processors."""
+
+        # Read the streamID
+        streamID = rec.streamID()
+        input = self.streams.get(streamID)
+
+        if input is None:
+            input = self._addStream(streamID)
+            # Check that the stream was requested
+            if input is None:
+                return False
+        if input.rejected:
+            # The record belongs to an already discarded stream
+            return False
+
+        # Check that the beginning of the record (+30 seconds) is inside the
+        # timewindow
+        t_from, t_to = input.window
+        if (rec.startTime() > t_to) or (rec.endTime() < t_from):
+            return False
+
+        # Without reordering, check that the new record comes in
+        # chronological order
+        if self.holdTime <= 0 and input.timeStream is not None and \
+                rec.endTime() < input.timeStream:
+            msg = "Record in wrong order! %s : '%s' before '%s'" % \
+                (streamID, rec.endTime(), input.timeStream)
+            seiscomp3.Logging.error(msg)
+            self._processBatch(input)
+            self._reject(input, "record in wrong order")
+            return False
+
+        self._release(input, input.buffer.push(rec))
+        return True
+
+    def _addStream(self, streamID):
+        """Create the input of a stream and the states of the processors
+        which requested it. None if no processor requested it."""
+
+        key = tuple(streamID.split('.'))
+        processors = [p for p in self.processors if key in p.timeWinDict]
+        if not processors:
+            return None
+
+        input = StreamInput(streamID, self.table)
+        input.gain = processors[0].getGain(*key)
+        # The time windows of all the processors are merged
+        windows = [p.timeWinDict[key] for p in processors]
+        input.window = (min(w[0] for w in windows),
+                        max(w[1] for w in windows))
+        input.buffer = ReorderBuffer(self.holdTime)
+        input.buffer.onLate = lambda rec: seiscomp3.Logging.warning(
+            "Record arrived too late! %s : '%s' till '%s' (discarded)" %
+            (streamID, rec.startTime(), rec.endTime()))
+        input.bands = sorted(set(band for p in processors
+                                 for band in p.filterBands))
+        input.states = [(p, p._addStream(input)) for p in processors]
+        input.rejected = all(state.rejected for p, state in input.states)
+        self.streams[streamID] = input
+        self.inputs.append(input)
+        return input
+
+    def _release(self, input, records):
+        """Check and process the records released by a buffer."""
+
+        for rec in records:
+            if input.rejected:
+                return
+            for block in self._accept(input, rec):
+                self._queue(input, block)
+
+    def _queue(self, input, block):
+        """Process a block, or add it to the batch of its stream."""
+
+        if self.batchSize <= 0 or input.avgValue is None:
+            self._average(input, block)
+            self._deliver([(input, block)])
+            return
+
+        input.batch.append(block)
+        input.batchSamples += len(block.data().numpy())
+        if input.batchSamples >= self.batchSize:
+            self._processBatch(input)
+
+    def _processBatch(self, input):
+        """Process the blocks of the batch of a stream as a single one."""
+
+        block = self._takeBatch(input)
+        if block is not None:
+            self._deliver([(input, block)])
+
+    def _takeBatch(self, input):
+        """Join the blocks of the batch of a stream in a single one and
+        empty it. None if there is nothing to process."""
+
+        blocks = input.batch
+        if not blocks:
+            return None
+
+        input.batch = []
+        input.batchSamples = 0
+        if len(blocks) == 1:
+            block = blocks[0]
+        else:
+            values = [b.data().numpy() for b in blocks]
+            block = Block(input.streamID, blocks[0].startTime(),
+                          blocks[0].samplingFrequency(),
+                          numpy.concatenate(values))
+            block.recordStarts = numpy.cumsum(
+                [0] + [len(v) for v in values[:-1]])
+
+        nsamp = len(block.data().numpy())
+        self.batches += 1
+        self.batchedBlocks += len(blocks)
+        self.batchedSamples += nsamp
+        self.maxBatch = max(self.maxBatch, nsamp)
+
+        return block
+
+    def _deliver(self, pending):
+        """Pass records (or blocks) to the processors of their streams
+        (list of (input, record)), scaled with the gain and centered around
+        0 by substracting the average of the first "peepAvg" seconds (0
+        while it is calculated)."""
+
+        blocks = []
+        for input, rec in pending:
+            # The operations are done in double precision
+            avg = input.avgValue if input.avgValue is not None else 0
+            values = rec.data().numpy().astype(numpy.double) / input.gain - \
+                avg
+            # Shared by all the processors
+            values.flags.writeable = False
+
+            block = Block(input.streamID, rec.startTime(),
+                          rec.samplingFrequency(), values)
+            block.recordStarts = getattr(rec, 'recordStarts', None)
+            blocks.append((input, block, avg))
+
+        if self.filterBank is not None:
+            self._filter(blocks)
+
+        for input, block, avg in blocks:
+            if input.rejected:
+                continue
+            for processor, state in input.states:
+                if not state.rejected:
+                    processor.process(state, block)
+
+    def _filter(self, blocks):
+        """Filter the blocks of several streams (list of (input, block,
+        average)) in the bands requested for them."""
+
+        bank = self.filterBank
+        byBand = dict()
+        for input, block, avg in blocks:
+            block.filtered = dict()
+            if not input.bands:
+                continue
+            if input.filterRow is None:
+                try:
+                    input.filterRow = bank.addStream(input.sps, input.bands)
+                except ValueError, e:
+                    seiscomp3.Logging.error("%s: %s" % (input.streamID, e))
+                    self._reject(input, "filter cannot be applied")
+                    continue
+            for band in input.bands:
+                byBand.setdefault(band, []).append((input, block, avg))
+
+        for band in sorted(byBand):
+            items = byBand[band]
+            # The average is included to avoid a "jump" when it is
+            # calculated and the signal is "re-centered". In any case the
+            # filters remove it.
+            filtered = bank.filter(band, [i[0].filterRow for i in items],
+                                   [i[1].numpy() + i[2] for i in items])
+            for (input, block, avg), values in zip(items, filtered):
+                values.flags.writeable = False
+                block.filtered[band] = values
+
+    def flush(self):
+        """Process the batches of all the streams."""
+
+        pending = []
+        for input in self.inputs:
+            block = self._takeBatch(input)
+            if block is not None:
+                pending.append((input, block))
+        if pending:
+            self._deliver(pending)
+
+    def _fill(self, input, rec, missing):
+        """Block with the samples missing before a record. They are doubles
+        whatever the type of the samples of the record, as the signal
+        delivered to the processors."""
+
+        data = rec.data().numpy()
+        if self.gapFill == 'zero' and input.avgValue is not None:
+            values = numpy.empty(missing)
+            values.fill(input.avgValue * input.gain)
+        else:
+            values = numpy.linspace(input.lastSample, data[0],
+                                    missing + 2)[1:-1]
+
+        return Block(input.streamID, input.timeStream,
+                     rec.samplingFrequency(),
+                     numpy.asarray(values, dtype=numpy.double))
+
+    def _accept(self, input, rec):
+        """Check the gaps before a record. The records are received in
+        chronological order, but a record can start before the end of the
+        previous one (the buffer discards the ones overlapped completely).
+
+        Returns the list of blocks to process: the record preceded by the
+        samples filling a gap, the part of the record after the samples
+        already processed, or nothing if the stream is discarded."""
+
+        streamID = input.streamID
+        rStart = rec.startTime()
+        rEnd = rec.endTime()
+        blocks = [rec]
+
+        if input.timeStream is None:
+            # The start time of the record is kept in order to check
+            # that the records come in order. I tried keeping end time
+            # and compare it with the start time of the next one but
+            # there is a minimum overlapping.
+            input.startTime = rStart.length()
+            input.timeStream = rEnd
+            input.sps = rec.samplingFrequency()
+        else:
+            # Check that there is no gap longer than "maxGap" seconds
+            if (rStart > (input.timeStream +
+                          seiscomp3.Core.TimeSpan(self.maxGap))):
+                msg = "Gap between records! %s : '%s' till '%s'" % \
+                    (streamID, input.timeStream, rStart)
+                seiscomp3.Logging.error(msg)
+                self._processBatch(input)
+                self._reject(input, "gap of %.1f s" %
+                             (rStart - input.timeStream).length())
+                return []
+
+            gap = (rStart - input.timeStream).length()
+            missing = int(round(gap * input.sps))
+            if missing > 0:
+                msg = "Gap between records! %s : '%s' till '%s'" % \
+                    (streamID, input.timeStream, rStart)
+                if gap <= self.fillGap:
+                    if self.gapFill is not None:
+                        seiscomp3.Logging.warning(msg + " (filled)")
+                        blocks.insert(0, self._fill(input, rec, missing))
+                        self.gapsFilled += 1
+                else:
+                    seiscomp3.Logging.warning(msg + " (resumed)")
+                    # The samples before the gap are processed first
+                    self._processBatch(input)
+                    if input.filterRow is not None:
+                        self.filterBank.reset(input.filterRow)
+                    for processor, state in input.states:
+                        if not state.rejected:
+                            processor.resume(state, missing)
+                    self.gapsResumed += 1
+            elif missing < 0:
+                # The samples already processed are not processed again
+                data = rec.data().numpy()
+                if -missing >= len(data):
+                    return []
+                seiscomp3.Logging.warning(
+                    "Overlapping records! %s : '%s' before '%s' (trimmed)" %
+                    (streamID, rStart, input.timeStream))
+                rec = Block(streamID,
+                            rStart + seiscomp3.Core.TimeSpan(-missing /
+                                                             input.sps),
+                            rec.samplingFrequency(), data[-missing:])
+                blocks = [rec]
+                self.overlapsTrimmed += 1
+
+            input.timeStream = rEnd
+
+        self._retain(input, rec)
+
+        input.lastSample = rec.data().numpy()[-1]
+
+        return blocks
+
+    def _retain(self, input, rec):
+        """Keep the samples of an accepted record, if requested."""
+
+        if self.retention <= 0:
+            return
+
+        if input.retained is None:
+            input.retained = RecordRetention(self.retention, self.retainRaw)
+        input.retained.append(rec)
+
+    def _average(self, input, rec):
+        """Calculate the average of the first "peepAvg" seconds of the
+        stream."""
+
+        # If the average was already calculated there is nothing to do
+        if input.avgValue is not None:
+            return
+
+        if input.baseline is None:
+            input.baseline = streamstats.RunningStats(self.robustBaseline)
+
+        # Samples up to the first one after the limit are included
+        limitTime = input.startTime + self.peepAvg
+        limitPos = (limitTime - rec.startTime().length()) * \
+            rec.samplingFrequency()
+        last = max(0, int(numpy.floor(limitPos)) + 1)
+
+        data = rec.data().numpy()
+        stats = input.baseline
+        stats.add(data[:last + 1].astype(numpy.double) / input.gain)
+
+        if last < len(data):
+            # I'm done calculating the average!
+            input.avgValue = stats.robustMean(self.spikeLimit) \
+                if stats.robust else stats.mean()
+            input.baseline = None
+
+    def _reject(self, input, reason):
+        """Discard a stream for all the processors."""
+
+        input.rejected = True
+        input.retained = None
+        for processor, state in input.states:
+            processor._reject(input.streamID, reason)
+
+    def finish(self):
+        """Process all the records still pending and log the counters. Only
+        the first call does anything, so that every processor registered can
+        call it."""
+
+        if self._finished:
+            return
+        self._finished = True
+
+        # Process the records still waiting in the buffers
+        for input in self.inputs:
+            self._release(input, input.buffer.flush())
+        self.flush()
+
+        names = ','.join(p.name for p in self.processors)
+        buffers = [input.buffer for input in self.inputs]
+        seiscomp3.Logging.info("Preprocessing %s: %d records reordered, "
+                               "%d duplicated, %d late, %d overlaps trimmed, "
+                               "%d gaps filled, %d gaps resumed, "
+                               "%d streams discarded" %
+                               (names,
+                                sum(b.reordered for b in buffers),
+                                sum(b.duplicates for b in buffers),
+                                sum(b.late for b in buffers),
+                                self.overlapsTrimmed,
+                                self.gapsFilled, self.gapsResumed,
+                                sum(1 for input in self.inputs
+                                    if input.rejected)))
+        if self.batches:
+            seiscomp3.Logging.info(
+                "Preprocessing %s: %d batches, %.1f records and %.0f "
+                "samples per batch on average, max. %d samples" %
+                (names, self.batches,
+                 self.batchedBlocks / float(self.batches),
+                 self.batchedSamples / float(self.batches), self.maxBatch))
+        bank = self.filterBank
+        if bank is not None and bank.calls:
+            seiscomp3.Logging.info(
+                "Preprocessing %s: %d blocks and %d samples filtered in %d "
+                "calls, %.1f blocks per call on average" %
+                (names, bank.blocks, bank.samples, bank.calls,
+                 bank.blocks / float(bank.calls)))
+        retained = [input.retained for input in self.inputs
+                    if input.retained is not None]
+        if retained:
+            seiscomp3.Logging.info(
+                "Preprocessing %s: %.1f MB of records retained (max. %.1f "
+                "MB)" % (names, sum(r.bytes for r in retained) / 1048576.0,
+                         sum(r.maxBytes for r in retained) / 1048576.0))
+
+
 class Processor:
+    # Class of the state of the streams and columns of the StreamTable
+    # (name, numpy type, initial value)
+    stateClass = StreamState
+    streamFields = [('rejected', numpy.bool_, False)]
+    # Bands in which the preprocessing should filter the signal, if it has a
+    # filter bank (see Block.filtered), e.g. "BW(4, 1, 3)"
+    filterBands = []
+
     def __init__(self, dumpWaveforms=False):
         self.event = None
         self.gain = dict()
@@ -23,29 +1030,41 @@ class Processor:
         # Timewindows requested
         self.timeWinDict = dict()
 
-        # Samples/second
-        self.sps = dict()
+        # State of every stream (StreamState) by stream ID and in the order
+        # of the rows of the table with their numeric attributes
+        self.streams = dict()
+        self.states = []
+        self.table = StreamTable(self.streamFields)
 
-        # Record when the timewindow actually starts
-        self.startTime = dict()
+        # Streams whose records will be rejected because they have gaps
+        # or other problems
+        self.quarantine = Quarantine()
+        # Function called with the ID of a stream when it is put in
+        # quarantine (e.g. to stop receiving its records)
+        self.onReject = None
 
-        # Average value for this stream to be used to center the signal inc ase
-        # of a wrong offset
-        self.avgValue = dict()
+        # Preprocessing stage feeding the processor (Preprocessor). It has
+        # its own one unless it is registered to one shared with other
+        # processors.
+        self.input = None
+        Preprocessor().register(self)
 
-        # Number of seconds from the beginning of the signal to be used in the
-        # calculation of the average value.
-        self.peepAvg = 20
+        # Geometry of the selected stations w.r.t. the event
+        self.geometry = None
 
-        # To check the proper order of records and possible gaps
-        self._timeStream = dict()
+        # Precomputed P travel times (traveltime.PTravelTimeGrid). If it is
+        # not set, the travel times are calculated for every station.
+        self.tttGrid = None
 
-        # List of accepted incoming records for each stream
-        self._incoming = dict()
+        # Directory where the results and waveforms are saved
+        self.outputDir = '.'
+        # Writer of the files in the background (outputwriter.OutputWriter).
+        # If it is not set, the files are written immediately.
+        self.writer = None
 
-        # List of streams whose records will be rejected because they have
-        # gaps or are not in chronological order
-        self._wrongStreams = []
+    # Number of seconds from the beginning of the signal used to calculate
+    # its average (see Preprocessor)
+    peepAvg = property(lambda self: self.input.peepAvg)
 
     def timeWindows(self, rec):
         """This method MUST be implemented in the derived class."""
@@ -53,97 +1072,107 @@ class Processor:
         pass
 
     def feed(self, rec):
-        """Only check that the record is inside the requested timewindow."""
+        """Pass a record to the preprocessing stage of the processor. If it
+        is shared with other processors, it should be fed directly (see
+        processorInputs)."""
 
-        # Read the streamID
-        streamID = rec.streamID()
-        n, s, l, c = streamID.split('.')
-
-        # Check if the record belongs to an already discarded stream
-        if streamID in self._wrongStreams:
-            # Delete files containing incomplete data ONLY if we are storing
-            # data in this run. Otherwise we could delete files from a previous
-            # run.
-            if self.dumpWaveforms:
-                test = '%s-%s%s%s%s*' % (self.name, n, s, l, c)
-                r = glob.glob(test)
-                for i in r:
-                    try:
-                        os.remove(i)
-                    except OSError:
-                        pass
-            return False
+        return self.input.feed(rec)
 
-        # Check that the beginning of the record (+30 seconds) is inside the
-        # timewindow
-        if (n, s, l, c) in self.timeWinDict:
-            t_from, t_to = self.timeWinDict[n, s, l, c]
-            rStart = rec.startTime()
-            rEnd = rec.endTime()
-            if not ((rStart > t_to) or (rEnd < t_from)):
-                if not streamID in self._timeStream:
-                    # The start time of the record is kept in order to check
-                    # that the records come in order. I tried keeping end time
-                    # and compare it with the start time of the next one but
-                    # there is a minimum overlapping.
-                    self.startTime[streamID] = rStart.length()
-                    self._timeStream[streamID] = rEnd
-                    self._incoming[streamID] = [rec]
-                    self.sps[streamID] = rec.samplingFrequency()
-                else:
-                    # Check that the new record comes in chronological order
-                    if rEnd < self._timeStream[streamID]:
-                        msg = "Record in wrong order! %s : '%s' before '%s'" \
-                            % (streamID, rEnd,
-                               self._timeStream[streamID])
-                        seiscomp3.Logging.error(msg)
-                        self._wrongStreams.append(streamID)
-                        return False
-
-                    # Check that there is no gap longer than 5 seconds
-                    if (rStart > (self._timeStream[streamID] +
-                                  seiscomp3.Core.TimeSpan(5))):
-                        msg = "Gap between records! %s : '%s' till '%s'" % \
-                            (streamID, self._timeStream[streamID],
-                             rStart)
-                        seiscomp3.Logging.error(msg)
-                        self._wrongStreams.append(streamID)
-                        return False
-                    else:
-                        self._timeStream[streamID] = rEnd
-                        self._incoming[streamID].append(rec)
-
-                # If the record was appended see whether I need to calculate
-                # the average.
-                if (streamID not in self.avgValue):
-                    self.avgValue[streamID] = (0, 0)
-
-                # If I have a tuple here, this means that I still need to
-                # calculate further the average
-                if type(self.avgValue[streamID]) == tuple:
-                    limitTime = self.startTime[streamID] + self.peepAvg
-                    limitPos = (limitTime - rStart.length()) * \
-                        rec.samplingFrequency()
-
-                    gain = self.getGain(n, s, l, c)
-                    cumul, count = self.avgValue[streamID]
-
-                    # Loop to calculate the average
-                    data = rec.data().numpy()
-                    for pos, i in enumerate(data):
-                        cumul += i / gain
-                        count += 1
-                        if pos > limitPos:
-                            # I'm done calculating the average!
-                            self.avgValue[streamID] = cumul / count
-                            break
-                    else:
-                        # I still need the next record to calculate the average
-                        self.avgValue[streamID] = (cumul, count)
-
-                return True
-
-        return False
+    def _addStream(self, input):
+        """Create the state of a stream requested by the processor."""
+
+        state = self.stateClass(input, self.table)
+        state.rejected = input.streamID in self.quarantine
+        self.streams[input.streamID] = state
+        self.states.append(state)
+        return state
+
+    def flush(self):
+        """Process the batches of all the streams."""
+
+        self.input.flush()
+
+    def _reject(self, streamID, reason):
+        """Put a stream in quarantine, so that its records are not
+        processed anymore."""
+
+        if not self.quarantine.add(streamID, reason):
+            return
+
+        state = self.streams.get(streamID)
+        if state is not None:
+            state.rejected = True
+
+        seiscomp3.Logging.warning("Processor %s: %s discarded (%s)" %
+                                  (self.name, streamID, reason))
+
+        # Delete files containing incomplete data ONLY if we are storing
+        # data in this run. Otherwise we could delete files from a previous
+        # run.
+        if self.dumpWaveforms:
+            n, s, l, c = streamID.split('.')
+            test = '%s-%s%s%s%s*' % (self.name, n, s, l, c)
+            self._output(self._removeOutput, test)
+
+        if self.onReject is not None:
+            self.onReject(streamID)
+
+    def resume(self, state, missing):
+        """Called before processing a record which comes after a gap that
+        could not be filled. "missing" is the number of samples in the gap.
+        This method can be implemented in the derived class."""
+
+        pass
+
+    def process(self, state, rec):
+        """Process a record which was accepted. Records of a stream are
+        received in chronological order with the state of the stream. Their
+        samples are already scaled with the gain and centered, and must not
+        be modified (they are shared by all the processors). This method
+        MUST be implemented in the derived class."""
+
+        pass
+
+    def outputFile(self, filename):
+        """Path of a file to be saved by the processor."""
+
+        return os.path.join(self.outputDir, filename)
+
+    def _output(self, function, *args):
+        """Call a function which writes to disk, in the background if there
+        is a writer."""
+
+        if self.writer is None:
+            function(*args)
+        else:
+            self.writer.submit(function, *args)
+
+    def _appendOutput(self, function, *args):
+        """Like _output, for a function which only appends data to a file
+        (e.g. a block of a waveform dump). It may be discarded if too many
+        writes are pending (see outputwriter.OutputWriter.append)."""
+
+        if self.writer is None:
+            function(*args)
+        else:
+            self.writer.append(function, *args)
+
+    def _replaceOutput(self, filename, function, *args):
+        """Like _output, for a function which rewrites a complete file. If
+        the file is rewritten again before it was done, only the last call
+        is executed."""
+
+        if self.writer is None:
+            function(*args)
+        else:
+            self.writer.replace(self.outputFile(filename), function, *args)
+
+    def _removeOutput(self, filePatt):
+        for i in glob.glob(self.outputFile(filePatt)):
+            try:
+                os.remove(i)
+            except OSError:
+                pass
 
     def setInventory(self, inventory):
         print "This should not be called!!!!"
@@ -151,6 +1180,23 @@ class Processor:
                                 (self.name, len(inventory)))
         self.inventory = inventory
 
+    def distanceCorrection(self, delta, depth):
+        """Correction to apply based on the distance and depth. This method
+        can be implemented in the derived class."""
+
+        return 0.0
+
+    def _updateGeometry(self):
+        """Calculate the geometry of the selected stations for the current
+        event."""
+
+        stations = dict((key, self.filtered[key]) for key in self.filtered
+                        if isinstance(key, tuple) and len(key) == 2)
+        self.geometry = StationGeometry(self.event, stations,
+                                        self.distanceCorrection)
+        seiscomp3.Logging.debug("Processor %s: geometry of %d stations" %
+                                (self.name, len(self.geometry)))
+
     def getGain(self, net, sta, loc, cha):
         if (net, sta, loc, cha) not in self.gain:
             s = self.filtered[net, sta, loc, cha]
@@ -162,7 +1208,6 @@ class Processor:
 
     def setEvent(self, origin):
         # event is a SC3 event!
-        updateRequired = False
         lat = origin.latitude().value()
         lon = origin.longitude().value()
         dep = origin.depth().value()
@@ -170,6 +1215,15 @@ class Processor:
         #    "%Y-%m-%d %H:%M:%S.%f000000")[:22]
         time = origin.time().value()
 
+        if self.moveEvent(time, lat, lon, dep):
+            self.flush()
+            self.update()
+
+    def moveEvent(self, time, lat, lon, dep):
+        """Set the location of the event. Returns True if it was relocated
+        and the results must be updated."""
+
+        updateRequired = False
         if self.event:
             delta, az, baz = seiscomp3.Math.delazi(self.event.lat,
                                                    self.event.lon,
@@ -187,10 +1241,35 @@ class Processor:
                                    self.event.dep))
 
         if updateRequired:
-            self.update()
+            # Distances and corrections must be recalculated if the event was
+            # relocated
+            if self.geometry is not None:
+                self._updateGeometry()
+
+        return updateRequired
+
+    def summary(self):
+        """Picklable summary of the streams, used to combine the results of
+        the processors which share the streams of an event (see
+        streampool): the stream IDs, the rows of the StreamTable, the end
+        of the newest record (seconds) and the streams in quarantine."""
+
+        ends = [state.timeStream.length() for state in self.states
+                if state.timeStream is not None]
+        return dict(streamID=[state.streamID for state in self.states],
+                    table=self.table.rows(),
+                    end=max(ends) if ends else None,
+                    quarantine=dict(self.quarantine.reasons))
 
     def update(self):
         pass
 
     def finalize(self):
         seiscomp3.Logging.debug("Processor %s: finalizing" % self.name)
+        self.finishStreams()
+
+    def finishStreams(self):
+        """Process all the records still pending in the preprocessing stage
+        and log its counters."""
+
+        self.input.finish()